@@ -1,39 +1,42 @@
 import os
 import sys
 import json
-import shutil
-import subprocess
-import ctypes
-import tkinter as tk
-from tkinter import filedialog
 from pathlib import Path
-from typing import List
-import win32com.client
 import time
-from datetime import datetime, timedelta
+
+# GUI (tkinter), COM (win32com) and the sync engine are imported where they are used, so a
+# scheduled --run-task only loads what a sync needs.
 
 # --- Global Paths ---
-BASE_DIR = Path(os.environ.get('APPDATA')) / 'VaultMirror'
-SCRIPTS_DIR = BASE_DIR / 'scripts'
+# Without APPDATA (a service account, or not Windows) the home folder stands in; shard workers re-import this module
+BASE_DIR = Path(os.environ.get('APPDATA') or Path.home()) / 'VaultMirror'
+SCRIPTS_DIR = BASE_DIR / 'scripts'  # Per-job JSON configs (and legacy generated sync_*.py scripts)
 STATES_DIR = BASE_DIR / 'sync-states'
 LOCKS_DIR = BASE_DIR / 'locks'
+METRICS_DIR = BASE_DIR / 'metrics'  # One JSON-lines file of run records per case
 # Note: Deleted folder will be on destination drive, not C: drive
 
-for p in [BASE_DIR, SCRIPTS_DIR, STATES_DIR, LOCKS_DIR]:
-    p.mkdir(parents=True, exist_ok=True)
+def ensure_dirs():
+    for p in [BASE_DIR, SCRIPTS_DIR, STATES_DIR, LOCKS_DIR]:
+        p.mkdir(parents=True, exist_ok=True)
 
 # --- Constants ---
 DELETION_GRACE_PERIOD_DAYS = 30  # Files in deleted folder older than this will be purged
+DELETED_INDEX_NAME = "deleted-index.db"  # Written by safe_delete() in each case's deleted folder
+DELETED_PAGE_SIZE = 25
 
 # --- Helpers ---
 
 def is_admin():
     try:
+        import ctypes
         return ctypes.windll.shell32.IsUserAnAdmin()
     except:
         return False
 
 def select_folder(title="Select Folder"):
+    import tkinter as tk
+    from tkinter import filedialog
     root = tk.Tk()
     root.withdraw()
     root.attributes('-topmost', True)
@@ -41,17 +44,110 @@ def select_folder(title="Select Folder"):
     root.destroy()
     return folder_selected
 
-def run_standalone_sync(script_path):
-    p = Path(script_path)
+def write_job_config(case_name, source_path, dest_path, bidirectional, state_file, exclude=(), extra_dests=(), bandwidth=0):
+    """Write the JSON config the sync engine runs a scheduled job from (extra_dests: more one-way destinations,
+    bandwidth: the job's copy rate cap in MB/s, 0 for none)"""
+    job_path = SCRIPTS_DIR / f"sync_{case_name}.json"
+    lock_file = LOCKS_DIR / f"{case_name}.lock"
+    
+    # Choose destination drive for deleted folder (use destination drive by default)
+    dest_root = Path(dest_path).drive if Path(dest_path).drive else Path(source_path).drive
+    DELETED_ROOT = Path(f"{dest_root}\\VaultMirror_Deleted\\{case_name}")
+    
+    job = {
+        'case_name': case_name,
+        'source_path': str(source_path),
+        'dest_path': str(dest_path),
+        'bidirectional': bool(bidirectional),
+        'state_file': str(state_file),
+        'lock_file': str(lock_file),
+        'deleted_root': str(DELETED_ROOT),
+        'metrics_dir': str(METRICS_DIR),
+        'exclude': list(exclude)
+    }
+    if bandwidth:
+        job['bandwidth_mb_per_s'] = bandwidth
+    if extra_dests:
+        # Fan-out: one read of the source feeds every destination, each with its own state and deleted folder
+        job['bidirectional'] = False
+        job['destinations'] = [{'case_name': case_name, 'dest_path': job['dest_path'], 'state_file': job['state_file'],
+                                'lock_file': job['lock_file'], 'deleted_root': job['deleted_root']}]
+        for i, extra in enumerate(extra_dests, 2):
+            extra_root = Path(extra).drive if Path(extra).drive else Path(source_path).drive
+            job['destinations'].append({
+                'case_name': f"{case_name}_{i}",
+                'dest_path': str(extra),
+                'state_file': str(Path(state_file).with_name(f"{Path(state_file).stem}_{i}.json")),
+                'lock_file': str(LOCKS_DIR / f"{case_name}_{i}.lock"),
+                'deleted_root': str(Path(f"{extra_root}\\VaultMirror_Deleted\\{case_name}_{i}"))
+            })
+    with open(job_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, indent=2)
+    return job_path
+
+def migrate_legacy_job(script_path):
+    """Write a job config for a task that still points at a generated sync_<case>.py"""
+    config_file = BASE_DIR / 'sync-config.json'
+    try:
+        with open(config_file, 'r') as f:
+            jobs = json.load(f).get('sync_jobs', {})
+    except (OSError, ValueError):
+        return None
+    for task_name, details in jobs.items():
+        if Path(details.get('script_path', '')) == Path(script_path):
+            return write_job_config(details['case_name'], details['source_path'], details['dest_path'],
+                                    details.get('bidirectional', False), STATES_DIR / f"state_{task_name}.json",
+                                    details.get('exclude', ()), details.get('extra_dest_paths', ()),
+                                    details.get('bandwidth_mb_per_s', 0))
+    return None
+
+def run_standalone_sync(job_path, watch_mode=False, dry_run=False):
+    p = Path(job_path)
+    # Tasks created by older versions point at a generated sync_<case>.py; use its job config if written since
+    if p.suffix == '.py' and (p.with_suffix('.json').exists() or migrate_legacy_job(p)):
+        p = p.with_suffix('.json')
     if not p.exists(): return
+    if p.suffix == '.json':
+        import VaultMirrorEngine
+        VaultMirrorEngine.run_job(p, watch_mode, dry_run)
+        return
+    if dry_run:
+        print("Dry run needs a job config; run this task once to migrate it")
+        return
     with open(p, 'r', encoding='utf-8') as f:
         code = f.read()
+    import shutil
     exec_globals = {'os': os, 'json': json, 'shutil': shutil, 'Path': Path, '__name__': '__main__'}
     exec(code, exec_globals)
 
+def run_all_jobs(task_names=(), dry_run=False):
+    """Run the jobs in sync-config.json (all of them, or the named tasks/cases) in one process"""
+    config_file = BASE_DIR / 'sync-config.json'
+    try:
+        with open(config_file, 'r') as f:
+            jobs = json.load(f).get('sync_jobs', {})
+    except (OSError, ValueError):
+        print("No sync jobs configured")
+        return
+    job_paths = []
+    for task_name, details in jobs.items():
+        if task_names and task_name not in task_names and details.get('case_name') not in task_names:
+            continue
+        p = Path(details.get('script_path', ''))
+        if p.suffix == '.py':
+            p = p.with_suffix('.json') if p.with_suffix('.json').exists() else migrate_legacy_job(p)
+        if p and p.exists():
+            job_paths.append(p)
+        else:
+            print(f"Skipping {task_name}: job config not found")
+    import VaultMirrorEngine
+    VaultMirrorEngine.run_many(job_paths, dry_run)
+
 class DriveSyncScheduler:
     def __init__(self):
+        ensure_dirs()
         try:
+            import win32com.client
             self.scheduler = win32com.client.Dispatch('Schedule.Service')
             self.scheduler.Connect()
         except Exception as e:
@@ -73,328 +169,11 @@ class DriveSyncScheduler:
         with open(self.config_file, 'w') as f:
             json.dump(self.config, f, indent=2)
 
-    def _create_sync_script(self, case_name, source_path, dest_path, bidirectional, state_file):
-        script_path = SCRIPTS_DIR / f"sync_{case_name}.py"
-        lock_file = LOCKS_DIR / f"{case_name}.lock"
-        
-        # Choose destination drive for deleted folder (use destination drive by default)
-        dest_root = Path(dest_path).drive if Path(dest_path).drive else Path(source_path).drive
-        DELETED_ROOT = Path(f"{dest_root}\\VaultMirror_Deleted\\{case_name}")
-        
-        # Build the script template with placeholders
-        script_template = '''import os
-import json
-import shutil
-import time
-from pathlib import Path
-from datetime import datetime, timedelta
-
-# Files to ignore during sync
-EXCLUSIONS = [".tmp"]
-DELETION_GRACE_PERIOD_DAYS = 30  # Files in deleted folder older than this will be purged
-
-# IMPORTANT: Exclude our own deleted folder from sync
-DELETED_ROOT = Path(r"DELETED_ROOT_PLACEHOLDER")
-EXCLUSION_PATHS = [DELETED_ROOT]
-
-def is_drive_accessible(path):
-    """Check if a drive/path is actually accessible"""
-    try:
-        # Try to list one item to test accessibility
-        p = Path(path)
-        if not p.exists():
-            # Path doesn't exist - might be disconnected drive
-            return False
-        # Try to read from the path
-        next(p.iterdir(), None)
-        return True
-    except (OSError, IOError, PermissionError, WindowsError):
-        return False
-
-def is_excluded_path(file_path):
-    """Check if file is in an excluded path"""
-    try:
-        for excluded in EXCLUSION_PATHS:
-            if excluded and excluded.exists():
-                # Check if file is within the excluded directory
-                if Path(file_path).is_relative_to(excluded):
-                    return True
-    except:
-        pass
-    return False
-
-def get_tree_state(path):
-    """Get current state of files in path, excluding our deleted folder"""
-    p = Path(path)
-    state = {}
-    if not p.exists(): 
-        return state
-    
-    for file in p.rglob("*"):
-        if file.is_file():
-            # Skip excluded file types
-            if any(file.name.lower().endswith(ext) for ext in EXCLUSIONS):
-                continue
-            # Skip files in our deleted folder
-            if is_excluded_path(file):
-                continue
-            try: 
-                state[str(file.relative_to(p))] = {
-                    'mtime': file.stat().st_mtime,
-                    'size': file.stat().st_size
-                }
-            except: 
-                pass
-    return state
-
-def safe_delete(file_path, deleted_root, sync_id, direction):
-    """Move file to deleted folder instead of permanent deletion"""
-    try:
-        # Create deleted folder if it doesn't exist
-        deleted_root.mkdir(parents=True, exist_ok=True)
-        
-        # Create unique deletion timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        # Get relative path for organization
-        try:
-            # Try to get relative path from source/dest root
-            if "A_to_B" in direction:
-                root_path = Path(r"SOURCE_PATH_PLACEHOLDER")
-            elif "B_to_A" in direction:
-                root_path = Path(r"DEST_PATH_PLACEHOLDER")
-            else:
-                root_path = file_path.parents[-1]
-            
-            try:
-                rel_path = str(file_path.relative_to(root_path))
-            except:
-                rel_path = file_path.name
-        except:
-            rel_path = file_path.name
-        
-        # Create safe filename for storage
-        safe_name = rel_path.replace(os.sep, "_").replace("..", "parent")
-        if len(safe_name) > 200:
-            safe_name = safe_name[:100] + "..." + safe_name[-100:]
-        
-        # Create organized deletion folder structure
-        deleted_dir = deleted_root / direction / timestamp[:8]  # YYYYMMDD
-        deleted_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Move file to deleted folder
-        dest_path = deleted_dir / f"{timestamp}_{safe_name}"
-        
-        # If destination exists, add counter
-        counter = 1
-        original_dest = dest_path
-        while dest_path.exists():
-            dest_path = original_dest.with_stem(f"{original_dest.stem}_{counter}")
-            counter += 1
-            
-        shutil.move(str(file_path), str(dest_path))
-        
-        # Create metadata file
-        meta = {
-            'original_path': str(file_path),
-            'original_rel_path': rel_path,
-            'deleted_at': timestamp,
-            'sync_id': sync_id,
-            'direction': direction,
-            'original_size': file_path.stat().st_size if file_path.exists() else 0
-        }
-        
-        with open(f"{dest_path}.meta.json", 'w') as f:
-            json.dump(meta, f, indent=2)
-            
-        return True
-    except Exception as e:
-        print(f"Safe delete failed for {file_path}: {e}")
-        return False
-
-def purge_old_deletions(deleted_root, days_old=DELETION_GRACE_PERIOD_DAYS):
-    """Purge files in deleted folder older than specified days"""
-    if not deleted_root.exists():
-        return 0
-        
-    cutoff_time = time.time() - (days_old * 24 * 60 * 60)
-    purged_count = 0
-    
-    for meta_file in deleted_root.rglob("*.meta.json"):
-        try:
-            # Check meta file age
-            if meta_file.stat().st_mtime < cutoff_time:
-                # Find associated data file
-                data_file = meta_file.with_suffix('')  # Remove .meta.json
-                if data_file.exists():
-                    data_file.unlink()
-                meta_file.unlink()
-                purged_count += 1
-                
-                # Try to remove empty directories
-                try:
-                    meta_file.parent.rmdir()
-                except:
-                    pass  # Directory not empty
-        except:
-            continue
-    
-    return purged_count
-
-def sync():
-    lock_path = Path(r"LOCK_FILE_PLACEHOLDER")
-    if lock_path.exists(): 
-        print("Sync already in progress")
-        return
-    
-    lock_path.touch()
-    
-    try:
-        dir_a, dir_b = Path(r"SOURCE_PATH_PLACEHOLDER"), Path(r"DEST_PATH_PLACEHOLDER")
-        state_path = Path(r"STATE_FILE_PLACEHOLDER")
-        sync_id = "CASE_NAME_PLACEHOLDER"
-        
-        # Initialize deleted folder on destination drive
-        DELETED_ROOT.mkdir(parents=True, exist_ok=True)
-        
-        print(f"Deleted files stored at: {DELETED_ROOT}")
-        
-        # Check drive accessibility
-        a_accessible = is_drive_accessible(dir_a)
-        b_accessible = is_drive_accessible(dir_b)
-        
-        if not a_accessible and not b_accessible:
-            print(f"ERROR: Both drives inaccessible. Skipping sync.")
-            return
-            
-        if not a_accessible:
-            print(f"WARNING: Source drive {dir_a} is inaccessible. Only copying from B to A if bidirectional.")
-            
-        if not b_accessible:
-            print(f"WARNING: Destination drive {dir_b} is inaccessible. Only copying from A to B if bidirectional.")
-        
-        # Purge old deletions before sync
-        purged = purge_old_deletions(DELETED_ROOT, DELETION_GRACE_PERIOD_DAYS)
-        if purged > 0:
-            print(f"Purged {purged} old deleted files")
-        
-        last_state = {}
-        if state_path.exists():
-            try:
-                with open(state_path, "r") as f: 
-                    last_state = json.load(f)
-            except: 
-                pass
-
-        # Only scan accessible drives
-        curr_a = get_tree_state(dir_a) if a_accessible else {}
-        curr_b = get_tree_state(dir_b) if b_accessible else {}
-        
-        all_paths = set(curr_a.keys()) | set(curr_b.keys()) | set(last_state.keys())
-        new_state = {}
-        deletions = 0
-        
-        for rel in all_paths:
-            p_a, p_b = dir_a / rel, dir_b / rel
-            in_a, in_b, in_l = rel in curr_a, rel in curr_b, rel in last_state
-            
-            # Skip if path is in our deleted folder (shouldn't happen with exclusion, but safety check)
-            if is_excluded_path(p_a) or is_excluded_path(p_b):
-                continue
-'''
-        
-        # Add the sync logic based on bidirectional flag
-        if bidirectional:
-            script_template += '''
-            # Bi-directional deletion logic with safety checks
-            if in_l and not in_a and in_b:
-                # File existed before, now only in B (deleted from A)
-                if b_accessible and p_b.exists():
-                    if safe_delete(p_b, DELETED_ROOT, sync_id, "A_to_B"):
-                        deletions += 1
-                    continue
-            elif in_l and not in_b and in_a:
-                # File existed before, now only in A (deleted from B)
-                if a_accessible and p_a.exists():
-                    if safe_delete(p_a, DELETED_ROOT, sync_id, "B_to_A"):
-                        deletions += 1
-                    continue
-            '''
-        else:
-            script_template += '''
-            # One-way deletion: only delete from destination if source doesn't have it
-            if in_l and not in_a and in_b:
-                # File existed before in source, now missing from source but in destination
-                if b_accessible and p_b.exists():
-                    if safe_delete(p_b, DELETED_ROOT, sync_id, "one_way"):
-                        deletions += 1
-                    continue
-            '''
-        
-        # Add copy logic for both directions
-        script_template += '''
-            # Copy from A to B if A is accessible
-            if in_a and a_accessible:
-                # Copy from A to B if B is accessible
-                if b_accessible and (not in_b or curr_a[rel]['mtime'] > curr_b.get(rel, {}).get('mtime', 0)):
-                    p_b.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(p_a, p_b)
-                    new_state[rel] = {'mtime': curr_a[rel]['mtime'], 'size': curr_a[rel]['size']}
-                elif not b_accessible and in_a:
-                    # B not accessible, but A has file - keep in state
-                    new_state[rel] = {'mtime': curr_a[rel]['mtime'], 'size': curr_a[rel]['size']}
-        '''
-        
-        if bidirectional:
-            script_template += '''
-            # Bi-directional: copy from B to A if B is accessible
-            elif in_b and b_accessible:
-                if a_accessible and (not in_a or curr_b[rel]['mtime'] > curr_a.get(rel, {}).get('mtime', 0)):
-                    p_a.parent.mkdir(parents=True, exist_ok=True)
-                    shutil.copy2(p_b, p_a)
-                    new_state[rel] = {'mtime': curr_b[rel]['mtime'], 'size': curr_b[rel]['size']}
-                elif not a_accessible and in_b:
-                    # A not accessible, but B has file - keep in state
-                    new_state[rel] = {'mtime': curr_b[rel]['mtime'], 'size': curr_b[rel]['size']}
-            '''
-        
-        # Add the rest of the sync function
-        script_template += '''
-        
-        with open(state_path, "w") as f:
-            json.dump(new_state, f, indent=2)
-            
-        if deletions > 0:
-            print(f"SAFE DELETE: Moved {deletions} file(s) to {DELETED_ROOT}")
-            print(f"Files will be permanently deleted after ''' + str(DELETION_GRACE_PERIOD_DAYS) + ''' days.")
-            
-    except Exception as e:
-        print(f"Sync error: {e}")
-    finally:
-        if lock_path.exists(): 
-            lock_path.unlink()
-
-if __name__ == "__main__":
-    sync()
-'''
-        
-        # Replace placeholders with actual values
-        script_content = script_template
-        script_content = script_content.replace("DELETED_ROOT_PLACEHOLDER", str(DELETED_ROOT))
-        script_content = script_content.replace("SOURCE_PATH_PLACEHOLDER", str(source_path))
-        script_content = script_content.replace("DEST_PATH_PLACEHOLDER", str(dest_path))
-        script_content = script_content.replace("LOCK_FILE_PLACEHOLDER", str(lock_file))
-        script_content = script_content.replace("STATE_FILE_PLACEHOLDER", str(state_file))
-        script_content = script_content.replace("CASE_NAME_PLACEHOLDER", case_name)
-        
-        with open(script_path, 'w', encoding='utf-8') as f:
-            f.write(script_content)
-        return script_path
-
-    def create_sync_task(self, case_name, source_path, dest_path, interval, bidirectional):
+    def create_sync_task(self, case_name, source_path, dest_path, interval, bidirectional, exclude=(), extra_dests=(), bandwidth=0):
         task_name = f"dfirvault-sync-{case_name}"
         state_file = STATES_DIR / f"state_{task_name}.json"
-        sync_script = self._create_sync_script(case_name, source_path, dest_path, bidirectional, state_file)
+        bidirectional = bidirectional and not extra_dests
+        job_path = write_job_config(case_name, source_path, dest_path, bidirectional, state_file, exclude, extra_dests, bandwidth)
         
         # Display warning for bidirectional sync
         if bidirectional:
@@ -416,9 +195,12 @@ if __name__ == "__main__":
         sch, mod, friendly_name = interval_map.get(interval, ('HOURLY', '1', 'Hourly'))
         
         exe_path = sys.executable
-        cmd = ['schtasks', '/Create', '/TN', task_name, '/TR', f'"{exe_path}" --run-task "{sync_script}"',
+        # Frozen builds are the program itself; from source, python.exe needs this script's path
+        launcher = f'"{exe_path}"' if getattr(sys, 'frozen', False) else f'"{exe_path}" "{Path(__file__).resolve()}"'
+        cmd = ['schtasks', '/Create', '/TN', task_name, '/TR', f'{launcher} --run-task "{job_path}"',
                '/SC', sch, '/MO', mod, '/F']
         
+        import subprocess
         res = subprocess.run(cmd, capture_output=True, text=True, shell=True)
         if res.returncode == 0:
             # Calculate deleted folder location for display
@@ -431,29 +213,51 @@ if __name__ == "__main__":
                 'dest_path': str(dest_path), 
                 'bidirectional': bidirectional, 
                 'interval_desc': friendly_name, 
-                'script_path': str(sync_script),
-                'deleted_location': deleted_location
+                'script_path': str(job_path),
+                'deleted_location': deleted_location,
+                'exclude': list(exclude),
+                'extra_dest_paths': [str(p) for p in extra_dests],
+                'bandwidth_mb_per_s': bandwidth
             }
             self.save_config()
             return True
         return False
 
     def delete_sync_task(self, task_name):
+        import shutil
+        import subprocess
         subprocess.run(f'schtasks /Delete /TN "{task_name}" /F', shell=True, capture_output=True)
-        state_file = STATES_DIR / f"state_{task_name}.json"
-        if state_file.exists(): state_file.unlink()
         details = self.config['sync_jobs'].get(task_name)
+        states = [STATES_DIR / f"state_{task_name}.json"]
+        if details:
+            states += [STATES_DIR / f"state_{task_name}_{i}.json" for i in range(2, len(details.get('extra_dest_paths', ())) + 2)]
+        for state_file in states:
+            for p in [state_file, state_file.with_suffix('.db'), state_file.with_suffix('.db-wal'),
+                      state_file.with_suffix('.db-shm'), state_file.with_suffix('.hashes.db'),
+                      state_file.with_name(state_file.name + '.migrated')]:
+                if p.exists(): p.unlink()
         if details:
             if 'script_path' in details:
                 p = Path(details['script_path'])
-                if p.exists(): p.unlink()
+                for f in [p, p.with_suffix('.py'), p.with_suffix('.json')]:
+                    if f.exists(): f.unlink()
             l = LOCKS_DIR / f"{details.get('case_name', '')}.lock"
             if l.exists(): l.unlink()
+            if details.get('case_name'):
+                import VaultMirrorEngine
+                # Extra fan-out destinations run as <case>_2, <case>_3, ...
+                cases = [details['case_name']] + [f"{details['case_name']}_{i}" for i in range(2, len(states) + 1)]
+                for case in cases:
+                    shutil.rmtree(STATES_DIR / 'partial' / case, ignore_errors=True)
+                    prom = VaultMirrorEngine.prometheus_textfile_path(case)
+                    for f in [LOCKS_DIR / f"{case}.lock", METRICS_DIR / f"{case}.jsonl", METRICS_DIR / f"{case}.jsonl.1", prom]:
+                        if f and f.exists(): f.unlink()
         if task_name in self.config['sync_jobs']:
             del self.config['sync_jobs'][task_name]
             self.save_config()
 
     def run_sync_immediately(self, task_name):
+        import subprocess
         subprocess.run(f'schtasks /Run /TN "{task_name}"', shell=True, capture_output=True)
 
 # --- UI ---
@@ -461,6 +265,54 @@ if __name__ == "__main__":
 def clear():
     os.system('cls' if os.name == 'nt' else 'clear')
 
+def view_deleted_index(deleted_path, index_path):
+    """Page through a deleted folder's index, newest deletions first"""
+    import sqlite3
+    conn = sqlite3.connect(str(index_path))
+    try:
+        page = 0
+        while True:
+            total_files, total_size = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(original_size), 0) FROM deleted").fetchone()
+            pages = max(1, -(-total_files // DELETED_PAGE_SIZE))
+            page = min(page, pages - 1)
+            clear()
+            print(f"Deleted Files in: {deleted_path}")
+            print("="*60)
+            if total_files == 0:
+                print("\nNo deleted files found in this folder.")
+                input("\nPress Enter to continue...")
+                return
+            rows = conn.execute(
+                "SELECT original_rel_path, deleted_at, direction, original_size, stored_path FROM deleted "
+                "ORDER BY deleted_ts DESC LIMIT ? OFFSET ?", (DELETED_PAGE_SIZE, page * DELETED_PAGE_SIZE))
+            for i, (rel_path, deleted_at, direction, size, stored_path) in enumerate(rows, page * DELETED_PAGE_SIZE + 1):
+                print(f"\n{i}. {rel_path or 'Unknown'}")
+                print(f"   Deleted: {deleted_at or 'Unknown'}")
+                print(f"   Direction: {direction or 'Unknown'}")
+                print(f"   Size: {size or 0:,} bytes")
+                print(f"   Stored: {stored_path}")
+            print(f"\n\nTotal: {total_files:,} files | Total size: {total_size:,} bytes | Page {page + 1}/{pages}")
+
+            print("\nOptions:")
+            print("N. Next page | P. Previous page")
+            print(f"1. Purge files older than {DELETION_GRACE_PERIOD_DAYS} days")
+            print("2. Back")
+            choice = input("\nChoice: ").strip().lower()
+            if choice == 'n':
+                page += 1
+            elif choice == 'p':
+                page = max(0, page - 1)
+            elif choice == '1':
+                import VaultMirrorEngine
+                purged = VaultMirrorEngine.purge_old_deletions(Path(deleted_path), DELETION_GRACE_PERIOD_DAYS)
+                print(f"\nPurged {purged} files.")
+                input("Press Enter to continue...")
+            elif choice == '2':
+                return
+    finally:
+        conn.close()
+
 def view_deleted_folder(deleted_path):
     """View contents of a specific deleted folder"""
     if not deleted_path.exists():
@@ -468,6 +320,16 @@ def view_deleted_folder(deleted_path):
         input("Press Enter to continue...")
         return
     
+    # Folders written by current sync scripts carry an index; older ones are walked
+    index_path = deleted_path / DELETED_INDEX_NAME
+    if index_path.exists():
+        import sqlite3
+        try:
+            view_deleted_index(deleted_path, index_path)
+            return
+        except sqlite3.Error as e:
+            print(f"\nDeleted-files index unreadable ({e}), scanning folder instead.")
+    
     clear()
     print(f"Deleted Files in: {deleted_path}")
     print("="*60)
@@ -506,7 +368,7 @@ def view_deleted_folder(deleted_path):
             purged = 0
             for meta_file in deleted_path.rglob("*.meta.json"):
                 if meta_file.stat().st_mtime < cutoff_time:
-                    data_file = meta_file.with_suffix('')
+                    data_file = Path(str(meta_file)[:-len(".meta.json")])
                     if data_file.exists():
                         data_file.unlink()
                     meta_file.unlink()
@@ -568,10 +430,24 @@ def main_menu():
             if not case: continue
             src, dst = select_folder("Select Source"), select_folder("Select Destination")
             if not src or not dst: continue
+            extra_dsts = []
+            while input("Add another destination? (y/n): ").lower() == 'y':
+                extra = select_folder("Select Another Destination")
+                if extra: extra_dsts.append(extra)
             print("\n1. Minute | 2. Hour | 3. Day | 4. Week")
             itv = input("Choice: ").strip()
-            bi = input("Bi-directional? (y/n): ").lower() == 'y'
-            if scheduler.create_sync_task(case, src, dst, itv, bi):
+            if extra_dsts:
+                print("Several destinations: one-way sync, the source is read once for all of them")
+                bi = False
+            else:
+                bi = input("Bi-directional? (y/n): ").lower() == 'y'
+            print("\nExclude patterns, gitignore-style (e.g. pagefile.sys, $RECYCLE.BIN/, *.lck)")
+            exclude = [p.strip() for p in input("Comma-separated, blank for none: ").split(',') if p.strip()]
+            try:
+                bandwidth = max(0.0, float(input("Bandwidth cap in MB/s (blank for none): ").strip() or 0))
+            except ValueError:
+                bandwidth = 0
+            if scheduler.create_sync_task(case, src, dst, itv, bi, exclude, extra_dsts, bandwidth):
                 print("\n✓ Task Created.")
                 
                 # Show deleted folder location
@@ -596,18 +472,27 @@ def main_menu():
                 print(f"--- TASK DETAILS: {name} ---")
                 print(f"Source:   {details.get('source_path')}")
                 print(f"Dest:     {details.get('dest_path')}")
+                for extra in details.get('extra_dest_paths', ()):
+                    print(f"Dest:     {extra}")
                 print(f"Interval: {details.get('interval_desc', 'Unknown')}")
+                if details.get('bandwidth_mb_per_s'):
+                    print(f"Bandwidth: {details['bandwidth_mb_per_s']:g} MB/s")
                 print(f"Mode:     {'Bi-Directional (Safe Delete)' if details.get('bidirectional') else 'One-Way (Safe Delete)'}")
                 print(f"Deleted files location: {details.get('deleted_location', 'Unknown')}")
                 print("-" * 60)
                 print("1. Run Now")
-                print("2. Delete Task")
-                print("3. Back")
+                print("2. Preview Next Run (Dry Run)")
+                print("3. Delete Task")
+                print("4. Back")
                 sub = input("\nAction: ").strip()
                 if sub == '1':
                     scheduler.run_sync_immediately(name)
                     print("✓ Triggered."); input("Press Enter...")
                 elif sub == '2':
+                    print()
+                    run_standalone_sync(details.get('script_path', ''), dry_run=True)
+                    input("\nPress Enter...")
+                elif sub == '3':
                     scheduler.delete_sync_task(name)
                     print("✓ Deleted."); input("Press Enter...")
         elif choice == '3':
@@ -616,7 +501,12 @@ def main_menu():
             break
 
 if __name__ == "__main__":
-    if len(sys.argv) > 2 and sys.argv[1] == '--run-task':
-        run_standalone_sync(sys.argv[2])
+    # Sharded syncs start worker processes, which re-run the frozen exe
+    import multiprocessing
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 2 and sys.argv[1] in ('--run-task', '--watch', '--dry-run'):
+        run_standalone_sync(sys.argv[2], watch_mode='--watch' in sys.argv, dry_run='--dry-run' in sys.argv)
+    elif len(sys.argv) > 1 and sys.argv[1] == '--run-all':
+        run_all_jobs([a for a in sys.argv[2:] if not a.startswith('--')], dry_run='--dry-run' in sys.argv)
     else:
         main_menu()
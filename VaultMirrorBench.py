@@ -0,0 +1,273 @@
+"""Benchmark the VaultMirror sync engine on synthetic trees.
+
+Builds source trees in a temp directory, syncs them with engine.sync() and reports the phase
+timings it records: purge, state load, scan (scan_a/scan_b), renames, diff, transfer (copies and
+safe-deletes) and the state save. Runs that take the streaming diff scan and decide in one pass,
+timed as diff. Every scenario is synced once from scratch, then twice with nothing changed (noop,
+then steady: the first pass at which both sides' directory listings are reused). Results are
+written as JSON so runs can be compared:
+
+    python VaultMirrorBench.py --scale 0.01 --output before.json
+    python VaultMirrorBench.py --scale 0.01 --compare before.json
+    python VaultMirrorBench.py --scale 0.01 --dir-cache off --compare before.json
+
+Scenarios (counts and sizes at --scale 1):
+    tiny   1,000,000 files of 0-64 bytes, 1,000 per directory
+    deep   200 chains of directories 50 levels deep, 2 files per level
+    large  3 files of 2 GiB
+    churn  100,000 small files synced, then 5% each renamed, deleted, modified and added
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import contextlib
+import platform
+import tempfile
+from pathlib import Path
+from datetime import datetime
+
+import VaultMirrorEngine as engine
+
+SCENARIOS = ("tiny", "deep", "large", "churn")
+REGRESSION_THRESHOLD = 0.20  # A phase this much slower than the baseline is flagged
+REGRESSION_MIN_SECONDS = 0.05  # ...unless it is faster than this either way (timer noise)
+WRITE_CHUNK = 1024 * 1024
+
+def _write(path, size, rng):
+    with open(path, "wb") as f:
+        if size <= WRITE_CHUNK:
+            f.write(rng.randbytes(size))
+            return
+        # One random chunk, repeated: real I/O without spending the run in the RNG
+        chunk = rng.randbytes(WRITE_CHUNK)
+        for _ in range(size // WRITE_CHUNK):
+            f.write(chunk)
+        f.write(chunk[:size % WRITE_CHUNK])
+
+def make_tiny(root, scale, rng):
+    count = max(1, int(1_000_000 * scale))
+    for i in range(count):
+        d = root / f"d{i // 1000:04d}"
+        if i % 1000 == 0:
+            d.mkdir(parents=True)
+        _write(d / f"f{i:07d}.bin", rng.randrange(65), rng)
+
+def make_deep(root, scale, rng):
+    for chain in range(max(1, int(200 * scale))):
+        d = root / f"chain{chain:03d}"
+        for level in range(50):
+            d = d / f"l{level:02d}"
+            d.mkdir(parents=True)
+            for n in range(2):
+                _write(d / f"f{n}.txt", rng.randrange(1, 4096), rng)
+
+def make_large(root, scale, rng):
+    root.mkdir(parents=True, exist_ok=True)
+    for i in range(3):
+        _write(root / f"image{i}.dd", max(WRITE_CHUNK, int(2 * 1024 ** 3 * scale)), rng)
+
+def make_churn_base(root, scale, rng):
+    count = max(20, int(100_000 * scale))
+    for i in range(count):
+        d = root / f"case{i % 50:02d}" / f"sub{i // 50 % 20:02d}"
+        d.mkdir(parents=True, exist_ok=True)
+        _write(d / f"f{i:06d}.bin", rng.randrange(1, 16 * 1024), rng)
+
+def apply_churn(root, rng):
+    """Rename, delete, modify and add 5% of the files each; returns the counts"""
+    files = sorted(p for p in root.rglob("*") if p.is_file())
+    rng.shuffle(files)
+    n = max(1, len(files) // 20)
+    renamed, deleted, modified = files[:n], files[n:2 * n], files[2 * n:3 * n]
+    for p in renamed:
+        target = root / "moved" / p.parent.name / p.name
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.rename(p, target)
+    for p in deleted:
+        p.unlink()
+    later = time.time() + 10
+    for p in modified:
+        _write(p, rng.randrange(1, 16 * 1024), rng)
+        os.utime(p, (later, later))
+    for i in range(n):
+        d = root / "added" / f"sub{i % 20:02d}"
+        d.mkdir(parents=True, exist_ok=True)
+        _write(d / f"new{i:06d}.bin", rng.randrange(1, 16 * 1024), rng)
+    return {'renamed': n, 'deleted': n, 'modified': n, 'added': n}
+
+def timed_sync(job, purge=False):
+    """One engine.sync() pass of job; returns its phase timings and counters"""
+    record = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        engine.sync(job, record=record)
+        if purge:
+            # sync() purges before it safe-deletes; purge this pass's deletions too, as past a zero-day grace period
+            started = time.perf_counter()
+            purged = engine.purge_old_deletions(job.deleted_root, 0)
+            record['phases']['purge'] = round(record['phases'].get('purge', 0) + time.perf_counter() - started, 4)
+            record['purged'] = record.get('purged', 0) + purged
+    if record['status'] != 'ok':
+        raise RuntimeError(f"{job.case_name}: sync ended with {record['status']} ({record['error']})")
+    scanned, planned = record['scanned'], record.get('planned', {})
+    counts = {
+        'streaming': record.get('streaming', False),
+        'files_a': scanned.get('a', {}).get('files', 0),
+        'files_b': scanned.get('b', {}).get('files', 0),
+        'bytes_a': scanned.get('a', {}).get('bytes', 0),
+        'dir_cache_hits': sum(side.get('dir_cache_hits', 0) for side in scanned.values()),
+        'renamed': planned.get('renames', 0),
+        'copies': record.get('copies', 0),
+        'bytes_copied': record.get('bytes_copied', 0),
+        'deletes': record.get('safe_deletes', 0),
+        'errors': record.get('copy_errors', 0),
+    }
+    if record.get('throughput_bytes_per_second'):
+        counts['copy_mb_per_s'] = round(record['throughput_bytes_per_second'] / 1024 ** 2, 1)
+    if 'purged' in record:
+        counts['purged'] = record['purged']
+    phases = record['phases']
+    return {'phases': phases, 'counts': counts, 'total': round(sum(phases.values()), 4)}
+
+def run_scenario(name, workdir, scale, seed):
+    rng = random.Random(seed)
+    base = workdir / name
+    src, dst = base / "A", base / "B"
+    src.mkdir(parents=True)
+    dst.mkdir()
+    job = engine.Job({
+        'case_name': f"bench-{name}",
+        'source_path': str(src),
+        'dest_path': str(dst),
+        'bidirectional': False,
+        'state_file': str(base / "state.json"),
+        'lock_file': str(base / "sync.lock"),
+        'deleted_root': str(base / "deleted"),
+    })
+    job.deleted_root.mkdir()
+
+    started = time.perf_counter()
+    if name == "tiny":
+        make_tiny(src, scale, rng)
+    elif name == "deep":
+        make_deep(src, scale, rng)
+    elif name == "large":
+        make_large(src, scale, rng)
+    else:
+        make_churn_base(src, scale, rng)
+    print(f"{name}: tree generated in {time.perf_counter() - started:.1f}s")
+
+    # Directories written this close to a scan are re-listed rather than recorded; scheduled runs
+    # are further apart than that, so each pass waits it out (outside the timings)
+    settle = engine.DIR_CACHE_RACY_SECONDS + 1
+    time.sleep(settle)
+    passes = {'initial': timed_sync(job)}
+    time.sleep(settle)
+    passes['noop'] = timed_sync(job)
+    # The initial copy wrote into every destination directory, so only from here on are both sides' listings reused
+    time.sleep(settle)
+    passes['steady'] = timed_sync(job)
+    if name == "churn":
+        changes = apply_churn(src, rng)
+        time.sleep(settle)
+        passes['churn'] = timed_sync(job, purge=True)
+        passes['churn']['counts'].update(changes)
+    for pass_name, record in passes.items():
+        phases = ", ".join(f"{k} {v:.2f}s" for k, v in record['phases'].items())
+        print(f"  {pass_name:8s} {record['total']:8.2f}s  ({phases})")
+    shutil.rmtree(base, ignore_errors=True)
+    return passes
+
+def _git_commit():
+    try:
+        import subprocess
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(results, baseline):
+    """Phases slower than the baseline by more than REGRESSION_THRESHOLD, as printable lines"""
+    if baseline.get('scale') != results['scale']:
+        print(f"WARNING: baseline was run at scale {baseline.get('scale')}, this run at {results['scale']}")
+    regressions = []
+    for scenario, passes in results['scenarios'].items():
+        for pass_name, record in passes.items():
+            old = baseline.get('scenarios', {}).get(scenario, {}).get(pass_name)
+            if not old:
+                continue
+            for phase, seconds in record['phases'].items():
+                before = old['phases'].get(phase)
+                if not before or max(before, seconds) < REGRESSION_MIN_SECONDS:
+                    continue
+                if seconds > before * (1 + REGRESSION_THRESHOLD):
+                    regressions.append(f"{scenario}/{pass_name}/{phase}: {before:.3f}s -> {seconds:.3f}s "
+                                       f"(+{(seconds / before - 1) * 100:.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VaultMirror sync engine on synthetic trees")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiplier for file counts and sizes")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--workdir", help="where to build the trees (default: system temp dir)")
+    parser.add_argument("--state-backend", choices=("sqlite", "json"), default=engine.STATE_BACKEND)
+    parser.add_argument("--streaming-threshold", type=int, default=engine.STREAMING_DIFF_THRESHOLD,
+                        help="manifest size from which the streaming diff is used (0 = always)")
+    parser.add_argument("--dir-cache", choices=("on", "off"), default="on" if engine.DIR_CACHE_ENABLED else "off",
+                        help="reuse recorded listings of unchanged directories (DIR_CACHE_ENABLED)")
+    parser.add_argument("--output", help="results file (default: bench-<timestamp>.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="flag phases slower than this results file")
+    args = parser.parse_args()
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+    engine.STATE_BACKEND = args.state_backend
+    engine.METRICS_ENABLED = False  # Timings come back from sync(); keep them out of the metrics files
+    engine.STREAMING_DIFF_THRESHOLD = args.streaming_threshold
+    engine.DIR_CACHE_ENABLED = args.dir_cache == "on"
+
+    results = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'settings': {name: getattr(engine, name) for name in (
+            'STATE_BACKEND', 'STREAMING_DIFF_THRESHOLD', 'SCAN_WORKERS', 'COPY_WORKERS_SMALL', 'COPY_WORKERS_LARGE',
+            'DIR_CACHE_ENABLED', 'DELTA_THRESHOLD', 'RESUMABLE_THRESHOLD', 'DETECT_RENAMES')},
+        'scenarios': {},
+    }
+    workdir = Path(tempfile.mkdtemp(prefix="vaultmirror-bench-", dir=args.workdir))
+    try:
+        for name in names:
+            results['scenarios'][name] = run_scenario(name, workdir, args.scale, args.seed)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = args.output or f"bench-{datetime.now():%Y%m%d_%H%M%S}.json"
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        if regressions:
+            print(f"REGRESSIONS against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+if __name__ == "__main__":
+    main()
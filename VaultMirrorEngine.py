@@ -0,0 +1,3977 @@
+"""VaultMirror sync engine.
+
+Imported by ``VaultMirror.py --run-task <job.json>`` and ``--run-all`` (and usable on its own as
+``python VaultMirrorEngine.py <job.json> [--watch | --dry-run]``, or with several job configs to run them
+together). Each job is described by a small JSON config written when the task is created;
+nothing here touches the GUI or COM.
+"""
+import os
+import re
+import sys
+import json
+import stat
+import heapq
+import bisect
+import hashlib
+import shutil
+import sqlite3
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from functools import partial
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+from datetime import datetime
+
+# gitignore-style rules applied to every job, ahead of the job's own "exclude" rules
+EXCLUSIONS = ["*.tmp"]
+SCAN_WORKERS = 8  # Threads used to walk subdirectories in parallel (1 = serial walk)
+COPY_WORKERS_SMALL = 8  # Concurrent copies/safe-deletes for files below LARGE_FILE_THRESHOLD
+COPY_WORKERS_LARGE = 2  # Concurrent copies for large files (disk images, memory dumps)
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024  # Bytes
+MAX_PENDING_TRANSFERS = 512  # Queued actions before the diff loop waits for the workers
+STREAMING_DIFF_THRESHOLD = 200_000  # Manifests with at least this many entries are diffed as sorted streams in bounded memory (0 = always; SQLite only)
+RENAME_CANDIDATE_LIMIT = 200_000  # Streaming diff: files held back for rename pairing before giving up on renames for the run
+SYNC_SHARDS = 1  # Worker processes one job's sync is split across (1 = no sharding; needs the SQLite manifest)
+SHARD_BY = "dirs"  # How top-level entries are split between shards: "dirs" (dealt out in sorted order) or "hash" (stable hash of the name)
+STATE_BACKEND = "sqlite"  # "sqlite" (incremental manifest) or "json" (legacy full rewrite)
+STATE_CHECKPOINT_ENTRIES = 2000  # Changed manifest entries buffered before a checkpoint commit
+STATE_CHECKPOINT_SECONDS = 30  # Maximum time between checkpoints during a long run
+DIR_CACHE_ENABLED = True  # Reuse recorded listings of directories whose mtime/size are unchanged
+DIR_CACHE_FULL_RESCAN_EVERY = 24  # Runs between forced full rescans (catches in-place edits, which leave directory mtimes alone)
+DIR_CACHE_RACY_SECONDS = 2  # Directories modified this close to the scan are always re-listed (FAT has 2 s mtimes)
+MTIME_PROBE = True  # Measure each side's timestamp resolution once per job and compare mtimes to the coarser one (FAT 2 s, exFAT 10 ms, SMB 1 s)
+MTIME_RESOLUTIONS_NS = (2_000_000_000, 1_000_000_000, 10_000_000, 1_000_000, 1_000, 100, 1)  # Resolutions the probe can report, coarsest first
+CONTENT_COMPARE = False  # Hash same-size files whose mtimes differ and skip the copy if the content matches
+HASH_WORKERS = 4  # Threads hashing files for CONTENT_COMPARE
+HASH_CHUNK_SIZE = 1024 * 1024  # Bytes read per hashing step
+CONTENT_COMPARE_BATCH = 1000  # Streaming diff: touched files held back and hashed together
+HASH_CACHE_RETENTION_DAYS = 30  # Cached digests not used for this long are dropped
+DELTA_THRESHOLD = 256 * 1024 * 1024  # Files at least this large are updated block-by-block in place (0 = off)
+DELTA_BLOCK_SIZE = 1024 * 1024  # Bytes per compared block
+DELTA_MIN_OVERLAP = 0.5  # Existing destination must be at least this fraction of the source size
+DELTA_GIVE_UP_RATIO = 0.5  # Stop comparing (plain rewrite) once this fraction of blocks has differed
+RESUMABLE_THRESHOLD = 256 * 1024 * 1024  # Full copies at least this large go through a temp file + progress journal (0 = off)
+RESUME_SYNC_BLOCKS = 64  # Blocks written between fsync + journal checkpoints
+RESUME_JOURNAL_DAYS = 7  # Abandoned partial copies older than this are cleaned up
+PARTIAL_SUFFIX = ".vaultmirror-partial.tmp"  # Temp file suffix; never picked up by the scanner
+COPY_DIGESTS = ("sha256",)  # Digests computed while each file is copied and kept in the manifest: "sha256" and/or "md5" (empty = off)
+VERIFY_COPIES = False  # Re-read every copied file from the destination and check it against the digest taken while copying
+COPY_BACKEND = "auto"  # "auto" (measured per pair of drives), "kernel", "mmap", "threaded" or "copy2"
+COPY_BACKEND_MIN_SIZE = 4 * 1024 * 1024  # Smaller files always go through shutil.copy2
+COPY_BUFFER_SIZE = 8 * 1024 * 1024  # Bytes per read/write in the mmap and threaded backends
+COPY_READ_AHEAD = 4  # Threaded backend: buffers the reader may fill ahead of the writer
+SPARSE_COPIES = True  # Copy only the data of sparse files (disk images, VM disks) and leave their holes as holes
+SPARSE_MIN_SIZE = 4 * 1024 * 1024  # Smaller files are copied whole and their allocated size is not recorded
+PREALLOCATE_MIN_SIZE = 64 * 1024 * 1024  # Dense copies at least this large get their full size allocated up front (0 = off)
+COPY_CALIBRATION_MAX_BYTES = 64 * 1024 * 1024  # A new pair of drives is measured on its first copy up to this size
+COPY_CALIBRATION_DAYS = 30  # Measured choices are redone after this long
+COPY_CALIBRATION_FILE = "copy-backends.json"  # Per-drive-pair choices, kept beside the manifests
+FANOUT_WAIT_SECONDS = 120  # Fan-out jobs: how long destinations that finished their diff wait for the rest before copying
+FANOUT_STALL_SECONDS = 30  # Fan-out jobs: a destination this far behind the shared read of a file is cut loose (retried next run)
+BANDWIDTH_MB_PER_S = 0  # Cap on all copies in this process together, in MB/s (0 = none); a job's "bandwidth_mb_per_s" caps it alone
+BANDWIDTH_PROFILES = []  # Time-of-day caps overriding BANDWIDTH_MB_PER_S, e.g. [("08:00", "18:00", 20), ("18:00", "08:00", 0)]; first match wins
+BANDWIDTH_BURST_SECONDS = 0.5  # Copies may run this many seconds' worth of the cap ahead before being paced
+BANDWIDTH_ADAPTIVE = False  # Back off while source reads are much slower than usual (someone else is using the disk); per job: "bandwidth_adaptive"
+BANDWIDTH_LATENCY_FACTOR = 3  # Adaptive: reads this many times slower than their usual speed halve the rate
+BANDWIDTH_MIN_MB_PER_S = 1  # Adaptive: the rate is never backed off below this
+BANDWIDTH_ADAPT_SECONDS = 1.0  # Adaptive: how often the rate is reconsidered
+PLAN_ORDER = "scan"  # Order copies are started in: "scan" (as found), "smallest" (most files done early) or "largest" (keeps throughput high)
+THROUGHPUT_MIN_SAMPLE_BYTES = 16 * 1024 * 1024  # Runs copying less than this don't update the measured throughput
+DETECT_RENAMES = True  # Replay renames/moves as renames on the other side instead of safe-delete + copy
+DELETION_GRACE_PERIOD_DAYS = 30  # Files in deleted folder older than this will be purged
+DELETED_INDEX_NAME = "deleted-index.db"  # Per-case index of safe-deleted files, kept in the deleted folder
+WATCH_DEBOUNCE_SECONDS = 2.0  # --watch: quiet period before a batch of changed paths is synced
+WATCH_MAX_DELAY_SECONDS = 30  # --watch: sync a batch after this long even if events keep arriving
+WATCH_RECONCILE_SECONDS = 3600  # --watch: full sync() pass at this interval
+WATCH_POLL_SECONDS = 15  # --watch: rescan interval where inotify is unavailable
+METRICS_ENABLED = True  # Append a JSON line per run to <metrics_dir>/<case>.jsonl
+METRICS_MAX_BYTES = 5 * 1024 * 1024  # Metrics file is rotated to .jsonl.1 beyond this size
+METRICS_MAX_FAILURES = 100  # Per-file failures (with reasons) listed in a run's record
+PROMETHEUS_TEXTFILE_DIR = ""  # If set (e.g. node_exporter's textfile directory), write vaultmirror_<case>.prom there each run
+RUNNER_JOBS = 4  # Multi-job runner: jobs synced at the same time
+RUNNER_COPY_WORKERS = 16  # Multi-job runner: copy/safe-delete threads shared by all running jobs
+RUNNER_LARGE_COPY_WORKERS = 4  # Multi-job runner: shared threads for files above LARGE_FILE_THRESHOLD
+DEVICE_JOB_SLOTS = 1  # Multi-job runner: jobs allowed on one drive at once (1 = jobs sharing a drive take turns)
+DEVICE_JOB_SLOTS_OVERRIDES = {}  # Per-drive exceptions, e.g. {"D:\\": 3} for an SSD that copes with parallel jobs
+
+class Job:
+    """One sync job, as described by the JSON config VaultMirror.py writes for its scheduled task"""
+
+    def __init__(self, config):
+        self.case_name = config['case_name']
+        self.source_path = Path(config['source_path'])
+        self.dest_path = Path(config['dest_path'])
+        self.bidirectional = bool(config.get('bidirectional'))
+        self.state_file = Path(config['state_file'])
+        self.lock_file = Path(config['lock_file'])
+        self.deleted_root = Path(config['deleted_root'])
+        # IMPORTANT: Exclude our own deleted folder from sync
+        self.exclusion_paths = [self.deleted_root]
+        self.exclusions = ExclusionRules(config.get('exclude', ()), self.exclusion_paths,
+                                         (self.source_path, self.dest_path))
+        self.journal_dir = self.state_file.parent / "partial" / self.case_name
+        self.metrics_dir = Path(config.get('metrics_dir') or self.state_file.parent.parent / "metrics")
+        # Per-job bandwidth cap (MB/s), time-of-day profiles and adaptive backoff; see job_throttle()
+        self.bandwidth_mb_per_s = config.get('bandwidth_mb_per_s', 0)
+        self.bandwidth_profiles = config.get('bandwidth_profiles', ())
+        self.bandwidth_adaptive = config.get('bandwidth_adaptive')
+        # Seconds two mtimes may differ by and still be the same timestamp; set per run by detect_mtime_tolerance()
+        self.mtime_tolerance = 0.0
+
+    @classmethod
+    def load(cls, config_path):
+        with open(config_path, 'r', encoding='utf-8') as f:
+            return cls(json.load(f))
+
+class FanoutJob:
+    """One source mirrored one-way to several destinations, from a config with a "destinations" list.
+
+    Each destination is a Job of its own (manifest, lock, deleted folder, metrics), built from the
+    config's shared fields and its entry in the list; sync_fanout() runs them together.
+    """
+
+    def __init__(self, config):
+        self.case_name = config['case_name']
+        self.source_path = Path(config['source_path'])
+        self.jobs = [Job({**config, 'case_name': f"{self.case_name}_{i + 1}", **dest, 'bidirectional': False})
+                     for i, dest in enumerate(config['destinations'])]
+        # The source is scanned once for all destinations, so it skips every one's deleted folder
+        self.exclusions = ExclusionRules(config.get('exclude', ()), [job.deleted_root for job in self.jobs],
+                                         (self.source_path,))
+
+    @property
+    def dest_paths(self):
+        return [job.dest_path for job in self.jobs]
+
+def load_job(config_path):
+    """Job or FanoutJob for a job config"""
+    with open(config_path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    return FanoutJob(config) if config.get('destinations') else Job(config)
+
+def is_drive_accessible(path):
+    """Check if a drive/path is actually accessible"""
+    try:
+        # Try to list one item to test accessibility
+        p = Path(path)
+        if not p.exists():
+            # Path doesn't exist - might be disconnected drive
+            return False
+        # Try to read from the path
+        next(p.iterdir(), None)
+        return True
+    except OSError:
+        return False
+
+# An odd second with nanoseconds set, so each resolution rounds or truncates it differently
+_MTIME_PROBE_NS = 1_600_000_001_123_456_789
+
+def probe_mtime_resolution(root):
+    """Timestamp resolution in ns of the filesystem holding root, or None if a probe file can't be written there"""
+    probe = os.path.join(root, f".vaultmirror-mtime-{os.getpid()}{PARTIAL_SUFFIX}")
+    try:
+        with open(probe, 'wb'):
+            pass
+        os.utime(probe, ns=(_MTIME_PROBE_NS, _MTIME_PROBE_NS))
+        got = os.stat(probe).st_mtime_ns
+    except OSError:
+        return None
+    finally:
+        try:
+            os.unlink(probe)
+        except OSError:
+            pass
+    for ns in MTIME_RESOLUTIONS_NS:
+        if got % ns == 0 and abs(got - _MTIME_PROBE_NS) < ns:
+            return ns
+    return 1
+
+# Timestamp resolution (ns) by filesystem type, for sides that must not be written to
+_FS_MTIME_RESOLUTIONS = {
+    'fat': 2_000_000_000, 'fat12': 2_000_000_000, 'fat16': 2_000_000_000, 'fat32': 2_000_000_000,
+    'vfat': 2_000_000_000, 'msdos': 2_000_000_000, 'hfs': 1_000_000_000, 'exfat': 10_000_000,
+    'ntfs': 100, 'ntfs3': 100, 'refs': 100, 'ext2': 1, 'ext3': 1, 'ext4': 1, 'xfs': 1, 'btrfs': 1,
+    'zfs': 1, 'f2fs': 1, 'tmpfs': 1, 'overlay': 1, 'apfs': 1,
+}
+
+def filesystem_type(path):
+    """Lower-case name of the filesystem holding path (GetVolumeInformationW, or /proc/self/mounts), or None"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+            volume = ctypes.create_unicode_buffer(261)
+            name = ctypes.create_unicode_buffer(261)
+            if not ctypes.windll.kernel32.GetVolumePathNameW(str(path), volume, 261):
+                return None
+            if not ctypes.windll.kernel32.GetVolumeInformationW(volume.value, None, 0, None, None, None, name, 261):
+                return None
+            return name.value.lower()
+        real = os.path.realpath(path)
+        best, fstype = None, None
+        with open('/proc/self/mounts', 'r') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                # Spaces and the like in mount points are written as octal escapes
+                mount = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                if real == mount or real.startswith(mount.rstrip('/') + '/'):
+                    if best is None or len(mount) >= len(best):
+                        best, fstype = mount, fields[2].lower()
+        return fstype
+    except (OSError, AttributeError):
+        return None
+
+def mtime_resolution(store, side, root, probe=True, writable=True):
+    """Timestamp resolution (ns) of one side, or None if unknown.
+
+    Only a side the job writes to is probed; the result is cached in the manifest and probed
+    again when the root changes. A read-only side (the source of a one-way job) is never written
+    to: it goes by its filesystem type, and counts as the coarsest resolution if that is unknown.
+    """
+    if writable:
+        key = f"mtime_resolution_{side}"
+        cached = store.get_meta(key)
+        if cached:
+            ns, _, cached_root = cached.partition(' ')
+            if cached_root == str(root):
+                return int(ns)
+        if probe:
+            ns = probe_mtime_resolution(root)
+            if ns is not None:
+                store.put_meta(key, f"{ns} {root}")
+                return ns
+    ns = _FS_MTIME_RESOLUTIONS.get(filesystem_type(root))
+    if ns is None and not writable:
+        ns = MTIME_RESOLUTIONS_NS[0]
+    return ns
+
+def detect_mtime_tolerance(job, store, a_accessible, b_accessible, probe=True):
+    """Set job.mtime_tolerance to the coarser of the two sides' timestamp resolutions.
+
+    A copy onto FAT or an SMB share gets its mtime rounded, so without this the two copies of an
+    unchanged file look different and get rewritten every run. A destination that can't be probed
+    or identified counts as exact; the source of a one-way job is never probed (see mtime_resolution()).
+    """
+    resolutions = [0]
+    if MTIME_PROBE:
+        for side, root, accessible in (('a', job.source_path, a_accessible), ('b', job.dest_path, b_accessible)):
+            ns = mtime_resolution(store, side, root, probe and accessible, side == 'b' or job.bidirectional)
+            if ns:
+                resolutions.append(ns)
+    job.mtime_tolerance = max(resolutions) / 1e9
+    return job.mtime_tolerance
+
+def mtime_newer(meta, other, tolerance=0.0):
+    """True when meta is a newer version than other: later by more than tolerance, or within it but a different size"""
+    delta = meta['mtime'] - other['mtime']
+    if abs(delta) <= tolerance:
+        return meta['size'] != other['size']
+    return delta > 0
+
+def mtime_moved(meta, other, tolerance=0.0):
+    """True when the two mtimes differ by more than tolerance"""
+    return abs(meta['mtime'] - other['mtime']) > tolerance
+
+def _glob_segment(segment):
+    """Regex for one path component of a glob: * and ? stay within the component"""
+    not_sep = "[^" + re.escape(os.sep) + "]"
+    out, i = [], 0
+    while i < len(segment):
+        c = segment[i]
+        i += 1
+        if c == "*":
+            out.append(not_sep + "*")
+        elif c == "?":
+            out.append(not_sep)
+        elif c == "\\" and i < len(segment):
+            out.append(re.escape(segment[i]))
+            i += 1
+        elif c == "[":
+            # A class runs to the next "]" ("]" first in it is literal); unclosed, "[" is literal
+            start = i + 1 if segment[i:i + 1] == "!" else i
+            end = segment.find("]", start + 1 if segment[start:start + 1] == "]" else start)
+            if end < 0:
+                out.append(re.escape(c))
+                continue
+            body = "".join(ch if ch == "-" else re.escape(ch) for ch in segment[start:end])
+            out.append("[" + ("^" if start > i else "") + body + "]")
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out)
+
+def _glob_regex(pattern):
+    """Regex source for a slash-separated glob matched against a whole relative path; ** spans components"""
+    sep = re.escape(os.sep)
+    segments = pattern.split("/")
+    out = []
+    for i, segment in enumerate(segments):
+        last = i == len(segments) - 1
+        if segment == "**":
+            out.append(".+" if last else "(?:.*" + sep + ")?")
+        else:
+            out.append(_glob_segment(segment) + ("" if last else sep))
+    return "".join(out)
+
+class ExclusionRules:
+    """gitignore-style exclusion rules, compiled once per job and matched against relative paths.
+
+    A pattern without a slash matches a name at any depth; one with a slash (other than a trailing
+    one) is anchored to the sync root. A trailing slash matches directories only. "*" and "?" stay
+    within a name, "**" spans directories, and a leading "!" re-includes what an earlier rule
+    excluded (the last matching rule wins). Excluded directories are pruned, so nothing below them
+    can be re-included. Matching ignores case, as Windows does. excluded_dirs (our deleted folder)
+    are always excluded, at their relative path under any of roots.
+    """
+
+    def __init__(self, patterns=(), excluded_dirs=(), roots=()):
+        self.patterns = list(EXCLUSIONS) + list(patterns)
+        self.dirs = set()
+        for excluded in excluded_dirs:
+            for root in roots:
+                try:
+                    rel = os.path.relpath(os.path.abspath(excluded), os.path.abspath(root))
+                except ValueError:
+                    continue  # Another drive
+                if rel != os.curdir and rel != os.pardir and not rel.startswith(os.pardir + os.sep):
+                    self.dirs.add(os.path.normcase(rel))
+        rules = []  # (kind, text, negate, dir_only); kind: "name", "suffix", "name_re" or "path_re"
+        for line in self.patterns:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if os.sep == "\\":
+                line = line.replace("\\", "/")  # Windows paths; names cannot hold a backslash there
+            negate = line.startswith("!")
+            line = line[1:] if negate else line
+            dir_only = line.endswith("/")
+            anchored = "/" in line.rstrip("/")
+            line = line.strip("/")
+            if not line:
+                continue
+            if anchored:
+                rules.append(("path_re", _glob_regex(line), negate, dir_only))
+            elif not any(c in line for c in "*?[\\"):
+                rules.append(("name", line.lower(), negate, dir_only))
+            elif line.startswith("*") and not any(c in line[1:] for c in "*?[\\"):
+                rules.append(("suffix", line[1:].lower(), negate, dir_only))
+            else:
+                rules.append(("name_re", _glob_segment(line), negate, dir_only))
+        self._files = self._compile([r for r in rules if not r[3]])
+        self._dirs = self._compile(rules)
+        self.key = hashlib.sha256(json.dumps([self.patterns, sorted(self.dirs)]).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def _compile(rules):
+        # Neighbouring rules that agree on negation are folded together: plain names into a set,
+        # "*.ext" into one endswith() and the rest into one alternation per kind, so a rule list
+        # without "!" costs a few lookups per entry whatever its length
+        groups = []
+        for kind, text, negate, _ in rules:
+            if not groups or groups[-1][1] != negate:
+                groups.append(({"name": [], "suffix": [], "name_re": [], "path_re": []}, negate))
+            groups[-1][0][kind].append(text)
+        flags = re.IGNORECASE | re.DOTALL
+        return [(frozenset(kinds["name"]), tuple(kinds["suffix"]),
+                 re.compile("(?:" + "|".join(kinds["name_re"]) + r")\Z", flags) if kinds["name_re"] else None,
+                 re.compile("(?:" + "|".join(kinds["path_re"]) + r")\Z", flags) if kinds["path_re"] else None,
+                 negate) for kinds, negate in reversed(groups)]
+
+    @staticmethod
+    def _match(groups, rel, name):
+        lowered = name.lower()
+        for names, suffixes, name_re, path_re, negate in groups:
+            if (lowered in names or (suffixes and lowered.endswith(suffixes)) or
+                    (name_re is not None and name_re.match(name)) or (path_re is not None and path_re.match(rel))):
+                return not negate
+        return False
+
+    def excludes_file(self, rel, name):
+        """Whether a file (rel path, and its name) is excluded, its directories aside"""
+        return name.endswith(PARTIAL_SUFFIX) or self._match(self._files, rel, name)
+
+    def excludes_dir(self, rel, name):
+        """Whether a directory (rel path without the trailing separator) is excluded, its parents aside"""
+        return (bool(self.dirs) and os.path.normcase(rel) in self.dirs) or self._match(self._dirs, rel, name)
+
+    def excludes_path(self, rel, is_dir=False):
+        """Whether rel or any directory above it is excluded (for paths not reached by a walk)"""
+        parts = rel.split(os.sep)
+        for i in range(1, len(parts)):
+            if self.excludes_dir(os.sep.join(parts[:i]), parts[i - 1]):
+                return True
+        return self.excludes_dir(rel, parts[-1]) if is_dir else self.excludes_file(rel, parts[-1])
+
+_FILE_ATTRIBUTE_SPARSE_FILE = 0x200
+_FILE_ATTRIBUTE_COMPRESSED = 0x800
+
+def allocated_size(path, st):
+    """Bytes a file takes on disk, or None when the OS cannot say cheaply (taken to be its size)"""
+    if hasattr(st, 'st_blocks'):
+        return st.st_blocks * 512
+    # Windows: only sparse and compressed files take less than their size, and the attributes say which
+    if getattr(st, 'st_file_attributes', 0) & (_FILE_ATTRIBUTE_SPARSE_FILE | _FILE_ATTRIBUTE_COMPRESSED):
+        import ctypes
+        from ctypes import wintypes
+        high = wintypes.DWORD()
+        low = ctypes.windll.kernel32.GetCompressedFileSizeW(str(path), ctypes.byref(high)) & 0xFFFFFFFF
+        if low != 0xFFFFFFFF or not ctypes.GetLastError():
+            return (high.value << 32) + low
+    return None
+
+def file_meta(mtime, size, alloc=None):
+    """A file's entry; 'alloc' (bytes on disk) is kept only for files that take less than their size"""
+    meta = {'mtime': mtime, 'size': size}
+    if alloc is not None and alloc < size:
+        meta['alloc'] = alloc
+    return meta
+
+def allocated(meta):
+    """Bytes a file described by meta takes on disk (free-space planning)"""
+    return meta.get('alloc', meta['size'])
+
+def _scan_dir(dir_path, rel_prefix, exclusions):
+    """List one directory with os.scandir, returning its files and subdirectories to walk"""
+    files = {}
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        rel = rel_prefix + entry.name
+                        # Prune excluded directories (e.g. our deleted folder) without descending
+                        if exclusions.excludes_dir(rel, entry.name):
+                            continue
+                        subdirs.append((entry.path, rel + os.sep))
+                    elif entry.is_file():
+                        rel = rel_prefix + entry.name
+                        if exclusions.excludes_file(rel, entry.name):
+                            continue
+                        # DirEntry caches the stat result (free on Windows), so one call serves every field
+                        st = entry.stat()
+                        if st.st_size >= SPARSE_MIN_SIZE:
+                            files[rel] = file_meta(st.st_mtime, st.st_size, allocated_size(entry.path, st))
+                        else:
+                            files[rel] = {'mtime': st.st_mtime, 'size': st.st_size}
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    return files, subdirs
+
+class DirCache:
+    """Directory listings recorded for one side, keyed by relative directory prefix ("" is the root)"""
+
+    def __init__(self, entries=None, full=False):
+        self.entries = entries or {}  # rel_dir -> (mtime, size, {name: [mtime, size]}, [subdir names])
+        self.full = full
+        self.updates = {}  # rel_dir -> new listing, or None to drop the recorded one
+        self.seen = set()
+        self.hits = 0
+        self.racy_cutoff = time.time() - DIR_CACHE_RACY_SECONDS
+
+    def get(self, rel_prefix):
+        return self.entries.get(rel_prefix)
+
+    def visit(self, rel_prefix, hit, record):
+        """Note a directory the walk reached: a cache hit, or its fresh listing (None = don't keep one)"""
+        self.seen.add(rel_prefix)
+        if hit:
+            self.hits += 1
+        else:
+            self.updates[rel_prefix] = record
+
+class StreamingDirCache:
+    """DirCache for the streaming diff: listings are looked up and written through the store as
+    the walk goes, so memory does not grow with the number of directories.
+
+    The walk visits directories in sorted order, so stored listings of directories that no
+    longer exist are found by stepping through the stored ones alongside it. With save=False
+    (dry run) nothing is written.
+    """
+
+    def __init__(self, store, side, full=False, save=True):
+        self.store = store
+        self.side = side
+        self.full = full
+        self.save = save
+        self.hits = 0
+        self.racy_cutoff = time.time() - DIR_CACHE_RACY_SECONDS
+        self._updates = []
+        self._drops = []
+        self._lock = threading.Lock()
+        self._reader = store.reader()
+        if full:
+            if save:
+                store.clear_dir_listings(side)
+            self._stored = iter(())
+        else:
+            self._stored = iter(store.dir_rels(self._reader, side))
+        self._next_stored = self._advance()
+
+    def _advance(self):
+        with self._lock:
+            row = next(self._stored, None)
+        return row[0] if row else None
+
+    def get(self, rel_prefix):
+        if self.full:
+            return None
+        with self._lock:
+            row = self._reader.execute("SELECT mtime, size, entries FROM dirs WHERE side = ? AND rel = ?",
+                                       (self.side, rel_prefix)).fetchone()
+        if row is None:
+            return None
+        listing = json.loads(row[2])
+        return (row[0], row[1], listing['f'], listing['d'])
+
+    def visit(self, rel_prefix, hit, record):
+        # Stored listings that sort before this directory were not reached: the directory is gone
+        while self._next_stored is not None and self._next_stored < rel_prefix:
+            self._drops.append(self._next_stored)
+            self._next_stored = self._advance()
+        if self._next_stored == rel_prefix:
+            self._next_stored = self._advance()
+        if hit:
+            self.hits += 1
+        elif record is None:
+            self._drops.append(rel_prefix)
+        else:
+            self._updates.append((rel_prefix, record))
+        if len(self._updates) + len(self._drops) >= STATE_CHECKPOINT_ENTRIES:
+            self.flush()
+
+    def flush(self):
+        updates, self._updates = self._updates, []
+        drops, self._drops = self._drops, []
+        if self.save:
+            self.store.put_dir_listings(self.side, updates, drops)
+
+    def finish(self, invalidated=()):
+        """Write what is left; directories the sync wrote into lose their listing"""
+        while self._next_stored is not None:
+            self._drops.append(self._next_stored)
+            self._next_stored = self._advance()
+        self._drops.extend(invalidated)
+        self.flush()
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._reader.close()
+
+def _list_dir(dir_path, rel_prefix, exclusions, dir_cache):
+    """List one directory, reusing its recorded listing when its own mtime and size are unchanged"""
+    st = None
+    if dir_cache is not None:
+        try:
+            st = os.stat(dir_path)
+        except OSError:
+            pass
+        cached = dir_cache.get(rel_prefix)
+        if st is not None and cached and cached[0] == st.st_mtime and cached[1] == st.st_size:
+            files = {rel_prefix + name: {'mtime': listed[0], 'size': listed[1]} if len(listed) == 2 else file_meta(*listed)
+                     for name, listed in cached[2].items()}
+            subdirs = [(os.path.join(dir_path, name), rel_prefix + name + os.sep) for name in cached[3]]
+            return rel_prefix, files, subdirs, True, None
+
+    files, subdirs = _scan_dir(dir_path, rel_prefix, exclusions)
+    record = None
+    if st is not None and st.st_mtime < dir_cache.racy_cutoff:
+        n = len(rel_prefix)
+        record = (st.st_mtime, st.st_size,
+                  {rel[n:]: [meta['mtime'], meta['size'], meta['alloc']] if 'alloc' in meta else [meta['mtime'], meta['size']]
+                   for rel, meta in files.items()},
+                  [sub_prefix[n:-len(os.sep)] for _, sub_prefix in subdirs])
+    return rel_prefix, files, subdirs, False, record
+
+def get_tree_state(path, exclusions=None, workers=SCAN_WORKERS, dir_cache=None):
+    """Get current state of files in path, skipping what exclusions (an ExclusionRules) rule out.
+
+    With a DirCache, directories whose mtime/size match the last run are not re-listed and
+    their recorded files are reused; new listings are collected in dir_cache.updates.
+    """
+    root = os.path.abspath(path)
+    state = {}
+    if not os.path.isdir(root):
+        return state
+
+    exclusions = exclusions or ExclusionRules()
+
+    def merge(result):
+        rel_prefix, files, subdirs, hit, record = result
+        state.update(files)
+        if dir_cache is not None:
+            dir_cache.visit(rel_prefix, hit, record)
+        return subdirs
+
+    if workers <= 1:
+        stack = [(root, "")]
+        while stack:
+            dir_path, rel_prefix = stack.pop()
+            stack.extend(merge(_list_dir(dir_path, rel_prefix, exclusions, dir_cache)))
+        return state
+
+    # Parallel walk: every directory listing is its own task, results merged on this thread
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_list_dir, root, "", exclusions, dir_cache)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                for dir_path, rel_prefix in merge(fut.result()):
+                    pending.add(pool.submit(_list_dir, dir_path, rel_prefix, exclusions, dir_cache))
+    return state
+
+def iter_tree(path, exclusions=None, workers=SCAN_WORKERS, dir_cache=None, top_level=None):
+    """Yield (rel, meta) for the files under path in sorted rel order (the walk of get_tree_state).
+
+    Only the listings of the directories on the current path are held. At each level the listings
+    of the next few subdirectories are fetched ahead on a thread pool; dir_cache.visit() is called
+    on this thread, in sorted order. top_level, if given, limits the walk to those root entries.
+    """
+    root = os.path.abspath(path)
+    if not os.path.isdir(root):
+        return
+
+    exclusions = exclusions or ExclusionRules()
+    pool = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+
+    def fetch(dir_path, rel_prefix):
+        # A callable returning the listing: fetched now on the pool, or later on this thread
+        if pool is None:
+            return partial(_list_dir, dir_path, rel_prefix, exclusions, dir_cache)
+        return pool.submit(_list_dir, dir_path, rel_prefix, exclusions, dir_cache).result
+
+    def enter(result):
+        rel_prefix, files, subdirs, hit, record = result
+        if dir_cache is not None:
+            dir_cache.visit(rel_prefix, hit, record)
+        if top_level is not None and not rel_prefix:
+            files = {rel: meta for rel, meta in files.items() if rel in top_level}
+            subdirs = [sub for sub in subdirs if sub[1][:-len(os.sep)] in top_level]
+        # A subdirectory sorts by its prefix (name + separator), which places all of its files
+        # exactly where they fall among this directory's own files
+        subdirs.sort(key=lambda sub: sub[1])
+        entries = sorted(list(files.items()) + [(sub_prefix, None) for _, sub_prefix in subdirs],
+                         key=lambda entry: entry[0])
+        pending = iter(subdirs)
+        fetched = deque(fetch(*sub) for sub in islice(pending, max(1, workers)))
+        return iter(entries), pending, fetched
+
+    try:
+        stack = [enter(fetch(root, "")())]
+        while stack:
+            entries, pending, fetched = stack[-1]
+            for rel, meta in entries:
+                if meta is not None:
+                    yield rel, meta
+                    continue
+                listing = fetched.popleft()
+                sub = next(pending, None)
+                if sub is not None:
+                    fetched.append(fetch(*sub))
+                stack.append(enter(listing()))
+                break
+            else:
+                stack.pop()
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+_DELETE_LOCK = threading.Lock()
+_DELETED_INDEXES = {}
+
+class DeletedIndex:
+    """SQLite index of the files moved into a deleted folder, ordered by deletion time"""
+
+    def __init__(self, deleted_root):
+        deleted_root.mkdir(parents=True, exist_ok=True)
+        self.deleted_root = deleted_root
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(deleted_root / DELETED_INDEX_NAME), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS deleted ("
+            "stored_path TEXT PRIMARY KEY, original_path TEXT, original_rel_path TEXT, deleted_at TEXT, "
+            "deleted_ts REAL NOT NULL, sync_id TEXT, direction TEXT, original_size INTEGER)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS deleted_by_time ON deleted (deleted_ts)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.commit()
+        if not self.conn.execute("SELECT 1 FROM info WHERE key = 'sidecars_imported'").fetchone():
+            self._import_sidecars()
+
+    def _import_sidecars(self):
+        """One-time import of deletions recorded only as .meta.json sidecars"""
+        rows = []
+        for meta_file in self.deleted_root.rglob("*.meta.json"):
+            try:
+                with open(meta_file, 'r') as f:
+                    meta = json.load(f)
+                rows.append((str(meta_file)[:-len(".meta.json")], meta, meta_file.stat().st_mtime))
+            except:
+                continue
+        with self._lock, self.conn:
+            for stored_path, meta, ts in rows:
+                self._insert(stored_path, meta, ts)
+            self.conn.execute("INSERT OR REPLACE INTO info (key, value) VALUES ('sidecars_imported', '1')")
+        if rows:
+            print(f"Indexed {len(rows)} existing deleted file(s) in {self.deleted_root}")
+
+    def _insert(self, stored_path, meta, ts):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO deleted (stored_path, original_path, original_rel_path, deleted_at, "
+            "deleted_ts, sync_id, direction, original_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (stored_path, meta.get('original_path'), meta.get('original_rel_path'), meta.get('deleted_at'),
+             ts, meta.get('sync_id'), meta.get('direction'), meta.get('original_size', 0))
+        )
+
+    def add(self, stored_path, meta, ts):
+        with self._lock, self.conn:
+            self._insert(str(stored_path), meta, ts)
+
+    def purge(self, cutoff_time):
+        """Unlink every entry deleted before cutoff_time (range query on the time index); returns the count purged.
+
+        An entry whose file or sidecar can't be removed keeps its row, so the next purge retries it.
+        """
+        with self._lock:
+            stored = [row[0] for row in self.conn.execute(
+                "SELECT stored_path FROM deleted WHERE deleted_ts < ?", (cutoff_time,))]
+        if not stored:
+            return 0
+        purged = []
+        parents = set()
+        for stored_path in stored:
+            try:
+                for p in (stored_path, stored_path + ".meta.json"):
+                    try:
+                        os.unlink(p)
+                    except FileNotFoundError:
+                        pass
+            except OSError as e:
+                print(f"Could not purge {stored_path}: {e}")
+                continue
+            purged.append(stored_path)
+            parents.add(os.path.dirname(stored_path))
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM deleted WHERE stored_path = ?", ((p,) for p in purged))
+        # Remove day folders that are now empty
+        for parent in parents:
+            try:
+                os.rmdir(parent)
+            except OSError:
+                pass
+        return len(purged)
+
+def deleted_index(deleted_root):
+    """Shared DeletedIndex for a deleted folder (safe_delete runs on several threads)"""
+    key = os.path.normcase(os.path.abspath(deleted_root))
+    with _DELETE_LOCK:
+        if key not in _DELETED_INDEXES:
+            _DELETED_INDEXES[key] = DeletedIndex(deleted_root)
+        return _DELETED_INDEXES[key]
+
+def safe_delete(file_path, job, direction, failures=None):
+    """Move file to deleted folder instead of permanent deletion (failures: list collecting the reason on error)"""
+    deleted_root, sync_id = job.deleted_root, job.case_name
+    try:
+        # Create deleted folder if it doesn't exist
+        deleted_root.mkdir(parents=True, exist_ok=True)
+        # Open the index before any sidecar is written, so its one-time import can't pick ours up
+        index = deleted_index(deleted_root)
+        
+        # Create unique deletion timestamp
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        # Get relative path for organization
+        try:
+            # Try to get relative path from source/dest root
+            if "A_to_B" in direction:
+                root_path = job.source_path
+            elif "B_to_A" in direction:
+                root_path = job.dest_path
+            else:
+                root_path = file_path.parents[-1]
+            
+            try:
+                rel_path = str(file_path.relative_to(root_path))
+            except:
+                rel_path = file_path.name
+        except:
+            rel_path = file_path.name
+        
+        # Create safe filename for storage
+        safe_name = rel_path.replace(os.sep, "_").replace("..", "parent")
+        if len(safe_name) > 200:
+            safe_name = safe_name[:100] + "..." + safe_name[-100:]
+        
+        # Create organized deletion folder structure
+        deleted_dir = deleted_root / direction / timestamp[:8]  # YYYYMMDD
+        deleted_dir.mkdir(parents=True, exist_ok=True)
+        
+        # Move file to deleted folder
+        dest_path = deleted_dir / f"{timestamp}_{safe_name}"
+        original_size = file_path.stat().st_size
+        
+        # If destination exists, add counter (locked: deletes run on the transfer workers)
+        with _DELETE_LOCK:
+            counter = 1
+            original_dest = dest_path
+            while dest_path.exists():
+                dest_path = original_dest.with_stem(f"{original_dest.stem}_{counter}")
+                counter += 1
+
+            shutil.move(str(file_path), str(dest_path))
+        
+        # Create metadata file
+        meta = {
+            'original_path': str(file_path),
+            'original_rel_path': rel_path,
+            'deleted_at': timestamp,
+            'sync_id': sync_id,
+            'direction': direction,
+            'original_size': original_size
+        }
+        
+        with open(f"{dest_path}.meta.json", 'w') as f:
+            json.dump(meta, f, indent=2)
+        index.add(dest_path, meta, time.time())
+            
+        return True
+    except Exception as e:
+        print(f"Safe delete failed for {file_path}: {e}")
+        if failures is not None:
+            failures.append(str(e))
+        return False
+
+def purge_old_deletions(deleted_root, days_old=DELETION_GRACE_PERIOD_DAYS):
+    """Purge files in deleted folder older than specified days"""
+    if not deleted_root.exists():
+        return 0
+        
+    cutoff_time = time.time() - (days_old * 24 * 60 * 60)
+    try:
+        return deleted_index(deleted_root).purge(cutoff_time)
+    except sqlite3.Error as e:
+        print(f"Deleted-files index unavailable: {e}")
+        return 0
+
+class JsonStateStore:
+    """Legacy manifest: the whole state is loaded and rewritten as one JSON file"""
+
+    def __init__(self, json_path):
+        self.json_path = Path(json_path)
+
+    def load(self, count_run=True):
+        if self.json_path.exists():
+            try:
+                with open(self.json_path, "r") as f:
+                    return json.load(f)
+            except:
+                pass
+        return {}
+
+    def stage(self, rel, meta, digests=None):
+        pass
+
+    def load_dir_cache(self, side, full=False):
+        return None
+
+    def get_signature(self, rel):
+        return None
+
+    def put_signature(self, rel, mtime, size, block_size, sigs):
+        pass
+
+    def get_meta(self, key):
+        return None
+
+    def put_meta(self, key, value):
+        pass
+
+    def save_dir_cache(self, side, dir_cache, invalidated=()):
+        pass
+
+    def finish(self, new_state):
+        with open(self.json_path, "w") as f:
+            json.dump(new_state, f, indent=2)
+
+    def commit_paths(self, removed, full_state):
+        self.finish(full_state)
+
+    def close(self):
+        pass
+
+# Digests are kept while mtime and size stay the same, replaced by new ones, else cleared
+_UPSERT_FILE_SQL = (
+    "INSERT INTO files (rel, mtime, size, sha256, md5, alloc) VALUES (:rel, :mtime, :size, :sha256, :md5, :alloc) "
+    "ON CONFLICT(rel) DO UPDATE SET "
+    "sha256 = CASE WHEN :new THEN excluded.sha256 "
+    "WHEN files.mtime = excluded.mtime AND files.size = excluded.size THEN files.sha256 END, "
+    "md5 = CASE WHEN :new THEN excluded.md5 "
+    "WHEN files.mtime = excluded.mtime AND files.size = excluded.size THEN files.md5 END, "
+    "mtime = excluded.mtime, size = excluded.size, alloc = excluded.alloc"
+)
+
+class SqliteStateStore:
+    """Incremental manifest: only changed entries are written, in batched transactions"""
+
+    def __init__(self, db_path, legacy_json=None):
+        self.db_path = Path(db_path)
+        self.legacy_json = Path(legacy_json) if legacy_json else None
+        self.last = {}
+        self._pending = {}
+        self._last_checkpoint = time.monotonic()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ("
+            "rel TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, sha256 TEXT, md5 TEXT, "
+            "alloc INTEGER) WITHOUT ROWID"
+        )
+        # Manifests from before digests (and allocated sizes; NULL = fully allocated) were recorded gain the columns in place
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        for column, kind in (('sha256', 'TEXT'), ('md5', 'TEXT'), ('alloc', 'INTEGER')):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE files ADD COLUMN {column} {kind}")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dirs ("
+            "side TEXT NOT NULL, rel TEXT NOT NULL, mtime REAL NOT NULL, size INTEGER NOT NULL, "
+            "entries TEXT NOT NULL, PRIMARY KEY (side, rel)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS blocks ("
+            "rel TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, "
+            "block_size INTEGER NOT NULL, sigs BLOB NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.commit()
+        self.run_number = 0
+
+    def _bump_run_number(self, save=True):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'runs'").fetchone()
+        runs = int(row[0]) + 1 if row else 1
+        if save:
+            with self.conn:
+                self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('runs', ?)", (str(runs),))
+        return runs
+
+    def _migrate_json(self):
+        """One-time import of an existing JSON manifest into an empty database"""
+        if not self.legacy_json or not self.legacy_json.exists():
+            return
+        if self.conn.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+            return
+        try:
+            with open(self.legacy_json, "r") as f:
+                legacy = json.load(f)
+        except:
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (rel, mtime, size) VALUES (?, ?, ?)",
+                ((rel, meta['mtime'], meta['size']) for rel, meta in legacy.items())
+            )
+        # Keep the old manifest for rollback, but never import it again
+        self.legacy_json.replace(self.legacy_json.with_name(self.legacy_json.name + ".migrated"))
+        print(f"Migrated {len(legacy)} manifest entries to {self.db_path}")
+
+    def load(self, count_run=True, entries=True):
+        self._migrate_json()
+        # A dry run looks at the manifest without counting as a run
+        self.run_number = self._bump_run_number(save=count_run)
+        if not entries:
+            # Streaming diff: the manifest is read in order through iter_sorted() instead
+            return None
+        self.last = {rel: file_meta(mtime, size, alloc)
+                     for rel, mtime, size, alloc in self.conn.execute("SELECT rel, mtime, size, alloc FROM files")}
+        return self.last
+
+    def count(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def reader(self):
+        """A second connection, so a long ordered read keeps one snapshot while this one writes"""
+        return sqlite3.connect(str(self.db_path), check_same_thread=False)
+
+    def top_level_names(self):
+        """First path component of every entry and recorded directory listing, found with an index seek or two per name"""
+        names = set()
+        with self._lock:
+            for table, where, params in (("files", "", ()), ("dirs", "side = ? AND ", ('a',)), ("dirs", "side = ? AND ", ('b',))):
+                query = f"SELECT rel FROM {table} WHERE {where}rel {{}} ? ORDER BY rel LIMIT 1"
+                row = self.conn.execute(query.format(">"), params + ("",)).fetchone()
+                while row:
+                    rel = row[0]
+                    name = rel.split(os.sep, 1)[0]
+                    names.add(name)
+                    if rel == name:
+                        row = self.conn.execute(query.format(">"), params + (name,)).fetchone()
+                    else:
+                        # Everything under name sorts before name followed by the character after the separator
+                        row = self.conn.execute(query.format(">="), params + (name + chr(ord(os.sep) + 1),)).fetchone()
+        return names
+
+    def iter_sorted(self):
+        """Manifest entries as (rel, meta) in rel order, as they stood when this was called"""
+        reader = self.reader()
+        rows = reader.execute("SELECT rel, mtime, size, alloc FROM files ORDER BY rel")
+
+        def entries():
+            try:
+                for rel, mtime, size, alloc in rows:
+                    yield rel, file_meta(mtime, size, alloc)
+            finally:
+                reader.close()
+        return entries()
+
+    def stage(self, rel, meta, digests=None):
+        """Buffer an entry if it differs from the stored one (or comes with new digests), checkpointing as the buffer fills"""
+        if digests is None and self.last.get(rel) == meta:
+            return
+        with self._lock:
+            self._pending[rel] = (meta, digests)
+            due = (len(self._pending) >= STATE_CHECKPOINT_ENTRIES or
+                   time.monotonic() - self._last_checkpoint >= STATE_CHECKPOINT_SECONDS)
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Commit buffered upserts so a crash mid-run keeps the work already done"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_checkpoint = time.monotonic()
+            if not pending:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    _UPSERT_FILE_SQL,
+                    ({'rel': rel, 'mtime': meta['mtime'], 'size': meta['size'], 'alloc': meta.get('alloc'),
+                      'new': digests is not None, 'sha256': (digests or {}).get('sha256'), 'md5': (digests or {}).get('md5')}
+                     for rel, (meta, digests) in pending.items())
+                )
+
+    def get_signature(self, rel):
+        """Block signature recorded for a file as (mtime, size, block_size, sigs), or None"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT mtime, size, block_size, sigs FROM blocks WHERE rel = ?", (rel,)).fetchone()
+
+    def put_signature(self, rel, mtime, size, block_size, sigs):
+        """Record the block signature of the content both sides now hold"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO blocks (rel, mtime, size, block_size, sigs) VALUES (?, ?, ?, ?, ?)",
+                (rel, mtime, size, block_size, sigs)
+            )
+
+    def get_meta(self, key):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_meta(self, key, value):
+        with self._lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def load_dir_cache(self, side, full=False):
+        """Recorded directory listings for one side, or an empty cache when a full rescan is due (or full)"""
+        if not DIR_CACHE_ENABLED:
+            return None
+        if full or (DIR_CACHE_FULL_RESCAN_EVERY and self.run_number % DIR_CACHE_FULL_RESCAN_EVERY == 0):
+            return DirCache(full=True)
+        entries = {}
+        for rel, mtime, size, listing in self.conn.execute(
+                "SELECT rel, mtime, size, entries FROM dirs WHERE side = ?", (side,)):
+            listing = json.loads(listing)
+            entries[rel] = (mtime, size, listing['f'], listing['d'])
+        return DirCache(entries)
+
+    def save_dir_cache(self, side, dir_cache, invalidated=()):
+        """Write changed directory listings; drop vanished ones and those the sync wrote into"""
+        if dir_cache is None:
+            return
+        if dir_cache.full:
+            drop = []
+        else:
+            drop = [rel for rel in dir_cache.entries if rel not in dir_cache.seen]
+        drop.extend(rel for rel, record in dir_cache.updates.items() if record is None)
+        drop.extend(invalidated)
+        rows = [(side, rel, record[0], record[1], json.dumps({'f': record[2], 'd': record[3]}))
+                for rel, record in dir_cache.updates.items()
+                if record is not None and rel not in invalidated]
+        with self._lock, self.conn:
+            if dir_cache.full:
+                self.conn.execute("DELETE FROM dirs WHERE side = ?", (side,))
+            self.conn.executemany("DELETE FROM dirs WHERE side = ? AND rel = ?", ((side, rel) for rel in drop))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dirs (side, rel, mtime, size, entries) VALUES (?, ?, ?, ?, ?)", rows
+            )
+
+    def dir_rels(self, conn, side):
+        """Rows of (rel,) for the recorded directory listings of one side, in rel order, read through conn"""
+        return conn.execute("SELECT rel FROM dirs WHERE side = ? ORDER BY rel", (side,))
+
+    def clear_dir_listings(self, side):
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM dirs WHERE side = ?", (side,))
+
+    def put_dir_listings(self, side, updates, drops):
+        """Write (rel, record) directory listings, then drop the listings of drops"""
+        rows = [(side, rel, record[0], record[1], json.dumps({'f': record[2], 'd': record[3]}))
+                for rel, record in updates]
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dirs (side, rel, mtime, size, entries) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.conn.executemany("DELETE FROM dirs WHERE side = ? AND rel = ?", ((side, rel) for rel in drops))
+
+    def finish(self, new_state):
+        """Commit the remaining upserts and drop entries that are no longer present"""
+        self.checkpoint()
+        removed = [(rel,) for rel in self.last if rel not in new_state]
+        if removed:
+            with self._lock, self.conn:
+                self.conn.executemany("DELETE FROM files WHERE rel = ?", removed)
+                self.conn.executemany("DELETE FROM blocks WHERE rel = ?", removed)
+
+    def commit_paths(self, removed, full_state=None):
+        """Persist a partial update (watch mode, streaming diff): staged upserts plus the removed entries"""
+        self.checkpoint()
+        for rel in removed:
+            self.last.pop(rel, None)
+        if removed:
+            with self._lock, self.conn:
+                self.conn.executemany("DELETE FROM files WHERE rel = ?", ((rel,) for rel in removed))
+                self.conn.executemany("DELETE FROM blocks WHERE rel = ?", ((rel,) for rel in removed))
+
+    def merge_partition(self, partition_path):
+        """Fold a shard's manifest partition (see ShardStore) into this manifest, then delete it"""
+        self.checkpoint()
+        with self._lock:
+            self.conn.execute("ATTACH DATABASE ? AS part", (str(partition_path),))
+            try:
+                with self.conn:
+                    rows = self.conn.execute("SELECT rel, mtime, size, sha256, md5, alloc, new FROM part.files").fetchall()
+                    self.conn.executemany(_UPSERT_FILE_SQL, (
+                        {'rel': rel, 'mtime': mtime, 'size': size, 'sha256': sha256, 'md5': md5, 'alloc': alloc, 'new': new}
+                        for rel, mtime, size, sha256, md5, alloc, new in rows))
+                    self.conn.execute("DELETE FROM files WHERE rel IN (SELECT rel FROM part.removed)")
+                    self.conn.execute("DELETE FROM blocks WHERE rel IN (SELECT rel FROM part.removed)")
+                    self.conn.execute("INSERT OR REPLACE INTO blocks SELECT rel, mtime, size, block_size, sigs FROM part.blocks")
+                    self.conn.execute("INSERT OR REPLACE INTO dirs SELECT side, rel, mtime, size, entries FROM part.dirs")
+                    self.conn.execute("DELETE FROM dirs WHERE EXISTS "
+                                      "(SELECT 1 FROM part.dir_drops d WHERE d.side = dirs.side AND d.rel = dirs.rel)")
+            finally:
+                self.conn.execute("DETACH DATABASE part")
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink(str(partition_path) + suffix)
+            except OSError:
+                pass
+
+    def close(self):
+        self.checkpoint()
+        self.conn.close()
+
+class ShardStore(SqliteStateStore):
+    """Manifest partition of one shard in a sharded sync.
+
+    Reads (entries, directory listings, block signatures) come from the job's manifest, limited to
+    the shard's top-level names; writes go to a partition database of its own, which the parent
+    folds in with merge_partition() once every shard is done.
+    """
+
+    def __init__(self, db_path, partition_path, names):
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink(str(partition_path) + suffix)
+            except OSError:
+                pass
+        super().__init__(partition_path)
+        self.main_path = Path(db_path)
+        self.names = names
+        self._main = sqlite3.connect(str(self.main_path), check_same_thread=False)
+        self.conn.execute("ALTER TABLE files ADD COLUMN new INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS removed (rel TEXT PRIMARY KEY) WITHOUT ROWID")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS dir_drops ("
+            "side TEXT NOT NULL, rel TEXT NOT NULL, PRIMARY KEY (side, rel)) WITHOUT ROWID"
+        )
+        self.conn.commit()
+
+    def _select(self, conn, columns, table, where="", params=(), files=True):
+        """Rows of the shard's part of a main-manifest table in rel order: each name, then everything under it"""
+        bounds = []
+        for name in self.names:
+            if files:
+                bounds.append((name, None))
+            bounds.append((name + os.sep, name + chr(ord(os.sep) + 1)))
+        for low, high in sorted(bounds):
+            if high is None:
+                yield from conn.execute(f"SELECT {columns} FROM {table} WHERE {where}rel = ?", params + (low,))
+            else:
+                yield from conn.execute(f"SELECT {columns} FROM {table} WHERE {where}rel >= ? AND rel < ? ORDER BY rel",
+                                        params + (low, high))
+
+    def reader(self):
+        return sqlite3.connect(str(self.main_path), check_same_thread=False)
+
+    def iter_sorted(self):
+        reader = self.reader()
+
+        def entries():
+            try:
+                for rel, mtime, size, alloc in self._select(reader, "rel, mtime, size, alloc", "files"):
+                    yield rel, file_meta(mtime, size, alloc)
+            finally:
+                reader.close()
+        return entries()
+
+    def dir_rels(self, conn, side):
+        return self._select(conn, "rel", "dirs", "side = ? AND ", (side,), files=False)
+
+    def clear_dir_listings(self, side):
+        self.put_dir_listings(side, [], [row[0] for row in self.dir_rels(self._main, side)])
+
+    def put_dir_listings(self, side, updates, drops):
+        # Every shard lists the root, so none of them may keep a listing of it
+        updates = [(rel, record) for rel, record in updates if rel]
+        rows = [(side, rel, record[0], record[1], json.dumps({'f': record[2], 'd': record[3]}))
+                for rel, record in updates]
+        with self._lock, self.conn:
+            self.conn.executemany("DELETE FROM dir_drops WHERE side = ? AND rel = ?", ((side, rel) for rel, _ in updates))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO dirs (side, rel, mtime, size, entries) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self.conn.executemany("DELETE FROM dirs WHERE side = ? AND rel = ?", ((side, rel) for rel in drops))
+            self.conn.executemany("INSERT OR IGNORE INTO dir_drops (side, rel) VALUES (?, ?)", ((side, rel) for rel in drops))
+
+    def get_signature(self, rel):
+        row = super().get_signature(rel)
+        if row is None:
+            with self._lock:
+                row = self._main.execute(
+                    "SELECT mtime, size, block_size, sigs FROM blocks WHERE rel = ?", (rel,)).fetchone()
+        return row
+
+    def checkpoint(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_checkpoint = time.monotonic()
+            if not pending:
+                return
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO files (rel, mtime, size, sha256, md5, alloc, new) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    ((rel, meta['mtime'], meta['size'], (digests or {}).get('sha256'), (digests or {}).get('md5'),
+                      meta.get('alloc'), digests is not None) for rel, (meta, digests) in pending.items())
+                )
+
+    def commit_paths(self, removed, full_state=None):
+        self.checkpoint()
+        if removed:
+            with self._lock, self.conn:
+                self.conn.executemany("INSERT OR IGNORE INTO removed (rel) VALUES (?)", ((rel,) for rel in removed))
+                self.conn.executemany("DELETE FROM files WHERE rel = ?", ((rel,) for rel in removed))
+                self.conn.executemany("DELETE FROM blocks WHERE rel = ?", ((rel,) for rel in removed))
+
+    def close(self):
+        super().close()
+        self._main.close()
+
+class HashCache:
+    """Content digests persisted beside the manifest, keyed by (path, size, mtime, inode)"""
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(str(db_path), check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, inode INTEGER NOT NULL, "
+            "digest TEXT NOT NULL, used REAL NOT NULL) WITHOUT ROWID"
+        )
+        self.conn.commit()
+        self.entries = {path: (size, mtime, inode, digest) for path, size, mtime, inode, digest
+                        in self.conn.execute("SELECT path, size, mtime, inode, digest FROM hashes")}
+        self.used = set()
+        self.computed = 0
+        self._lock = threading.Lock()
+        self._busy = {}  # key -> [lock, waiters] while a digest is being computed
+
+    def digest(self, path):
+        """Digest of a file, streamed from disk only when its metadata changed since it was cached"""
+        st = os.stat(path)
+        key = os.path.normcase(os.path.abspath(path))
+        with self._lock:
+            self.used.add(key)
+            cached = self.entries.get(key)
+            if not (cached and cached[:3] == (st.st_size, st.st_mtime, st.st_ino)):
+                # Threads asking for the same file at once (fan-out destinations) share one read
+                busy = self._busy.setdefault(key, [threading.Lock(), 0])
+                busy[1] += 1
+        if cached and cached[:3] == (st.st_size, st.st_mtime, st.st_ino):
+            return cached[3]
+        try:
+            with busy[0]:
+                with self._lock:
+                    cached = self.entries.get(key)
+                if cached and cached[:3] == (st.st_size, st.st_mtime, st.st_ino):
+                    return cached[3]
+                h = hashlib.blake2b(digest_size=20)
+                with open(path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                        h.update(chunk)
+                digest = h.hexdigest()
+                with self._lock:
+                    self.entries[key] = (st.st_size, st.st_mtime, st.st_ino, digest)
+                    self.computed += 1
+                return digest
+        finally:
+            with self._lock:
+                busy[1] -= 1
+                if not busy[1]:
+                    del self._busy[key]
+
+    def _same(self, path_a, path_b):
+        try:
+            return self.digest(path_a) == self.digest(path_b)
+        except OSError:
+            return False
+
+    def identical(self, rels, dir_a, dir_b):
+        """Relative paths whose content is the same on both sides, hashed on a worker pool"""
+        if not rels:
+            return set()
+        with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+            results = pool.map(lambda rel: self._same(os.path.join(dir_a, rel), os.path.join(dir_b, rel)), rels)
+            return {rel for rel, same in zip(rels, results) if same}
+
+    def close(self):
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hashes (path, size, mtime, inode, digest, used) VALUES (?, ?, ?, ?, ?, ?)",
+                ((path,) + self.entries[path] + (now,) for path in self.used if path in self.entries)
+            )
+            self.conn.execute("DELETE FROM hashes WHERE used < ?", (now - HASH_CACHE_RETENTION_DAYS * 86400,))
+        self.conn.close()
+
+def open_state_store(state_path):
+    """Open the manifest backend selected by STATE_BACKEND"""
+    state_path = Path(state_path)
+    if STATE_BACKEND == "sqlite":
+        try:
+            return SqliteStateStore(state_path.with_suffix(".db"), legacy_json=state_path)
+        except sqlite3.Error as e:
+            print(f"SQLite manifest unavailable ({e}), falling back to JSON")
+    return JsonStateStore(state_path)
+
+def pair_renames(vanished, appeared, src_root, dst_root, digest, tolerance=0.0):
+    """Pair files that vanished from the source side with files that appeared there.
+
+    vanished maps rel -> meta of the copies still on the destination side, appeared maps
+    rel -> meta of the new source files. Candidates are matched on size and mtime, with mtimes
+    within tolerance counting as equal, and every pair, even a lone match, is confirmed by content
+    digest: an unrelated file that happens to share size and mtime must not be renamed into place.
+    Returns [(old_rel, new_rel)].
+    """
+    by_size = {}
+    for rel, meta in vanished.items():
+        if meta['size'] > 0:  # Empty files carry no identity and are free to copy
+            by_size.setdefault(meta['size'], []).append((meta['mtime'], 0, rel))
+    for rel, meta in appeared.items():
+        if meta['size'] in by_size:
+            by_size[meta['size']].append((meta['mtime'], 1, rel))
+    # Within one size, runs of mtimes no more than tolerance apart form a group
+    groups = []
+    for items in by_size.values():
+        items.sort()
+        last = None
+        for mtime, kind, rel in items:
+            if last is None or mtime - last > tolerance:
+                groups.append(([], []))
+            groups[-1][kind].append(rel)
+            last = mtime
+
+    pairs = []
+    for olds, news in groups:
+        if not olds or not news:
+            continue
+        try:
+            by_digest = {}
+            for rel in olds:
+                by_digest.setdefault(digest(os.path.join(dst_root, rel)), []).append(rel)
+            for rel in news:
+                matches = by_digest.get(digest(os.path.join(src_root, rel)))
+                if matches:
+                    pairs.append((matches.pop(), rel))
+        except OSError:
+            continue
+    return pairs
+
+def _prune_empty_dirs(dir_path, root):
+    """Remove directories left empty by a move, stopping at the sync root"""
+    root = os.path.normcase(os.path.abspath(root))
+    dir_path = os.path.abspath(dir_path)
+    while os.path.normcase(dir_path) != root and os.path.normcase(dir_path).startswith(root):
+        try:
+            os.rmdir(dir_path)
+        except OSError:
+            break
+        dir_path = os.path.dirname(dir_path)
+
+def apply_renames(pairs, dst_root, dry_run=False):
+    """Carry out (old_rel, new_rel) renames under dst_root; returns the pairs that were done"""
+    done = []
+    for old, new in pairs:
+        old_path, new_path = os.path.join(dst_root, old), os.path.join(dst_root, new)
+        try:
+            if os.path.lexists(new_path):
+                continue
+            if dry_run:
+                done.append((old, new))
+                continue
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.rename(old_path, new_path)
+        except OSError as e:
+            print(f"Rename failed for {old} -> {new}: {e}")
+            continue
+        _prune_empty_dirs(os.path.dirname(old_path), dst_root)
+        done.append((old, new))
+    return done
+
+def replay_renames(curr_src, curr_dst, last_state, src_root, dst_root, digest, dry_run=False, tolerance=0.0):
+    """Rename files on the destination side to follow renames/moves made on the source side"""
+    vanished = {rel: curr_dst[rel] for rel in last_state if rel not in curr_src and rel in curr_dst}
+    if not vanished:
+        return 0
+    appeared = {rel: meta for rel, meta in curr_src.items() if rel not in last_state and rel not in curr_dst}
+    done = apply_renames(pair_renames(vanished, appeared, src_root, dst_root, digest, tolerance), dst_root, dry_run)
+    for old, new in done:
+        # The diff loop now sees the file in place on both sides and just keeps it
+        curr_dst[new] = curr_dst.pop(old)
+    return len(done)
+
+def _block_sig(block):
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def delta_applicable(dst, src_size):
+    """Whether dst holds enough of an older copy for a block delta to be worth it"""
+    try:
+        dst_size = os.path.getsize(dst)
+    except OSError:
+        return False
+    return dst_size > 0 and dst_size >= src_size * DELTA_MIN_OVERLAP
+
+def delta_copy(src, dst, signature=None, hashers=(), throttle=None):
+    """Update dst in place so it matches src, rewriting only the blocks that differ.
+
+    signature is the recorded (mtime, size, block_size, sigs) of dst's content; when it still
+    matches dst, destination blocks are compared by checksum instead of being read back.
+    Returns (block signatures of src, blocks written, total blocks).
+    """
+    src_size = os.path.getsize(src)
+    dst_st = os.stat(dst)
+    known = None
+    if signature and signature[2] == DELTA_BLOCK_SIZE and \
+            signature[0] == dst_st.st_mtime and signature[1] == dst_st.st_size:
+        known = signature[3]
+
+    sigs = []
+    written = 0
+    index = 0
+
+    def blocks(fsrc):
+        while True:
+            block = paced_read(fsrc, DELTA_BLOCK_SIZE, throttle)
+            if not block:
+                return
+            for h in hashers:
+                h.update(block)
+            sigs.append(_block_sig(block))
+            yield block
+
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'r+b') as fdst:
+            source = blocks(fsrc)
+            for block in source:
+                if known is not None:
+                    same = known[index * 16:(index + 1) * 16] == sigs[-1]
+                else:
+                    fdst.seek(index * DELTA_BLOCK_SIZE)
+                    same = fdst.read(len(block)) == block
+                index += 1
+                if same:
+                    continue
+                fdst.seek((index - 1) * DELTA_BLOCK_SIZE)
+                fdst.write(block)
+                written += 1
+                # Mostly different: stop paying for destination reads and just rewrite the rest
+                if index >= 16 and written > index * DELTA_GIVE_UP_RATIO:
+                    break
+            # Positioned just past the last block written, so the rest follows on in order
+            for block in source:
+                fdst.write(block)
+                written += 1
+                index += 1
+            fdst.truncate(src_size)
+    except BaseException:
+        # An interrupted in-place update must not look current: age it so the next run redoes it
+        try:
+            os.utime(dst, (0, 0))
+        except OSError:
+            pass
+        raise
+    shutil.copystat(src, dst)
+    return b''.join(sigs), written, index
+
+def _journal_paths(dst, journal_dir):
+    key = hashlib.sha1(os.path.normcase(os.path.abspath(dst)).encode('utf-8')).hexdigest()
+    return journal_dir / f"{key}.json", journal_dir / f"{key}.sigs"
+
+def resumable_copy(src, dst, journal_dir, hashers=(), throttle=None):
+    """Copy src to dst through a temp file beside dst, resuming an interrupted copy.
+
+    Progress is journalled in journal_dir as a header plus the signature of every block that
+    has been fsync'd to the temp file. A resumed copy re-checks the last journalled block and
+    continues after it; the temp file replaces dst atomically only once complete. Blocks that
+    lie in a hole of a sparse src are skipped, leaving a hole in the copy; a dense one has its
+    size allocated up front.
+    Returns the block signatures of src. hashers are fed the whole of src, including the part
+    a resumed copy skips.
+    """
+    st = os.stat(src)
+    temp = str(dst) + PARTIAL_SUFFIX
+    header_path, sigs_path = _journal_paths(dst, journal_dir)
+    header = {'src': str(src), 'dst': str(dst), 'size': st.st_size, 'mtime': st.st_mtime, 'block_size': DELTA_BLOCK_SIZE}
+    journal_dir.mkdir(parents=True, exist_ok=True)
+
+    sigs = b''
+    try:
+        with open(header_path, 'r') as f:
+            if json.load(f) == header and os.path.exists(temp):
+                with open(sigs_path, 'rb') as f:
+                    sigs = f.read()
+                sigs = sigs[:len(sigs) // 16 * 16]
+    except (OSError, ValueError):
+        pass
+    done = len(sigs) // 16
+    if done:
+        try:
+            with open(temp, 'rb') as f:
+                f.seek((done - 1) * DELTA_BLOCK_SIZE)
+                if _block_sig(f.read(DELTA_BLOCK_SIZE)) != sigs[-16:]:
+                    done = 0
+        except OSError:
+            done = 0
+    if done:
+        print(f"Resuming {dst} from {done * DELTA_BLOCK_SIZE:,} of {st.st_size:,} bytes")
+    else:
+        sigs = b''
+        with open(header_path, 'w') as f:
+            json.dump(header, f)
+
+    blocks = [sigs]
+    with open(src, 'rb') as fsrc, open(temp, 'r+b' if done else 'wb') as ftmp, \
+            open(sigs_path, 'r+b' if done else 'wb') as fsig:
+        offset = done * DELTA_BLOCK_SIZE
+        extents = sparse_extents(fsrc, st.st_size)
+        if hashers:
+            for block in iter(lambda: paced_read(fsrc, min(DELTA_BLOCK_SIZE, offset - fsrc.tell()), throttle), b''):
+                for h in hashers:
+                    h.update(block)
+        fsrc.seek(offset)
+        ftmp.seek(offset)
+        ftmp.truncate()
+        fsig.seek(done * 16)
+        fsig.truncate()
+        if extents is None:
+            _preallocate(ftmp, st.st_size)
+        else:
+            _mark_sparse(ftmp)
+        starts = [start for start, _ in extents or ()]
+        hole_sig = None
+        pending = []
+        while True:
+            offset = fsrc.tell()
+            hole = 0
+            if extents is not None and offset < st.st_size:
+                # The extent starting at or before offset, and the next one, tell whether this block holds data
+                i = bisect.bisect_right(starts, offset) - 1
+                end = offset + min(DELTA_BLOCK_SIZE, st.st_size - offset)
+                if (i < 0 or extents[i][1] <= offset) and (i + 1 >= len(starts) or starts[i + 1] >= end):
+                    hole = end - offset
+            if hole:
+                fsrc.seek(hole, os.SEEK_CUR)
+                ftmp.seek(hole, os.SEEK_CUR)
+                _hash_zeros(hashers, hole)
+                if hole_sig is None or hole != DELTA_BLOCK_SIZE:
+                    hole_sig = _block_sig(bytes(hole))
+                pending.append(hole_sig)
+                block = b''
+            else:
+                block = paced_read(fsrc, DELTA_BLOCK_SIZE, throttle)
+                if block:
+                    ftmp.write(block)
+                    for h in hashers:
+                        h.update(block)
+                    pending.append(_block_sig(block))
+                else:
+                    # A trailing hole was only skipped over: give the copy its full length
+                    ftmp.truncate()
+            if pending and (not (block or hole) or len(pending) >= RESUME_SYNC_BLOCKS):
+                # Data must be on disk before the journal claims it
+                ftmp.flush()
+                os.fsync(ftmp.fileno())
+                fsig.write(b''.join(pending))
+                fsig.flush()
+                blocks.extend(pending)
+                pending = []
+            if not (block or hole):
+                break
+
+    shutil.copystat(src, temp)
+    os.replace(temp, dst)
+    for p in (header_path, sigs_path):
+        try:
+            p.unlink()
+        except OSError:
+            pass
+    return b''.join(blocks)
+
+def purge_stale_journals(journal_dir, days_old=RESUME_JOURNAL_DAYS):
+    """Drop partial copies that have not been resumed for days_old days"""
+    if not journal_dir.exists():
+        return
+    cutoff = time.time() - days_old * 24 * 60 * 60
+    for header_path in journal_dir.glob("*.json"):
+        try:
+            if header_path.stat().st_mtime >= cutoff:
+                continue
+            with open(header_path, 'r') as f:
+                header = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for p in (Path(header.get('dst', '') + PARTIAL_SUFFIX), header_path, header_path.with_suffix('.sigs')):
+            try:
+                p.unlink()
+            except OSError:
+                pass
+
+_FSCTL_SET_SPARSE = 0x900C4
+_FSCTL_QUERY_ALLOCATED_RANGES = 0x940CF
+_ERROR_MORE_DATA = 234
+_ZEROS = bytes(1024 * 1024)
+
+def _allocated_ranges(fd, size):
+    # Windows: FSCTL_QUERY_ALLOCATED_RANGES, asked again from the last range while the buffer overflows
+    import ctypes
+    import msvcrt
+    from ctypes import wintypes
+    Range = ctypes.c_longlong * 2  # FILE_ALLOCATED_RANGE_BUFFER: offset, length
+    out = (Range * 256)()
+    returned = wintypes.DWORD()
+    handle = wintypes.HANDLE(msvcrt.get_osfhandle(fd))
+    extents = []
+    pos = 0
+    while pos < size:
+        query = Range(pos, size - pos)
+        ok = ctypes.windll.kernel32.DeviceIoControl(handle, _FSCTL_QUERY_ALLOCATED_RANGES, ctypes.byref(query),
+                                                    ctypes.sizeof(query), out, ctypes.sizeof(out),
+                                                    ctypes.byref(returned), None)
+        if not ok and ctypes.GetLastError() != _ERROR_MORE_DATA:
+            return None
+        n = returned.value // ctypes.sizeof(Range)
+        extents.extend((out[i][0], min(out[i][0] + out[i][1], size)) for i in range(n))
+        if ok or not n:
+            break
+        pos = extents[-1][1]
+    return extents
+
+def data_extents(f, size):
+    """(start, end) byte ranges of the open file f that hold data, or None if the OS or filesystem can't say.
+
+    Found with SEEK_DATA/SEEK_HOLE on POSIX and FSCTL_QUERY_ALLOCATED_RANGES on Windows; the
+    gaps between them are holes, which read back as zeros.
+    """
+    fd = f.fileno()
+    if os.name == 'nt':
+        return _allocated_ranges(fd, size)
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    import errno
+    extents = []
+    pos = 0
+    try:
+        while pos < size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # Only a hole is left
+                    break
+                raise
+            if start >= size:
+                break
+            pos = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            extents.append((start, pos))
+    except OSError:
+        return None
+    finally:
+        os.lseek(fd, 0, os.SEEK_SET)
+    return extents
+
+def sparse_extents(f, size):
+    """Data extents of the open file f when it should be copied sparse (it has holes), else None"""
+    if not SPARSE_COPIES or size < SPARSE_MIN_SIZE:
+        return None
+    alloc = allocated_size(f.name, os.fstat(f.fileno()))
+    if alloc is None or alloc >= size:
+        return None
+    extents = data_extents(f, size)
+    if extents is None or extents == [(0, size)]:
+        return None
+    return extents
+
+def _mark_sparse(f):
+    # NTFS only leaves unwritten ranges unallocated in files flagged sparse; POSIX filesystems always do
+    if os.name == 'nt':
+        import ctypes
+        import msvcrt
+        from ctypes import wintypes
+        ctypes.windll.kernel32.DeviceIoControl(wintypes.HANDLE(msvcrt.get_osfhandle(f.fileno())), _FSCTL_SET_SPARSE,
+                                               None, 0, None, 0, ctypes.byref(wintypes.DWORD()), None)
+
+def _preallocate(f, size):
+    """Reserve the whole of a large dense copy up front, so the filesystem can lay it out in few fragments"""
+    if not PREALLOCATE_MIN_SIZE or size < PREALLOCATE_MIN_SIZE:
+        return
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(f.fileno(), 0, size)
+        elif os.name == 'nt':
+            import ctypes
+            import msvcrt
+            from ctypes import wintypes
+            # FileAllocationInfo reserves clusters without moving the end of the file
+            ctypes.windll.kernel32.SetFileInformationByHandle(
+                wintypes.HANDLE(msvcrt.get_osfhandle(f.fileno())), 5, ctypes.byref(ctypes.c_longlong(size)), 8)
+        else:
+            os.ftruncate(f.fileno(), size)
+    except OSError:
+        pass  # Only an optimisation
+
+def _hash_zeros(hashers, n):
+    # A hole reads back as zeros, so the digests must see them
+    if not hashers:
+        return
+    while n > 0:
+        chunk = memoryview(_ZEROS)[:min(n, len(_ZEROS))]
+        for h in hashers:
+            h.update(chunk)
+        n -= len(chunk)
+
+def _copy_extents(fsrc, fdst, size, extents, hashers=(), throttle=None):
+    """Write the data extents of fsrc to fdst at their own offsets; the holes between them stay holes"""
+    _mark_sparse(fdst)
+    pos = 0
+    for start, end in extents:
+        _hash_zeros(hashers, start - pos)
+        fsrc.seek(start)
+        fdst.seek(start)
+        pos = start
+        while pos < end:
+            chunk = paced_read(fsrc, min(COPY_BUFFER_SIZE, end - pos), throttle)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            for h in hashers:
+                h.update(chunk)
+            pos += len(chunk)
+    _hash_zeros(hashers, size - pos)
+    fdst.truncate(size)
+
+def _copy_kernel(src, dst):
+    """Copy inside the kernel: CopyFileW on Windows, copy_file_range (falling back to sendfile) on Linux"""
+    if os.name == 'nt':
+        import ctypes
+        if not ctypes.windll.kernel32.CopyFileW(str(src), str(dst), False):
+            raise ctypes.WinError()
+        return
+    import errno
+    chunk = 1 << 30  # Bytes asked for per call; the kernel may do less
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        infd, outfd = fsrc.fileno(), fdst.fileno()
+        copy_range = getattr(os, 'copy_file_range', None)
+        offset = 0
+        while True:
+            if copy_range is not None:
+                try:
+                    n = copy_range(infd, outfd, chunk)
+                except OSError as e:
+                    # Older kernels refuse some cross-filesystem copies up front: use sendfile instead
+                    if offset or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    copy_range = None
+                    continue
+            else:
+                n = os.sendfile(outfd, infd, offset, chunk)
+            if not n:
+                break
+            offset += n
+
+def _copy_mmap(src, dst, hashers=()):
+    """Write dst straight out of a read-only mapping of src"""
+    import mmap
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if not size:
+            return
+        _preallocate(fdst, size)
+        with mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                for offset in range(0, len(mapped), COPY_BUFFER_SIZE):
+                    # Each slice is released at once: the mapping cannot close while one is alive
+                    with view[offset:offset + COPY_BUFFER_SIZE] as chunk:
+                        fdst.write(chunk)
+                        for h in hashers:
+                            h.update(chunk)
+            finally:
+                view.release()
+
+def _copy_threaded(src, dst, hashers=(), throttle=None):
+    """Read ahead on a helper thread while this one writes (and hashes), cycling COPY_READ_AHEAD buffers"""
+    import queue
+    free, filled = queue.Queue(), queue.Queue()
+    for _ in range(COPY_READ_AHEAD):
+        free.put(bytearray(COPY_BUFFER_SIZE))
+    failure = []
+
+    def read(fsrc):
+        try:
+            while True:
+                buf = free.get()
+                if buf is None:  # The writer gave up
+                    return
+                started = time.perf_counter()
+                n = fsrc.readinto(buf)
+                if throttle:
+                    throttle.take(n, time.perf_counter() - started)
+                filled.put((buf, n))
+                if not n:
+                    return
+        except BaseException as e:
+            failure.append(e)
+            filled.put((None, 0))
+
+    with open(src, 'rb', buffering=0) as fsrc, open(dst, 'wb', buffering=0) as fdst:
+        _preallocate(fdst, os.fstat(fsrc.fileno()).st_size)
+        reader = threading.Thread(target=read, args=(fsrc,), daemon=True)
+        reader.start()
+        try:
+            while True:
+                buf, n = filled.get()
+                if not n:
+                    break
+                data = memoryview(buf)[:n]
+                view = data
+                while view:
+                    view = view[fdst.write(view):]
+                for h in hashers:
+                    h.update(data)
+                free.put(buf)
+        finally:
+            free.put(None)
+            reader.join()
+    if failure:
+        raise failure[0]
+
+def _copy_buffered(src, dst, hashers=(), throttle=None):
+    """Plain read/hash/write loop, for files too small to be worth a reader thread"""
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        _preallocate(fdst, os.fstat(fsrc.fileno()).st_size)
+        for chunk in iter(lambda: paced_read(fsrc, COPY_BUFFER_SIZE, throttle), b''):
+            fdst.write(chunk)
+            for h in hashers:
+                h.update(chunk)
+
+# Content-only copies; copy_file() adds the metadata the way shutil.copy2 does
+COPY_BACKENDS = {
+    'copy2': shutil.copyfile,
+    'kernel': _copy_kernel,
+    'mmap': _copy_mmap,
+    'threaded': _copy_threaded,
+}
+
+HASHING_BACKENDS = ('mmap', 'threaded')  # Backends that see the bytes, so can feed digests
+
+def _auto_backends(hashing=False):
+    if hashing:
+        # Only backends that see the bytes can hash them; the rest would be measured for nothing
+        return [name for name in _auto_backends() if name in HASHING_BACKENDS]
+    names = ['copy2', 'threaded']
+    if os.name == 'nt' or sys.platform.startswith('linux'):
+        names.append('kernel')
+    # A mapped file truncated mid-copy kills the process with SIGBUS on POSIX; Windows refuses the truncate
+    if os.name == 'nt':
+        names.append('mmap')
+    return names
+
+def calibrate_copy_backends(src, dst_dir, hashing=False):
+    """MB/s of each candidate backend copying src into a temp file in dst_dir (src is only read).
+    With hashing, only HASHING_BACKENDS are timed, each feeding COPY_DIGESTS as a real copy would."""
+    # Read src once first so no backend is timed against a cold cache and the rest against a warm one
+    with open(src, 'rb') as f:
+        while f.read(COPY_BUFFER_SIZE):
+            pass
+    size = os.path.getsize(src)
+    temp = os.path.join(dst_dir, f"vaultmirror-calibrate-{threading.get_ident()}{PARTIAL_SUFFIX}")
+    rates = {}
+    for name in _auto_backends(hashing):
+        try:
+            started = time.perf_counter()
+            if hashing:
+                COPY_BACKENDS[name](src, temp, [hashlib.new(digest) for digest in COPY_DIGESTS])
+            else:
+                COPY_BACKENDS[name](src, temp)
+            elapsed = time.perf_counter() - started
+        except OSError:
+            continue
+        finally:
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+        rates[name] = round(size / max(elapsed, 1e-6) / 1024 ** 2, 1)
+    return rates
+
+class CopyCalibration:
+    """Copy backend chosen for each (source drive, destination drive), measured once and cached as JSON"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.choices = {}
+        try:
+            with open(self.path, 'r') as f:
+                self.choices = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self._lock = threading.Lock()
+        self._measuring = set()
+
+    def backend(self, src, dst, size, hashing=False):
+        """Backend to copy src to dst with; a new pair of drives is measured on this copy if it is small enough.
+
+        Hashing copies choose among HASHING_BACKENDS only, measured and cached separately.
+        """
+        if COPY_BACKEND != "auto":
+            return COPY_BACKEND
+        candidates = _auto_backends(hashing)
+        if len(candidates) == 1:
+            return candidates[0]
+        dst_dir = os.path.dirname(dst)
+        key = f"{device_key(src)} -> {device_key(dst_dir)}" + (" (hashing)" if hashing else "")
+        with self._lock:
+            choice = self.choices.get(key)
+            if choice and time.time() - choice['measured'] < COPY_CALIBRATION_DAYS * 86400:
+                return choice['backend']
+            # One copy measures the pair; the others use the first candidate (copy2, or threaded to hash) meanwhile
+            if key in self._measuring or size > COPY_CALIBRATION_MAX_BYTES:
+                return choice['backend'] if choice else candidates[0]
+            self._measuring.add(key)
+        try:
+            rates = calibrate_copy_backends(src, dst_dir, hashing)
+        finally:
+            with self._lock:
+                self._measuring.discard(key)
+        if not rates:
+            return candidates[0]
+        best = max(rates, key=rates.get)
+        print(f"Copy backend for {key}: {best} ({', '.join(f'{n} {r} MB/s' for n, r in rates.items())})")
+        with self._lock:
+            self.choices[key] = {'backend': best, 'measured': time.time(), 'mb_per_s': rates}
+            try:
+                temp = self.path.with_name(self.path.name + ".tmp")
+                with open(temp, 'w') as f:
+                    json.dump(self.choices, f, indent=2)
+                os.replace(temp, self.path)
+            except OSError as e:
+                print(f"Could not save copy calibration: {e}")
+        return best
+
+_CALIBRATION_LOCK = threading.Lock()
+_CALIBRATIONS = {}
+
+def copy_calibration(path):
+    """Shared CopyCalibration for a calibration file (every job and copy thread uses the same one)"""
+    key = os.path.normcase(os.path.abspath(path))
+    with _CALIBRATION_LOCK:
+        if key not in _CALIBRATIONS:
+            _CALIBRATIONS[key] = CopyCalibration(path)
+        return _CALIBRATIONS[key]
+
+_OVERRIDES_NOTED = set()
+
+def _note_backend_override(picked, used):
+    # Once per process: hash-while-copy is running a slower backend than the one picked
+    with _CALIBRATION_LOCK:
+        if (picked, used) in _OVERRIDES_NOTED:
+            return
+        _OVERRIDES_NOTED.add((picked, used))
+    print(f"Copy backend {picked} can't hash while copying; using {used} (COPY_DIGESTS is set)")
+
+def copy_file(src, dst, size, calibration=None, hashers=(), throttle=None):
+    """shutil.copy2 through the backend picked for this pair of drives, feeding hashers the bytes
+    as they are copied; returns (backend used, backend picked). They differ when the pick (say a
+    forced COPY_BACKEND = "kernel") can't hash. Sparse files copy only their data ('sparse').
+    A throttled copy always reads through this process, so every chunk can be paced."""
+    extents = None
+    if SPARSE_COPIES and size >= SPARSE_MIN_SIZE:
+        with open(src, 'rb') as fsrc:
+            extents = sparse_extents(fsrc, size)
+    if extents is not None:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            _copy_extents(fsrc, fdst, size, extents, hashers, throttle)
+        shutil.copystat(src, dst)
+        return 'sparse', 'sparse'
+    name = 'copy2'
+    if throttle:
+        name = 'threaded' if size >= COPY_BACKEND_MIN_SIZE else 'buffered'
+    elif size >= COPY_BACKEND_MIN_SIZE:
+        if calibration is not None:
+            name = calibration.backend(src, dst, size, bool(hashers))
+        elif COPY_BACKEND != "auto":
+            name = COPY_BACKEND
+    picked = name
+    if hashers and name not in HASHING_BACKENDS:
+        # Kernel-side copies never hand the bytes to this process
+        name = 'threaded' if size >= COPY_BACKEND_MIN_SIZE else 'buffered'
+        if size >= COPY_BACKEND_MIN_SIZE:
+            _note_backend_override(picked, name)
+        else:
+            picked = name  # Small files are never measured, so there was no real pick
+    if name == 'copy2':
+        shutil.copy2(src, dst)
+        return name, picked
+    if name == 'buffered':
+        _copy_buffered(src, dst, hashers, throttle)
+    elif throttle:
+        _copy_threaded(src, dst, hashers, throttle)
+    elif hashers:
+        COPY_BACKENDS[name](src, dst, hashers)
+    else:
+        COPY_BACKENDS[name](src, dst)
+    shutil.copystat(src, dst)
+    return name, picked
+
+def _age(path):
+    # A bad or partial copy must not look current: age it so the next run redoes it
+    try:
+        os.utime(path, (0, 0))
+    except OSError:
+        pass
+
+def fanout_copy(src, dsts, size, hashers=(), throttle=None):
+    """Copy src (with its timestamps) to every path in dsts, reading it once; returns {dst: exception} for the failures.
+
+    Files up to COPY_BUFFER_SIZE are read whole and written to each destination in turn. Larger
+    ones are streamed to a writer thread per destination through a queue of COPY_READ_AHEAD
+    chunks; a destination that has held the read up for FANOUT_STALL_SECONDS in all is cut loose
+    with a TimeoutError, so a slow or disconnected drive does not hold up the others. Only the
+    data of a sparse src is read and written. Failed copies are aged.
+    """
+    import queue
+    failed = {}
+    if size <= COPY_BUFFER_SIZE:
+        with open(src, 'rb') as fsrc:
+            data = paced_read(fsrc, -1, throttle)
+        for h in hashers:
+            h.update(data)
+        for dst in dsts:
+            try:
+                with open(dst, 'wb') as fdst:
+                    fdst.write(data)
+                shutil.copystat(src, dst)
+            except Exception as e:
+                failed[dst] = e
+                _age(dst)
+        return failed
+
+    def write(dst, chunks, cancelled):
+        try:
+            with open(dst, 'wb') as fdst:
+                if extents is None:
+                    _preallocate(fdst, size)
+                else:
+                    _mark_sparse(fdst)
+                while True:
+                    item = chunks.get()
+                    if item is None or cancelled.is_set():
+                        break
+                    offset, chunk = item
+                    if offset is not None:
+                        fdst.seek(offset)
+                    fdst.write(chunk)
+                if extents is not None and not cancelled.is_set():
+                    fdst.truncate(size)
+            if not cancelled.is_set():
+                shutil.copystat(src, dst)
+                return
+        except Exception as e:
+            failed.setdefault(dst, e)
+            cancelled.set()
+        _age(dst)
+
+    def cancel(dst, chunks, cancelled, reason):
+        failed.setdefault(dst, reason)
+        cancelled.set()
+        try:
+            chunks.put_nowait(None)
+        except queue.Full:
+            pass  # The writer sees the flag after its next chunk
+
+    def send(item):
+        for dst, chunks, cancelled, _ in writers:
+            while not cancelled.is_set():
+                started = time.monotonic()
+                try:
+                    chunks.put(item, timeout=min(0.5, max(0.01, FANOUT_STALL_SECONDS - waited[dst])))
+                    break
+                except queue.Full:
+                    pass
+                finally:
+                    waited[dst] += time.monotonic() - started
+                if waited[dst] >= FANOUT_STALL_SECONDS:
+                    cancel(dst, chunks, cancelled, TimeoutError(
+                        f"held the other destinations up for {FANOUT_STALL_SECONDS}s"))
+
+    with open(src, 'rb') as fsrc:
+        extents = sparse_extents(fsrc, size)
+    writers = []
+    waited = {}  # Seconds the read spent blocked on each destination
+    for dst in dsts:
+        chunks, cancelled = queue.Queue(COPY_READ_AHEAD), threading.Event()
+        thread = threading.Thread(target=write, args=(dst, chunks, cancelled), daemon=True)
+        thread.start()
+        writers.append((dst, chunks, cancelled, thread))
+        waited[dst] = 0.0
+    try:
+        with open(src, 'rb') as fsrc:
+            if extents is None:
+                for chunk in iter(lambda: paced_read(fsrc, COPY_BUFFER_SIZE, throttle), b''):
+                    for h in hashers:
+                        h.update(chunk)
+                    send((None, chunk))
+            else:
+                pos = 0
+                for start, end in extents:
+                    _hash_zeros(hashers, start - pos)
+                    fsrc.seek(start)
+                    pos = start
+                    while pos < end:
+                        chunk = paced_read(fsrc, min(COPY_BUFFER_SIZE, end - pos), throttle)
+                        if not chunk:
+                            break
+                        for h in hashers:
+                            h.update(chunk)
+                        # Each extent's first chunk carries its offset; the rest follow on
+                        send((pos if pos == start else None, chunk))
+                        pos += len(chunk)
+                _hash_zeros(hashers, size - pos)
+            send(None)
+    except Exception as e:
+        for dst, chunks, cancelled, _ in writers:
+            cancel(dst, chunks, cancelled, e)
+    for dst, _, cancelled, thread in writers:
+        # A writer cut loose finishes (or hangs) on its own
+        if not cancelled.is_set():
+            thread.join()
+    return failed
+
+def verify_copy(dst, algorithm, expected):
+    """Re-read dst and compare its digest with the one taken while copying.
+
+    Where the OS allows it (POSIX) dst is flushed and dropped from the page cache first, so the
+    bytes come back from the disk rather than from memory.
+    """
+    h = hashlib.new(algorithm)
+    with open(dst, 'rb') as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.fsync(f.fileno())
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        for chunk in iter(lambda: f.read(COPY_BUFFER_SIZE), b''):
+            h.update(chunk)
+    if h.hexdigest() != expected:
+        _age(dst)
+        raise OSError(f"verification failed: {algorithm} of the copy does not match the source")
+
+def _minutes(hhmm):
+    hours, _, minutes = str(hhmm).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+def scheduled_rate(mb_per_s, profiles, now=None):
+    """Bytes/s allowed at now (default: the local time) by the first profile window holding it, else mb_per_s; 0 = no cap"""
+    if profiles:
+        now = now or datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in profiles:
+            start, end = _minutes(start), _minutes(end)
+            # A window that ends before it starts runs past midnight
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                mb_per_s = rate
+                break
+    return int((mb_per_s or 0) * 1024 ** 2)
+
+class TokenBucket:
+    """Paces the bytes copied through it to a cap in MB/s, which time-of-day profiles can change.
+
+    take() is called with every chunk a copy reads and sleeps once the copies have got more than
+    BANDWIDTH_BURST_SECONDS ahead of the cap. In adaptive mode it is also told how long each read
+    took: reads BANDWIDTH_LATENCY_FACTOR times slower than usual mean something else is busy on the
+    disk, so the rate is halved (not below BANDWIDTH_MIN_MB_PER_S), and it creeps back up while
+    reads stay fast. share splits the caps between processes (sharded syncs).
+    """
+
+    def __init__(self, mb_per_s=0, profiles=(), adaptive=False, share=1):
+        self.mb_per_s = mb_per_s
+        self.profiles = [tuple(p) for p in profiles]
+        self.adaptive = adaptive
+        self.share = max(1, share)
+        self.backoffs = 0
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._latency = None  # Smoothed seconds per MB of recent reads
+        self._baseline = None  # What that usually is
+        self._backoff = None  # Adaptive cap in bytes/s while backing off
+        self._window_bytes = 0
+        self._window_start = self._stamp
+
+    @property
+    def active(self):
+        return bool(self.mb_per_s or self.profiles or self.adaptive)
+
+    def rate(self):
+        """Bytes/s currently allowed (0 = no cap)"""
+        with self._lock:
+            return self._rate()
+
+    def _rate(self):
+        rate = scheduled_rate(self.mb_per_s, self.profiles) // self.share
+        if self._backoff is not None:
+            rate = min(rate, self._backoff) if rate else self._backoff
+        return rate
+
+    def take(self, n, read_seconds=None):
+        """Count n bytes copied (read in read_seconds, for adaptive mode); returns the seconds slept to stay under the cap"""
+        with self._lock:
+            now = time.monotonic()
+            if self.adaptive and read_seconds is not None and n >= 64 * 1024:
+                self._observe(n, read_seconds, now)
+            rate = self._rate()
+            if not rate:
+                self._tokens, self._stamp = 0.0, now
+                return 0.0
+            self._tokens = min(self._tokens + (now - self._stamp) * rate, rate * BANDWIDTH_BURST_SECONDS)
+            self._stamp = now
+            # Copies run into debt and sleep it off, so concurrent ones share the cap between them
+            self._tokens -= n
+            delay = -self._tokens / rate if self._tokens < 0 else 0.0
+        if delay:
+            time.sleep(delay)
+        return delay
+
+    def _observe(self, n, seconds, now):
+        # Caller holds self._lock
+        per_mb = seconds / (n / 1024 ** 2)
+        self._latency = per_mb if self._latency is None else 0.8 * self._latency + 0.2 * per_mb
+        if self._baseline is None or self._latency < self._baseline:
+            self._baseline = self._latency
+        self._window_bytes += n
+        elapsed = now - self._window_start
+        if elapsed < BANDWIDTH_ADAPT_SECONDS:
+            return
+        # The baseline follows faster reads at once but slower ones only 1% per step, so a busy disk
+        # takes minutes to become the norm (and a drive that really got slower gets there in the end)
+        self._baseline += (self._latency - self._baseline) * 0.01
+        measured = self._window_bytes / elapsed
+        self._window_bytes, self._window_start = 0, now
+        if self._latency > self._baseline * BANDWIDTH_LATENCY_FACTOR:
+            floor = int(BANDWIDTH_MIN_MB_PER_S * 1024 ** 2) // self.share
+            backoff = max(floor, int((self._backoff or measured) / 2))
+            if self._backoff is None or backoff < self._backoff:
+                self.backoffs += 1
+            self._backoff = backoff
+        elif self._backoff is not None:
+            self._backoff = int(self._backoff * 1.25)
+            scheduled = scheduled_rate(self.mb_per_s, self.profiles) // self.share
+            # Past the scheduled cap, or well past what the copies manage anyway, it no longer limits anything
+            if (scheduled and self._backoff >= scheduled) or self._backoff > measured * 2:
+                self._backoff = None
+
+_GLOBAL_BUCKETS_LOCK = threading.Lock()
+_GLOBAL_BUCKETS = {}
+
+def global_bucket(share=1):
+    """The TokenBucket for BANDWIDTH_MB_PER_S and BANDWIDTH_PROFILES, shared by every job and copy thread in this process"""
+    key = (BANDWIDTH_MB_PER_S, tuple(tuple(p) for p in BANDWIDTH_PROFILES), share)
+    with _GLOBAL_BUCKETS_LOCK:
+        if key not in _GLOBAL_BUCKETS:
+            _GLOBAL_BUCKETS[key] = TokenBucket(BANDWIDTH_MB_PER_S, BANDWIDTH_PROFILES, share=share)
+        return _GLOBAL_BUCKETS[key]
+
+class Throttle:
+    """The token buckets one job's copies pass through, counting the time they spend paced; false if none caps anything"""
+
+    def __init__(self, buckets):
+        self.buckets = [bucket for bucket in buckets if bucket.active]
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def __bool__(self):
+        return bool(self.buckets)
+
+    @property
+    def backoffs(self):
+        return sum(bucket.backoffs for bucket in self.buckets)
+
+    def take(self, n, read_seconds=None):
+        waited = sum(bucket.take(n, read_seconds) for bucket in self.buckets)
+        if waited:
+            with self._lock:
+                self.waited += waited
+
+def job_throttle(job, share=1):
+    """Throttle for a job's copies: its own cap, profiles and adaptive setting, then the process-wide cap"""
+    adaptive = BANDWIDTH_ADAPTIVE if job.bandwidth_adaptive is None else job.bandwidth_adaptive
+    return Throttle([TokenBucket(job.bandwidth_mb_per_s, job.bandwidth_profiles, adaptive, share),
+                     global_bucket(share)])
+
+def paced_read(f, n, throttle=None):
+    """f.read(n), counted against throttle along with how long the read took"""
+    if not throttle:
+        return f.read(n)
+    started = time.perf_counter()
+    data = f.read(n)
+    throttle.take(len(data), time.perf_counter() - started)
+    return data
+
+class TransferPools:
+    """Copy worker pools; one per sync, or one shared by every job in the multi-job runner"""
+
+    def __init__(self, small_workers, large_workers):
+        self.small = ThreadPoolExecutor(max_workers=small_workers)
+        self.large = ThreadPoolExecutor(max_workers=large_workers)
+
+    def shutdown(self):
+        self.small.shutdown(wait=True)
+        self.large.shutdown(wait=True)
+
+class TransferQueue:
+    """Bounded worker pool that runs the copies and safe-deletes queued by the diff loop"""
+
+    def __init__(self, new_state, job, store, pools=None, share=1):
+        self.new_state = new_state
+        self.job = job
+        self.store = store
+        self.copies = 0
+        self.bytes_copied = 0
+        self.deletions = 0
+        self.errors = 0
+        self.delete_errors = 0
+        self.failures = []  # (path, action, reason), first METRICS_MAX_FAILURES only
+        self.failed_rels = []  # Streaming diff: copies that failed, whose manifest entries must go
+        self.delta_files = 0
+        self.delta_blocks_written = 0
+        self.delta_blocks_total = 0
+        self.backends = {}  # Plain copies per copy backend
+        self.backend_overrides = {}  # "picked -> used" counts, for picks that can't hash while copying
+        self.verified = 0
+        self.throttled_seconds = 0.0  # Absorbed from shards; this queue's own are counted by its throttle
+        self.backoffs = 0
+        self.calibration = copy_calibration(Path(job.state_file).parent / COPY_CALIBRATION_FILE)
+        # share: sharded syncs split the bandwidth caps between their worker processes
+        self.throttle = job_throttle(job, share)
+        # The multi-job runner passes in pools shared by every job; otherwise this queue owns its own
+        self._owns_pools = pools is None
+        if pools is None:
+            pools = TransferPools(COPY_WORKERS_SMALL, COPY_WORKERS_LARGE)
+        self._small = pools.small
+        self._large = pools.large
+        self._slots = threading.BoundedSemaphore(MAX_PENDING_TRANSFERS)
+        self._outstanding = 0
+        self._idle = threading.Condition()
+        self._lock = threading.Lock()
+        self._made_dirs = set()
+        self.written_dirs = {'a': set(), 'b': set()}  # Directories (per side) whose contents we changed
+
+    def _track(self):
+        # Blocks the diff loop once MAX_PENDING_TRANSFERS actions are waiting; _done() ends the action
+        self._slots.acquire()
+        with self._idle:
+            self._outstanding += 1
+
+    def _submit(self, pool, fn, *args):
+        self._track()
+        future = pool.submit(fn, *args)
+        future.add_done_callback(self._done)
+
+    def _done(self, _):
+        self._slots.release()
+        with self._idle:
+            self._outstanding -= 1
+            if not self._outstanding:
+                self._idle.notify_all()
+
+    def _ensure_parent(self, path):
+        parent = os.path.dirname(path)
+        if parent in self._made_dirs:
+            return
+        os.makedirs(parent, exist_ok=True)
+        with self._lock:
+            self._made_dirs.add(parent)
+
+    def keep(self, rel, meta, previous=None, digests=None):
+        """Record a file in new_state and stage it (with the digests taken while copying it) in the manifest store.
+
+        Without a new_state (streaming diff) the caller passes the manifest entry instead, and
+        unchanged entries are not staged at all.
+        """
+        entry = file_meta(meta['mtime'], meta['size'], meta.get('alloc'))
+        if self.new_state is not None:
+            with self._lock:
+                self.new_state[rel] = entry
+        elif entry == previous and digests is None:
+            return
+        self.store.stage(rel, entry, digests)
+
+    def copy(self, src, dst, rel, meta, dst_side):
+        """Queue a copy; the file is recorded in new_state only once it has been copied"""
+        pool = self._large if meta['size'] >= LARGE_FILE_THRESHOLD else self._small
+        self._submit(pool, self._do_copy, src, dst, rel, meta, dst_side)
+
+    def _wrote(self, rel, dst_side):
+        # Overwrites leave the directory mtime alone, so its recorded listing must be dropped
+        with self._lock:
+            self.written_dirs[dst_side].add(rel[:rel.rfind(os.sep) + 1])
+
+    def _copied(self, rel, meta, digests):
+        with self._lock:
+            self.copies += 1
+            self.bytes_copied += meta['size']
+        self.keep(rel, meta, digests=digests)
+
+    def _copy_failed(self, rel, error):
+        print(f"Copy failed for {rel}: {error}")
+        with self._lock:
+            self.errors += 1
+            self._fail(rel, "copy", error)
+            if self.new_state is None:
+                self.failed_rels.append(rel)
+
+    def plain_copy(self, dst, meta):
+        """Whether a copy of meta's file to dst goes through copy_file() (not a delta or resumable copy)"""
+        if DELTA_THRESHOLD and meta['size'] >= DELTA_THRESHOLD and delta_applicable(dst, meta['size']):
+            return False
+        return not (RESUMABLE_THRESHOLD and meta['size'] >= RESUMABLE_THRESHOLD)
+
+    def copy_shared(self, src, targets, rel, meta):
+        """Queue one read of src written to several destinations (fan-out jobs).
+
+        targets are (TransferQueue, dst) pairs, one per destination and this queue among them;
+        the copy counts as an action of each until it is done.
+        """
+        for transfers, _ in targets:
+            transfers._track()
+            transfers._wrote(rel, 'b')
+        pool = self._large if meta['size'] >= LARGE_FILE_THRESHOLD else self._small
+        future = pool.submit(self._do_copy_shared, src, targets, rel, meta)
+        for transfers, _ in targets:
+            future.add_done_callback(transfers._done)
+
+    def _do_copy_shared(self, src, targets, rel, meta):
+        hashers = [hashlib.new(name) for name in COPY_DIGESTS]
+        failed = {}
+        dsts = []
+        for transfers, dst in targets:
+            try:
+                transfers._ensure_parent(str(dst))
+                dsts.append(dst)
+            except OSError as e:
+                failed[dst] = e
+        try:
+            failed.update(fanout_copy(src, dsts, meta['size'], hashers, self.throttle))
+        except Exception as e:
+            failed.update((dst, e) for dst in dsts)
+        digests = {h.name: h.hexdigest() for h in hashers} or None
+        for transfers, dst in targets:
+            error = failed.get(dst)
+            if error is None and VERIFY_COPIES and digests:
+                try:
+                    verify_copy(dst, hashers[0].name, digests[hashers[0].name])
+                    with transfers._lock:
+                        transfers.verified += 1
+                except Exception as e:
+                    error = e
+            if error is not None:
+                transfers._copy_failed(rel, error)
+                continue
+            with transfers._lock:
+                transfers.backends['fanout'] = transfers.backends.get('fanout', 0) + 1
+            transfers._copied(rel, meta, digests)
+
+    def _do_copy(self, src, dst, rel, meta, dst_side):
+        self._wrote(rel, dst_side)
+        hashers = [hashlib.new(name) for name in COPY_DIGESTS]
+        try:
+            self._ensure_parent(str(dst))
+            if DELTA_THRESHOLD and meta['size'] >= DELTA_THRESHOLD and delta_applicable(dst, meta['size']):
+                sigs, written, total = delta_copy(src, dst, self.store.get_signature(rel), hashers, self.throttle)
+                self.store.put_signature(rel, meta['mtime'], meta['size'], DELTA_BLOCK_SIZE, sigs)
+                with self._lock:
+                    self.delta_files += 1
+                    self.delta_blocks_written += written
+                    self.delta_blocks_total += total
+            elif RESUMABLE_THRESHOLD and meta['size'] >= RESUMABLE_THRESHOLD:
+                sigs = resumable_copy(src, dst, self.job.journal_dir, hashers, self.throttle)
+                self.store.put_signature(rel, meta['mtime'], meta['size'], DELTA_BLOCK_SIZE, sigs)
+            else:
+                backend, picked = copy_file(src, dst, meta['size'], self.calibration, hashers, self.throttle)
+                with self._lock:
+                    self.backends[backend] = self.backends.get(backend, 0) + 1
+                    if picked != backend:
+                        key = f"{picked} -> {backend}"
+                        self.backend_overrides[key] = self.backend_overrides.get(key, 0) + 1
+            digests = {h.name: h.hexdigest() for h in hashers} or None
+            if VERIFY_COPIES and digests:
+                verify_copy(dst, hashers[0].name, digests[hashers[0].name])
+                with self._lock:
+                    self.verified += 1
+        except Exception as e:
+            self._copy_failed(rel, e)
+            return
+        self._copied(rel, meta, digests)
+
+    def delete(self, file_path, direction):
+        """Queue a safe-delete into the job's deleted folder"""
+        self._submit(self._small, self._do_delete, file_path, direction)
+
+    def _do_delete(self, file_path, direction):
+        reasons = []
+        if safe_delete(file_path, self.job, direction, reasons):
+            with self._lock:
+                self.deletions += 1
+        else:
+            with self._lock:
+                self.delete_errors += 1
+                self._fail(str(file_path), "safe_delete", reasons[0] if reasons else "unknown")
+
+    def _fail(self, path, action, reason):
+        # Caller holds self._lock
+        if len(self.failures) < METRICS_MAX_FAILURES:
+            self.failures.append((path, action, str(reason)))
+
+    def summary(self):
+        """The counters of a queue run by a shard, for absorb() in the parent"""
+        with self._lock:
+            return {'copies': self.copies, 'bytes_copied': self.bytes_copied, 'deletions': self.deletions,
+                    'errors': self.errors, 'delete_errors': self.delete_errors, 'delta_files': self.delta_files,
+                    'delta_blocks_written': self.delta_blocks_written, 'delta_blocks_total': self.delta_blocks_total,
+                    'verified': self.verified, 'failures': list(self.failures), 'backends': dict(self.backends),
+                    'backend_overrides': dict(self.backend_overrides),
+                    'throttled_seconds': self.throttled_seconds + self.throttle.waited,
+                    'backoffs': self.backoffs + self.throttle.backoffs}
+
+    def absorb(self, summary):
+        with self._lock:
+            for name, value in summary.items():
+                if name == 'failures':
+                    for failure in value:
+                        self._fail(*failure)
+                elif name in ('backends', 'backend_overrides'):
+                    counts = getattr(self, name)
+                    for backend, n in value.items():
+                        counts[backend] = counts.get(backend, 0) + n
+                else:
+                    setattr(self, name, getattr(self, name) + value)
+
+    def drain(self):
+        """Wait for the actions submitted so far, leaving the queue open for more"""
+        with self._idle:
+            self._idle.wait_for(lambda: not self._outstanding)
+
+    def join(self):
+        """Wait for every action this queue submitted to finish"""
+        self.drain()
+        if self._owns_pools:
+            self._small.shutdown(wait=True)
+            self._large.shutdown(wait=True)
+
+def format_size(n):
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if n < 1024 or unit == "GB":
+            return f"{n:,} {unit}" if unit == "bytes" else f"{n:,.1f} {unit}"
+        n /= 1024
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+
+class Plan:
+    """The actions the diff decided on, with the byte totals the dry-run report and execution order use.
+
+    With a TransferQueue, unchanged files are handed to it as they are found, and with direct=True
+    so are copies and safe-deletes (scan order, nothing held in memory); otherwise those wait
+    for execute().
+    """
+
+    def __init__(self, transfers=None, direct=False):
+        self.transfers = transfers
+        self.direct = direct and transfers is not None
+        self.copies = []  # (src, dst, rel, meta, dst_side)
+        self.deletes = []  # (path, direction)
+        self.dropped = []  # Manifest entries no longer backed by a file on either side
+        self.unchanged = 0
+        self.renames = 0
+        self.copy_count = 0
+        self.copy_files = {'a': 0, 'b': 0}
+        self.copy_bytes = {'a': 0, 'b': 0}
+        self.growth = {'a': 0, 'b': 0}  # Extra space each side needs: new files plus files that grow
+        self.delete_count = 0
+        self.delete_bytes = 0
+
+    def copy(self, src, dst, rel, meta, dst_side, existing=None):
+        self.copy_count += 1
+        self.copy_files[dst_side] += 1
+        self.copy_bytes[dst_side] += meta['size']
+        # A sparse file's holes are copied as holes, so it needs only its allocated size
+        needed = allocated(meta) if SPARSE_COPIES else meta['size']
+        self.growth[dst_side] += max(0, needed - (allocated(existing) if existing else 0))
+        if self.direct:
+            self.transfers.copy(src, dst, rel, meta, dst_side)
+        else:
+            self.copies.append((src, dst, rel, meta, dst_side))
+
+    def delete(self, rel, file_path, direction, meta):
+        self.delete_count += 1
+        self.delete_bytes += meta['size']
+        self.dropped.append(rel)
+        if self.direct:
+            self.transfers.delete(file_path, direction)
+        else:
+            self.deletes.append((file_path, direction))
+
+    def keep(self, rel, meta, previous=None):
+        self.unchanged += 1
+        if self.transfers is not None:
+            self.transfers.keep(rel, meta, previous)
+
+    def forget(self, rel):
+        self.dropped.append(rel)
+
+    def summary(self):
+        """The counters of a plan run by a shard, for absorb() in the parent"""
+        return {'unchanged': self.unchanged, 'renames': self.renames, 'copy_count': self.copy_count,
+                'copy_files': self.copy_files, 'copy_bytes': self.copy_bytes, 'growth': self.growth,
+                'delete_count': self.delete_count, 'delete_bytes': self.delete_bytes}
+
+    def absorb(self, summary):
+        for name, value in summary.items():
+            if isinstance(value, dict):
+                for side, n in value.items():
+                    getattr(self, name)[side] += n
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def execute(self, order=PLAN_ORDER):
+        """Hand the held actions to the TransferQueue: safe-deletes first, then copies in the chosen order"""
+        for file_path, direction in self.deletes:
+            self.transfers.delete(file_path, direction)
+        copies = self.copies
+        if order == "smallest":
+            copies = sorted(copies, key=lambda c: c[3]['size'])
+        elif order == "largest":
+            copies = sorted(copies, key=lambda c: c[3]['size'], reverse=True)
+        for args in copies:
+            self.transfers.copy(*args)
+        self.deletes, self.copies = [], []
+
+    def free_space(self, job):
+        """(side, free bytes or None if unknown, bytes needed) for each side the plan writes to"""
+        result = []
+        for side, root in (('b', job.dest_path), ('a', job.source_path)):
+            if not self.growth[side]:
+                continue
+            try:
+                free = shutil.disk_usage(root).free
+            except OSError:
+                free = None
+            result.append((side.upper(), free, self.growth[side]))
+        return result
+
+    def report(self, job, throughput=None):
+        """Print the dry-run summary: actions, byte totals, free space and estimated copy time"""
+        print(f"Plan for {job.case_name}:")
+        print(f"  Copy A -> B:   {self.copy_files['b']:,} file(s), {format_size(self.copy_bytes['b'])}")
+        if job.bidirectional:
+            print(f"  Copy B -> A:   {self.copy_files['a']:,} file(s), {format_size(self.copy_bytes['a'])}")
+        print(f"  Safe-delete:   {self.delete_count:,} file(s), {format_size(self.delete_bytes)}")
+        if self.renames:
+            print(f"  Rename/move:   {self.renames:,} file(s)")
+        print(f"  Unchanged:     {self.unchanged:,} file(s)")
+        for side, free, needed in self.free_space(job):
+            if free is None:
+                print(f"  Free space on {side}: unknown, needs {format_size(needed)}")
+            else:
+                verdict = "OK" if free >= needed else "NOT ENOUGH SPACE"
+                print(f"  Free space on {side}: {format_size(free)}, needs {format_size(needed)} - {verdict}")
+        total = self.copy_bytes['a'] + self.copy_bytes['b']
+        # The bandwidth cap in force right now, if it is below what the job has managed uncapped
+        cap = min((rate for rate in (bucket.rate() for bucket in job_throttle(job).buckets) if rate), default=0)
+        if not total:
+            print("  Estimated copy time: nothing to copy")
+        elif cap and (not throughput or cap < throughput):
+            print(f"  Estimated copy time: {format_duration(total / cap)} at {format_size(cap)}/s (bandwidth cap)")
+        elif throughput:
+            print(f"  Estimated copy time: {format_duration(total / throughput)} at {format_size(int(throughput))}/s (measured)")
+        else:
+            print("  Estimated copy time: unknown until a run has measured this job's throughput")
+
+def reconcile(job, paths, curr_a, curr_b, last_state, a_accessible, b_accessible, plan, identical=()):
+    """Decide the action for each relative path and add it to plan; shared by sync() and watch mode"""
+    for rel in paths:
+        decide(job, rel, curr_a.get(rel), curr_b.get(rel), last_state.get(rel),
+               a_accessible, b_accessible, plan, rel in identical)
+
+def decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan, identical=False):
+    """Add the action for one path to plan, given its entry on each side and in the manifest (or None).
+
+    The single home of the sync rules: reconcile() feeds it from dicts, stream_diff() from a merge-join.
+    """
+    dir_a, dir_b = job.source_path, job.dest_path
+    p_a, p_b = dir_a / rel, dir_b / rel
+    in_a, in_b, in_l = meta_a is not None, meta_b is not None, meta_l is not None
+    # Excluded paths (our deleted folder among them) never get here from a scan: the walk skips
+    # them on both sides, so a manifest entry for one is simply forgotten below
+
+    if job.bidirectional:
+        # Bi-directional deletion logic with safety checks
+        if in_l and not in_a and in_b:
+            # File existed before, now only in B (deleted from A)
+            if b_accessible and p_b.exists():
+                plan.delete(rel, p_b, "A_to_B", meta_b)
+                return
+        elif in_l and not in_b and in_a:
+            # File existed before, now only in A (deleted from B)
+            if a_accessible and p_a.exists():
+                plan.delete(rel, p_a, "B_to_A", meta_a)
+                return
+    else:
+        # One-way deletion: only delete from destination if source doesn't have it
+        if in_l and not in_a and in_b:
+            # File existed before in source, now missing from source but in destination
+            if b_accessible and p_b.exists():
+                plan.delete(rel, p_b, "one_way", meta_b)
+                return
+    
+    # Copy from A to B if A is accessible
+    if in_a and a_accessible:
+        # Copy from A to B if B is accessible
+        if b_accessible and (not in_b or mtime_newer(meta_a, meta_b, job.mtime_tolerance)) and not identical:
+            plan.copy(p_a, p_b, rel, meta_a, 'b', meta_b)
+            return
+        elif not b_accessible and in_a:
+            # B not accessible, but A has file - keep in state
+            plan.keep(rel, meta_a, meta_l)
+            return
+        elif in_b:
+            # Already present on both sides - keep in state so later deletions propagate
+            plan.keep(rel, meta_a, meta_l)
+            return
+
+    # Bi-directional: copy from B to A if B is accessible
+    elif job.bidirectional and in_b and b_accessible:
+        if a_accessible and (not in_a or mtime_newer(meta_b, meta_a, job.mtime_tolerance)) and not identical:
+            plan.copy(p_b, p_a, rel, meta_b, 'a', meta_a)
+            return
+        elif not a_accessible and in_b:
+            # A not accessible, but B has file - keep in state
+            plan.keep(rel, meta_b, meta_l)
+            return
+
+    # No action: the path drops out of the manifest
+    if in_l:
+        plan.forget(rel)
+
+def _tagged(stream, index):
+    previous = None
+    for rel, meta in stream:
+        # Out of order, a path would look missing from this stream and be taken for a deletion
+        if previous is not None and rel <= previous:
+            raise ValueError(f"Streaming diff input out of order at {rel!r}")
+        previous = rel
+        yield rel, index, meta
+
+def merge_sorted(*streams):
+    """Merge-join streams of (rel, meta) sorted by rel: yields (rel, [meta or None from each stream])"""
+    current, metas = None, None
+    for rel, index, meta in heapq.merge(*(_tagged(stream, i) for i, stream in enumerate(streams))):
+        if rel != current:
+            if current is not None:
+                yield current, metas
+            current, metas = rel, [None] * len(streams)
+        metas[index] = meta
+    if current is not None:
+        yield current, metas
+
+def _rename_side(meta_a, meta_b, meta_l, bidirectional):
+    """Side ('a' or 'b') whose rename pairing may involve this path, or None.
+
+    A vanished file is in the manifest and on the destination side only; an appeared file is on
+    the source side only. Empty files are never paired.
+    """
+    if meta_l is not None:
+        if meta_a is None and meta_b is not None and meta_b['size'] > 0:
+            return 'b'
+        if bidirectional and meta_b is None and meta_a is not None and meta_a['size'] > 0:
+            return 'a'
+    else:
+        if meta_a is not None and meta_b is None and meta_a['size'] > 0:
+            return 'b'
+        if bidirectional and meta_b is not None and meta_a is None and meta_b['size'] > 0:
+            return 'a'
+    return None
+
+def _pair_held_renames(job, held, dst_side, digest, plan, dry_run):
+    """replay_renames() over the held rename candidates, updating held in place; returns the count"""
+    src, dst = (0, 1) if dst_side == 'b' else (1, 0)
+    vanished = {rel: m[dst] for rel, m in held.items() if m[2] is not None and m[src] is None and m[dst] is not None}
+    if not vanished:
+        return 0
+    appeared = {rel: m[src] for rel, m in held.items() if m[2] is None and m[src] is not None and m[dst] is None}
+    src_root, dst_root = (job.source_path, job.dest_path) if dst_side == 'b' else (job.dest_path, job.source_path)
+    pairs = pair_renames(vanished, appeared, src_root, dst_root, digest, job.mtime_tolerance)
+    if pairs and plan.direct:
+        # Renames must not race copies already started into the same directories
+        plan.transfers.drain()
+    done = apply_renames(pairs, dst_root, dry_run)
+    for old, new in done:
+        held[new][dst], held[old][dst] = held[old][dst], None
+    return len(done)
+
+def resolve_renames(job, held, a_accessible, b_accessible, plan, hashes, dry_run=False):
+    """Pair and replay the renames among held rename candidates (rel -> [meta_a, meta_b, meta_l]), then decide them all"""
+    digest = lambda path: hashes().digest(path)
+    plan.renames += _pair_held_renames(job, held, 'b', digest, plan, dry_run)
+    if job.bidirectional:
+        plan.renames += _pair_held_renames(job, held, 'a', digest, plan, dry_run)
+    for rel, (meta_a, meta_b, meta_l) in held.items():
+        decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan)
+
+def stream_diff(job, streams, a_accessible, b_accessible, plan, hashes, detect_renames=True, dry_run=False,
+                defer_renames=False):
+    """Decide every path by merge-joining sorted (rel, meta) streams of side A, side B and the manifest.
+
+    Makes the same decisions as content compare, replay_renames() and reconcile() on dicts, but
+    only holds back the paths whose decision depends on others: touched files, hashed in batches
+    of CONTENT_COMPARE_BATCH, and rename candidates, paired once the streams end. Past
+    RENAME_CANDIDATE_LIMIT candidates, renames are not detected this run. hashes() returns the
+    job's HashCache. Returns the files and bytes seen on each side and the content compare counts;
+    with defer_renames the rename candidates are returned undecided as well, under 'held'.
+    """
+    stats = {'a': [0, 0], 'b': [0, 0], 'touched': 0, 'identical': 0, 'held': {}, 'renames_skipped': False}
+    compare = CONTENT_COMPARE and a_accessible and b_accessible
+    touched = []  # (rel, meta_a, meta_b, meta_l) waiting to be hashed
+    held = {} if detect_renames and a_accessible and b_accessible else None  # rel -> [meta_a, meta_b, meta_l]
+
+    def decide_touched():
+        same = hashes().identical([t[0] for t in touched], job.source_path, job.dest_path)
+        stats['identical'] += len(same)
+        for rel, meta_a, meta_b, meta_l in touched:
+            decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan, rel in same)
+        touched.clear()
+
+    def decide_held():
+        for rel, (meta_a, meta_b, meta_l) in held.items():
+            decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan)
+
+    for rel, (meta_a, meta_b, meta_l) in merge_sorted(*streams):
+        for side, meta in (('a', meta_a), ('b', meta_b)):
+            if meta is not None:
+                stats[side][0] += 1
+                stats[side][1] += meta['size']
+        if (compare and meta_a is not None and meta_b is not None and
+                meta_a['size'] == meta_b['size'] and mtime_moved(meta_a, meta_b, job.mtime_tolerance)):
+            touched.append((rel, meta_a, meta_b, meta_l))
+            stats['touched'] += 1
+            if len(touched) >= CONTENT_COMPARE_BATCH:
+                decide_touched()
+            continue
+        if held is not None and _rename_side(meta_a, meta_b, meta_l, job.bidirectional):
+            if len(held) < RENAME_CANDIDATE_LIMIT:
+                held[rel] = [meta_a, meta_b, meta_l]
+                continue
+            print(f"More than {RENAME_CANDIDATE_LIMIT:,} possible renames; renames are not detected this run")
+            decide_held()
+            held = None
+            stats['renames_skipped'] = True
+        decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan)
+    if touched:
+        decide_touched()
+
+    if held and defer_renames:
+        stats['held'] = held
+    elif held:
+        resolve_renames(job, held, a_accessible, b_accessible, plan, hashes, dry_run)
+    return stats
+
+class RunMetrics:
+    """Phase timings and counters for one run, appended as a JSON line to <metrics_dir>/<case>.jsonl"""
+
+    def __init__(self, job, mode="full"):
+        self.job = job
+        self._started = time.monotonic()
+        self._lock_taken = None
+        self.record = {
+            'case': job.case_name,
+            'mode': mode,
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'status': 'ok',
+            'error': None,
+            'phases': {},
+            'scanned': {},
+        }
+
+    @contextmanager
+    def phase(self, name):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            phases = self.record['phases']
+            phases[name] = round(phases.get(name, 0) + time.monotonic() - started, 4)
+
+    def lock_taken(self):
+        self._lock_taken = time.monotonic()
+
+    def lock_released(self):
+        if self._lock_taken is not None:
+            self.record['lock_held_seconds'] = round(time.monotonic() - self._lock_taken, 4)
+
+    def scanned(self, side, files, size, dir_cache_hits=0):
+        self.record['scanned'][side] = {
+            'files': files,
+            'bytes': size,
+            'dir_cache_hits': dir_cache_hits,
+        }
+
+    def fail(self, status, error=None):
+        self.record['status'] = status
+        if error is not None:
+            self.record['error'] = f"{type(error).__name__}: {error}"
+
+    def planned(self, plan):
+        self.record['planned'] = {
+            'copies': plan.copy_count,
+            'bytes': plan.copy_bytes['a'] + plan.copy_bytes['b'],
+            'safe_deletes': plan.delete_count,
+            'renames': plan.renames,
+            'unchanged': plan.unchanged,
+        }
+
+    def transferred(self, transfers):
+        # Sharded runs copy most files inside the shards phase
+        seconds = self.record['phases'].get('transfer', 0) + self.record['phases'].get('shards', 0)
+        planned = self.record.get('planned', {})
+        self.record.update({
+            'copies': transfers.copies,
+            'bytes_copied': transfers.bytes_copied,
+            'throughput_bytes_per_second': int(transfers.bytes_copied / seconds) if seconds > 0 else None,
+            'safe_deletes': transfers.deletions,
+            'copy_errors': transfers.errors,
+            'delete_errors': transfers.delete_errors,
+            # Planned copies that did not happen this run and are left for the next one
+            'backlog': max(0, planned.get('copies', 0) - transfers.copies),
+            'delta_files': transfers.delta_files,
+            'delta_blocks_written': transfers.delta_blocks_written,
+            'copy_backends': dict(transfers.backends),
+            # Picked backends that were swapped for one that can hash while copying
+            'copy_backend_overrides': dict(transfers.backend_overrides),
+            'verified': transfers.verified,
+            # Seconds copy threads spent paced by the bandwidth caps (summed over threads), and adaptive halvings
+            'throttled_seconds': round(transfers.throttled_seconds + transfers.throttle.waited, 3),
+            'bandwidth_backoffs': transfers.backoffs + transfers.throttle.backoffs,
+            'failures': [{'path': p, 'action': a, 'reason': r} for p, a, r in transfers.failures],
+        })
+
+    def write(self):
+        """Append the record (and refresh the Prometheus textfile); never fails the run"""
+        self.record['finished'] = datetime.now().isoformat(timespec='seconds')
+        self.record['duration_seconds'] = round(time.monotonic() - self._started, 4)
+        if not METRICS_ENABLED:
+            return
+        try:
+            self.job.metrics_dir.mkdir(parents=True, exist_ok=True)
+            path = self.job.metrics_dir / f"{self.job.case_name}.jsonl"
+            if path.exists() and path.stat().st_size > METRICS_MAX_BYTES:
+                path.replace(path.with_name(path.name + ".1"))
+            with open(path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(self.record) + "\n")
+            # A run skipped for the lock leaves the last real run's figures (and timestamp) in place
+            if PROMETHEUS_TEXTFILE_DIR and self.record['status'] != 'locked':
+                write_prometheus_textfile(self.record)
+        except Exception as e:
+            print(f"Could not write run metrics: {e}")
+
+def prometheus_textfile_path(case_name):
+    """Where a case's textfile goes, or None when PROMETHEUS_TEXTFILE_DIR is not set"""
+    if not PROMETHEUS_TEXTFILE_DIR:
+        return None
+    safe_case = "".join(c if c.isalnum() or c in "-_" else "_" for c in case_name)
+    return Path(PROMETHEUS_TEXTFILE_DIR) / f"vaultmirror_{safe_case}.prom"
+
+def write_prometheus_textfile(record):
+    """Write a run's key figures for node_exporter's textfile collector (atomically, via rename)"""
+    case = record['case'].replace("\\", "\\\\").replace('"', '\\"')
+    label = f'case="{case}"'
+    scanned = record.get('scanned', {})
+    metrics = [
+        ("vaultmirror_last_run_timestamp_seconds", "gauge", "Unix time the last sync run finished", time.time()),
+        ("vaultmirror_last_run_success", "gauge", "1 if the last sync run completed without a run-level error",
+         1 if record['status'] == 'ok' else 0),
+        ("vaultmirror_sync_duration_seconds", "gauge", "Wall time of the last sync run", record.get('duration_seconds', 0)),
+        ("vaultmirror_lock_held_seconds", "gauge", "How long the last run held the job lock", record.get('lock_held_seconds', 0)),
+        ("vaultmirror_files_copied", "gauge", "Files copied by the last run", record.get('copies', 0)),
+        ("vaultmirror_bytes_copied", "gauge", "Bytes copied by the last run", record.get('bytes_copied', 0)),
+        ("vaultmirror_safe_deletes", "gauge", "Files moved to the deleted folder by the last run", record.get('safe_deletes', 0)),
+        ("vaultmirror_errors", "gauge", "Files that failed to copy or safe-delete in the last run",
+         record.get('copy_errors', 0) + record.get('delete_errors', 0)),
+        ("vaultmirror_backlog_files", "gauge", "Planned copies left undone by the last run", record.get('backlog', 0)),
+    ]
+    lines = []
+    for name, kind, help_text, value in metrics:
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}", f"{name}{{{label}}} {value}"]
+    for name, key, help_text in (("vaultmirror_files_scanned", "files", "Files found by the last scan"),
+                                 ("vaultmirror_bytes_scanned", "bytes", "Bytes found by the last scan")):
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+        lines += [f'{name}{{{label},side="{side}"}} {figures[key]}' for side, figures in scanned.items()]
+    name = "vaultmirror_phase_seconds"
+    lines += [f"# HELP {name} Time spent in each phase of the last run", f"# TYPE {name} gauge"]
+    lines += [f'{name}{{{label},phase="{phase}"}} {seconds}' for phase, seconds in record['phases'].items()]
+
+    path = prometheus_textfile_path(record['case'])
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp, path)
+
+def measured_throughput(store):
+    """Smoothed copy throughput (bytes/s) measured on earlier runs of this job, or None"""
+    value = store.get_meta('throughput')
+    return float(value) if value else None
+
+def record_throughput(store, bytes_copied, seconds):
+    """Fold this run's copy rate into the job's measured throughput"""
+    if bytes_copied < THROUGHPUT_MIN_SAMPLE_BYTES or seconds <= 0:
+        return
+    sample = bytes_copied / seconds
+    previous = measured_throughput(store)
+    store.put_meta('throughput', sample if previous is None else 0.7 * previous + 0.3 * sample)
+
+def top_level_names(job, store, a_accessible, b_accessible):
+    """Sorted names of every entry at the root of either side or of the manifest, skipping excluded ones"""
+    names = store.top_level_names()
+    for root, accessible in ((job.source_path, a_accessible), (job.dest_path, b_accessible)):
+        root = os.path.abspath(root)
+        if accessible and os.path.isdir(root):
+            _, files, subdirs, _, _ = _list_dir(root, "", job.exclusions, None)
+            names.update(files)
+            names.update(prefix[:-len(os.sep)] for _, prefix in subdirs)
+    return sorted(names)
+
+def assign_shards(names, count):
+    """Split top-level names into count lists, dealt out in sorted order (SHARD_BY "dirs") or by a stable hash ("hash")"""
+    shards = [[] for _ in range(count)]
+    for i, name in enumerate(names):
+        if SHARD_BY == "hash":
+            i = zlib.crc32(name.encode('utf-8', 'surrogateescape'))
+        shards[i % count].append(name)
+    return shards
+
+def _shard_settings():
+    # Tunables set on this module (by VaultMirror.py, the benchmark or a caller) must reach the workers
+    return {name: value for name, value in globals().items()
+            if name.isupper() and not name.startswith('_') and isinstance(value, (bool, int, float, str, tuple, list, dict, type(None)))}
+
+def _sync_shard(job, db_path, names, partition_path, a_accessible, b_accessible, detect_renames, full_rescan, settings):
+    """Worker process: stream-diff and transfer one shard's top-level names, writing its manifest partition"""
+    globals().update(settings)
+    store = ShardStore(db_path, partition_path, names)
+    transfers = TransferQueue(None, job, store, share=SYNC_SHARDS)
+    hash_cache = None
+    cache_a = cache_b = None
+
+    def hashes():
+        nonlocal hash_cache
+        if hash_cache is None:
+            hash_cache = HashCache(job.state_file.with_suffix(".hashes.db"))
+        return hash_cache
+
+    try:
+        plan = Plan(transfers, direct=PLAN_ORDER == "scan")
+        if DIR_CACHE_ENABLED:
+            cache_a = StreamingDirCache(store, 'a', full_rescan) if a_accessible else None
+            cache_b = StreamingDirCache(store, 'b', full_rescan) if b_accessible else None
+        top_level = set(names)
+        streams = (iter_tree(job.source_path, job.exclusions, dir_cache=cache_a, top_level=top_level)
+                   if a_accessible else iter(()),
+                   iter_tree(job.dest_path, job.exclusions, dir_cache=cache_b, top_level=top_level)
+                   if b_accessible else iter(()),
+                   store.iter_sorted())
+        stats = stream_diff(job, streams, a_accessible, b_accessible, plan, hashes, detect_renames, defer_renames=True)
+        plan.execute()
+        transfers.join()
+        store.commit_paths(plan.dropped + transfers.failed_rels)
+        for cache, side in ((cache_a, 'a'), (cache_b, 'b')):
+            if cache is not None:
+                cache.finish(transfers.written_dirs[side])
+    finally:
+        transfers.join()
+        for cache in (cache_a, cache_b):
+            if cache is not None:
+                cache.close()
+        store.close()
+        if hash_cache is not None:
+            hash_cache.close()
+    stats['hits'] = {'a': getattr(cache_a, 'hits', 0), 'b': getattr(cache_b, 'hits', 0)}
+    stats['plan'] = plan.summary()
+    stats['transfers'] = transfers.summary()
+    return stats
+
+def sync_shards(job, store, plan, a_accessible, b_accessible, hashes, detect_renames, full_rescan):
+    """Run a streaming sync of the job's top-level entries split across SYNC_SHARDS worker processes.
+
+    Each shard copies and safe-deletes its own paths and writes a manifest partition, merged into
+    store once every shard has finished. Rename candidates come back undecided and are paired here,
+    across all shards as in a serial run; their actions go into plan. The shards' counters are
+    added to plan and plan.transfers. Returns the combined scan and content compare stats.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    shards = [names for names in assign_shards(top_level_names(job, store, a_accessible, b_accessible), SYNC_SHARDS)
+              if names]
+    partitions = [job.state_file.with_suffix(f".shard{i}.db") for i in range(len(shards))]
+    stats = {'a': [0, 0], 'b': [0, 0], 'touched': 0, 'identical': 0, 'hits': {'a': 0, 'b': 0}}
+    held, renames_skipped, error = {}, False, None
+    store.checkpoint()
+    if shards:
+        # spawn: the workers must not inherit this process's threads, locks and open databases
+        with ProcessPoolExecutor(max_workers=len(shards), mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_sync_shard, job, store.db_path, names, partition, a_accessible, b_accessible,
+                                   detect_renames, full_rescan, _shard_settings())
+                       for names, partition in zip(shards, partitions)]
+            results = []
+            for future in futures:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f"Shard failed: {e}")
+                    error = error or e
+        # A failed shard's partition still records the copies it finished
+        for partition in partitions:
+            if partition.exists():
+                store.merge_partition(partition)
+        for result in results:
+            for side in ('a', 'b'):
+                stats[side][0] += result[side][0]
+                stats[side][1] += result[side][1]
+                stats['hits'][side] += result['hits'][side]
+            stats['touched'] += result['touched']
+            stats['identical'] += result['identical']
+            plan.absorb(result['plan'])
+            plan.transfers.absorb(result['transfers'])
+            held.update(result['held'])
+            renames_skipped = renames_skipped or result['renames_skipped']
+        if error is not None:
+            raise error
+
+    if len(held) > RENAME_CANDIDATE_LIMIT and not renames_skipped:
+        print(f"More than {RENAME_CANDIDATE_LIMIT:,} possible renames; renames are not detected this run")
+        renames_skipped = True
+    if renames_skipped:
+        for rel, (meta_a, meta_b, meta_l) in held.items():
+            decide(job, rel, meta_a, meta_b, meta_l, a_accessible, b_accessible, plan)
+    elif held:
+        resolve_renames(job, dict(sorted(held.items())), a_accessible, b_accessible, plan, hashes)
+    return stats
+
+class FanoutSource:
+    """The source side of a fan-out run, shared by the syncs of its destinations.
+
+    The source is scanned once for all of them. Each destination diffs on its own and hands its
+    plan to execute(), which waits (up to FANOUT_WAIT_SECONDS) for the others, so that a file
+    several destinations need is read once and written to all of them together.
+    """
+
+    def __init__(self, fanout_job, expected):
+        self.fanout_job = fanout_job
+        self._lock = threading.Lock()
+        self._tree = None
+        self._sorted = None
+        self._hashes = None
+        self._ready = threading.Condition()
+        self._expected = expected
+        self._arrived = []  # (job, plan, transfers)
+        self._state = "waiting"  # -> "dispatching" -> "done"
+
+    def tree(self):
+        """{rel: meta} of the source, scanned on first use (read-only: every destination shares it)"""
+        with self._lock:
+            if self._tree is None:
+                self._tree = get_tree_state(self.fanout_job.source_path, self.fanout_job.exclusions)
+            return self._tree
+
+    def sorted_tree(self):
+        """(rel, meta) of the source in rel order, for the streaming diff"""
+        tree = self.tree()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = sorted(tree.items())
+            return self._sorted
+
+    def hashes(self):
+        """HashCache shared by the destinations (kept beside the first one's manifest)"""
+        with self._lock:
+            if self._hashes is None:
+                self._hashes = HashCache(self.fanout_job.jobs[0].state_file.with_suffix(".hashes.db"))
+            return self._hashes
+
+    def close(self):
+        if self._hashes is not None:
+            self._hashes.close()
+
+    def execute(self, job, plan, transfers):
+        """Run a destination's plan: safe-deletes now, copies together with the other destinations"""
+        for file_path, direction in plan.deletes:
+            transfers.delete(file_path, direction)
+        plan.deletes = []
+        with self._ready:
+            late = self._state != "waiting"
+            dispatch = False
+            if not late:
+                self._arrived.append((job, plan, transfers))
+                self._ready.notify_all()
+                deadline = time.monotonic() + FANOUT_WAIT_SECONDS
+                while self._state == "waiting" and len(self._arrived) < self._expected:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                dispatch = self._state == "waiting"
+                if dispatch:
+                    self._state = "dispatching"
+                    arrived = list(self._arrived)
+                else:
+                    # Another destination is queueing the shared copies, this queue's among them
+                    self._ready.wait_for(lambda: self._state == "done")
+        if late:
+            print(f"[{job.case_name}] copying on its own, the other destinations have already started")
+            plan.execute()
+        elif dispatch:
+            try:
+                self._dispatch(arrived)
+            finally:
+                with self._ready:
+                    self._state = "done"
+                    self._ready.notify_all()
+
+    def _dispatch(self, arrived):
+        by_rel = {}
+        for _, plan, transfers in arrived:
+            for src, dst, rel, meta, dst_side in plan.copies:
+                by_rel.setdefault(rel, []).append((transfers, src, dst, meta, dst_side))
+            plan.copies = []
+        if PLAN_ORDER == "smallest":
+            order = sorted(by_rel, key=lambda rel: by_rel[rel][0][3]['size'])
+        elif PLAN_ORDER == "largest":
+            order = sorted(by_rel, key=lambda rel: by_rel[rel][0][3]['size'], reverse=True)
+        else:
+            order = sorted(by_rel)
+        for rel in order:
+            shared = []
+            for transfers, src, dst, meta, dst_side in by_rel[rel]:
+                # Delta and resumable copies work from each destination's own older copy
+                if transfers.plain_copy(dst, meta):
+                    shared.append((transfers, dst))
+                else:
+                    transfers.copy(src, dst, rel, meta, dst_side)
+            if len(shared) > 1:
+                shared[0][0].copy_shared(src, shared, rel, meta)
+            elif shared:
+                transfers, dst = shared[0]
+                transfers.copy(src, dst, rel, meta, dst_side)
+
+    def leave(self, job):
+        """A destination's sync is over; if it never reached execute() the others stop waiting for it"""
+        with self._ready:
+            if not any(arrived is job for arrived, _, _ in self._arrived):
+                self._expected -= 1
+                self._ready.notify_all()
+
+def sync(job, pools=None, dry_run=False, fanout=None, record=None):
+    """Run one full sync pass for a job (pools: shared TransferPools when run by the multi-job runner).
+
+    With dry_run the plan is reported and nothing is copied, deleted, renamed or purged. fanout
+    is the FanoutSource when the job is one destination of a FanoutJob. record, if given, is
+    updated with the run's metrics record (phase timings and counters) once the run is over,
+    whether or not METRICS_ENABLED writes it out; the benchmark times syncs this way.
+    """
+    lock_path = job.lock_file
+    metrics = RunMetrics(job)
+    if lock_path.exists(): 
+        print("Sync already in progress")
+        if fanout is not None:
+            fanout.leave(job)
+        if not dry_run:
+            metrics.fail("locked")
+            metrics.write()
+        if record is not None:
+            record.update(metrics.record)
+        return
+    
+    lock_path.touch()
+    metrics.lock_taken()
+    transfers = None
+    store = None
+    hash_cache = None
+    cache_a = cache_b = None
+    
+    try:
+        dir_a, dir_b = job.source_path, job.dest_path
+        state_path = job.state_file
+        deleted_root = job.deleted_root
+        
+        # Initialize deleted folder on destination drive
+        if not dry_run:
+            deleted_root.mkdir(parents=True, exist_ok=True)
+        
+        print(f"Deleted files stored at: {deleted_root}")
+        
+        # Check drive accessibility
+        a_accessible = is_drive_accessible(dir_a)
+        b_accessible = is_drive_accessible(dir_b)
+        
+        if not a_accessible and not b_accessible:
+            print("ERROR: Both drives inaccessible. Skipping sync.")
+            metrics.fail("drives_inaccessible")
+            return
+            
+        if not a_accessible:
+            print(f"WARNING: Source drive {dir_a} is inaccessible. Only copying from B to A if bidirectional.")
+            
+        if not b_accessible:
+            print(f"WARNING: Destination drive {dir_b} is inaccessible. Only copying from A to B if bidirectional.")
+        
+        # Purge old deletions before sync
+        if not dry_run:
+            with metrics.phase("purge"):
+                purged = purge_old_deletions(deleted_root, DELETION_GRACE_PERIOD_DAYS)
+                purge_stale_journals(job.journal_dir)
+            metrics.record['purged'] = purged
+            if purged > 0:
+                print(f"Purged {purged} old deleted files")
+        
+        with metrics.phase("state_load"):
+            store = open_state_store(state_path)
+            # Large SQLite manifests are diffed as sorted streams instead of loaded whole
+            last_count = store.count() if isinstance(store, SqliteStateStore) else None
+            # A sharded sync is a streaming sync split across processes; dry runs stay in this one
+            sharded = SYNC_SHARDS > 1 and last_count is not None and not dry_run and fanout is None
+            streaming = sharded or (last_count is not None and last_count >= STREAMING_DIFF_THRESHOLD)
+            if streaming:
+                store.load(count_run=not dry_run, entries=False)
+            else:
+                last_state = store.load(count_run=not dry_run)
+            # Recorded directory listings were filtered by the rules of their run, so new rules need a full rescan
+            rules_changed = store.get_meta('exclusion_rules') != job.exclusions.key
+            # Dry runs write nothing, so they go by the resolutions measured on earlier runs
+            detect_mtime_tolerance(job, store, a_accessible, b_accessible, probe=not dry_run)
+        metrics.record['mtime_tolerance'] = job.mtime_tolerance
+        if job.mtime_tolerance >= 0.001:
+            print(f"Coarse timestamps on one side: mtimes compared to within {job.mtime_tolerance:g}s")
+
+        def hashes():
+            nonlocal hash_cache
+            if hash_cache is None:
+                # Fan-out destinations share one cache, so a source file is hashed once for all of them
+                hash_cache = fanout.hashes() if fanout is not None else HashCache(state_path.with_suffix(".hashes.db"))
+            return hash_cache
+
+        # Unchanged files are staged as the diff finds them, so the queue exists before it
+        if not dry_run:
+            transfers = TransferQueue(None if streaming else {}, job, store, pools)
+        # Fan-out copies are held until every destination has its plan
+        plan = Plan(transfers, direct=streaming and PLAN_ORDER == "scan" and fanout is None)
+
+        if sharded:
+            full = rules_changed or (bool(DIR_CACHE_FULL_RESCAN_EVERY) and
+                                     store.run_number % DIR_CACHE_FULL_RESCAN_EVERY == 0)
+            # Each shard scans, diffs and copies its part; renames are paired across all of them here
+            with metrics.phase("shards"):
+                stats = sync_shards(job, store, plan, a_accessible, b_accessible, hashes,
+                                    DETECT_RENAMES and last_count > 0, full)
+            metrics.record['streaming'] = True
+            metrics.record['shards'] = SYNC_SHARDS
+            metrics.scanned('a', *stats['a'], stats['hits']['a'])
+            metrics.scanned('b', *stats['b'], stats['hits']['b'])
+            if CONTENT_COMPARE and a_accessible and b_accessible:
+                metrics.record['content_unchanged'] = stats['identical']
+                print(f"Content compare: {stats['identical']} of {stats['touched']} touched file(s) unchanged")
+            if plan.renames > 0:
+                print(f"Renamed/moved {plan.renames} file(s) in place")
+        elif streaming:
+            if DIR_CACHE_ENABLED:
+                full = rules_changed or (bool(DIR_CACHE_FULL_RESCAN_EVERY) and
+                                         store.run_number % DIR_CACHE_FULL_RESCAN_EVERY == 0)
+                cache_a = StreamingDirCache(store, 'a', full, save=not dry_run) if a_accessible and fanout is None else None
+                cache_b = StreamingDirCache(store, 'b', full, save=not dry_run) if b_accessible else None
+            # Scans, content compare, renames and decisions all happen in the one pass
+            with metrics.phase("diff"):
+                if not a_accessible:
+                    stream_a = iter(())
+                elif fanout is not None:
+                    stream_a = iter(fanout.sorted_tree())
+                else:
+                    stream_a = iter_tree(dir_a, job.exclusions, dir_cache=cache_a)
+                streams = (stream_a,
+                           iter_tree(dir_b, job.exclusions, dir_cache=cache_b) if b_accessible else iter(()),
+                           store.iter_sorted())
+                stats = stream_diff(job, streams, a_accessible, b_accessible, plan, hashes,
+                                    DETECT_RENAMES and last_count > 0, dry_run)
+            metrics.record['streaming'] = True
+            metrics.scanned('a', *stats['a'], getattr(cache_a, 'hits', 0))
+            metrics.scanned('b', *stats['b'], getattr(cache_b, 'hits', 0))
+            if CONTENT_COMPARE and a_accessible and b_accessible:
+                metrics.record['content_unchanged'] = stats['identical']
+                print(f"Content compare: {stats['identical']} of {stats['touched']} touched file(s) unchanged, {hash_cache.computed if hash_cache else 0} hashed")
+            if plan.renames > 0 and not dry_run:
+                print(f"Renamed/moved {plan.renames} file(s) in place")
+        else:
+            # Only scan accessible drives
+            cache_a = store.load_dir_cache('a', rules_changed) if a_accessible and fanout is None else None
+            cache_b = store.load_dir_cache('b', rules_changed) if b_accessible else None
+            with metrics.phase("scan_a"):
+                if not a_accessible:
+                    curr_a = {}
+                elif fanout is not None:
+                    curr_a = fanout.tree()
+                else:
+                    curr_a = get_tree_state(dir_a, job.exclusions, dir_cache=cache_a)
+            with metrics.phase("scan_b"):
+                curr_b = get_tree_state(dir_b, job.exclusions, dir_cache=cache_b) if b_accessible else {}
+            metrics.scanned('a', len(curr_a), sum(meta['size'] for meta in curr_a.values()), getattr(cache_a, 'hits', 0))
+            metrics.scanned('b', len(curr_b), sum(meta['size'] for meta in curr_b.values()), getattr(cache_b, 'hits', 0))
+
+            # Content-aware mode: files whose timestamps moved but whose bytes did not are not copied
+            identical = set()
+            if CONTENT_COMPARE and a_accessible and b_accessible:
+                with metrics.phase("content_compare"):
+                    candidates = [rel for rel, meta in curr_a.items()
+                                  if rel in curr_b and meta['size'] == curr_b[rel]['size']
+                                  and mtime_moved(meta, curr_b[rel], job.mtime_tolerance)]
+                    identical = hashes().identical(candidates, dir_a, dir_b)
+                metrics.record['content_unchanged'] = len(identical)
+                print(f"Content compare: {len(identical)} of {len(candidates)} touched file(s) unchanged, {hash_cache.computed} hashed")
+
+            # Renamed/moved files become renames on the other side rather than safe-delete + copy
+            if DETECT_RENAMES and a_accessible and b_accessible and last_state:
+                digest = lambda path: hashes().digest(path)
+                with metrics.phase("renames"):
+                    plan.renames += replay_renames(curr_a, curr_b, last_state, dir_a, dir_b, digest, dry_run,
+                                                   job.mtime_tolerance)
+                    if job.bidirectional:
+                        plan.renames += replay_renames(curr_b, curr_a, last_state, dir_b, dir_a, digest, dry_run,
+                                                       job.mtime_tolerance)
+                if plan.renames > 0 and not dry_run:
+                    print(f"Renamed/moved {plan.renames} file(s) in place")
+
+            with metrics.phase("diff"):
+                all_paths = set(curr_a.keys()) | set(curr_b.keys()) | set(last_state.keys())
+                reconcile(job, all_paths, curr_a, curr_b, last_state, a_accessible, b_accessible, plan, identical)
+        metrics.planned(plan)
+        
+        if dry_run:
+            plan.report(job, measured_throughput(store))
+            return
+        for side, free, needed in plan.free_space(job):
+            if free is not None and free < needed:
+                print(f"WARNING: {side} has {format_size(free)} free but the planned copies need {format_size(needed)}")
+        
+        with metrics.phase("transfer"):
+            if fanout is not None:
+                fanout.execute(job, plan, transfers)
+            else:
+                plan.execute()
+            # State is written only after every queued copy has completed
+            transfers.join()
+        metrics.transferred(transfers)
+        record_throughput(store, transfers.bytes_copied,
+                          metrics.record['phases']['transfer'] + metrics.record['phases'].get('shards', 0))
+        with metrics.phase("state_save"):
+            if streaming:
+                store.commit_paths(plan.dropped + transfers.failed_rels)
+                for cache, side in ((cache_a, 'a'), (cache_b, 'b')):
+                    if cache is not None:
+                        cache.finish(transfers.written_dirs[side])
+                if sharded:
+                    for side in ('a', 'b'):
+                        store.put_dir_listings(side, [], transfers.written_dirs[side])
+            else:
+                store.finish(transfers.new_state)
+                store.save_dir_cache('a', cache_a, transfers.written_dirs['a'])
+                store.save_dir_cache('b', cache_b, transfers.written_dirs['b'])
+            # A side that was not scanned keeps listings filtered by the old rules
+            if a_accessible and b_accessible:
+                store.put_meta('exclusion_rules', job.exclusions.key)
+            
+        if transfers.delta_files > 0:
+            print(f"Delta transfer: rewrote {transfers.delta_blocks_written:,} of {transfers.delta_blocks_total:,} block(s) in {transfers.delta_files} large file(s)")
+        throttled = transfers.throttled_seconds + transfers.throttle.waited
+        if throttled >= 1:
+            backoffs = transfers.backoffs + transfers.throttle.backoffs
+            print(f"Bandwidth cap: copy threads waited {format_duration(throttled)} in total"
+                  + (f", backed off {backoffs} time(s) for other disk activity" if backoffs else ""))
+        if transfers.errors > 0:
+            print(f"WARNING: {transfers.errors} file(s) failed to copy and will be retried next run")
+        if transfers.deletions > 0:
+            print(f"SAFE DELETE: Moved {transfers.deletions} file(s) to {deleted_root}")
+            print(f"Files will be permanently deleted after {DELETION_GRACE_PERIOD_DAYS} days.")
+            
+    except Exception as e:
+        print(f"Sync error: {e}")
+        metrics.fail("error", e)
+    finally:
+        if transfers is not None:
+            transfers.join()
+            if 'copies' not in metrics.record:
+                metrics.transferred(transfers)
+        for cache in (cache_a, cache_b):
+            if isinstance(cache, StreamingDirCache):
+                cache.close()
+        if store is not None:
+            store.close()
+        if hash_cache is not None and fanout is None:
+            hash_cache.close()
+        if lock_path.exists(): 
+            lock_path.unlink()
+        metrics.lock_released()
+        if fanout is not None:
+            fanout.leave(job)
+        if not dry_run:
+            metrics.write()
+        if record is not None:
+            record.update(metrics.record)
+
+def sync_fanout(fanout_job, pools=None, dry_run=False):
+    """Sync every destination of a FanoutJob, scanning the source once and reading each copied file once.
+
+    The destinations sync side by side, each with its own lock, manifest, deleted folder and
+    metrics; one that is slow or disconnected is left behind rather than waited on.
+    """
+    source = FanoutSource(fanout_job, len(fanout_job.jobs))
+    owns_pools = pools is None and not dry_run
+    if owns_pools:
+        pools = TransferPools(COPY_WORKERS_SMALL, COPY_WORKERS_LARGE)
+    try:
+        if dry_run:
+            for job in fanout_job.jobs:
+                sync(job, dry_run=True, fanout=source)
+            return
+        with ThreadPoolExecutor(max_workers=len(fanout_job.jobs)) as runner:
+            for future in [runner.submit(sync, job, pools, False, source) for job in fanout_job.jobs]:
+                future.result()
+    finally:
+        source.close()
+        if owns_pools:
+            pools.shutdown()
+
+def scan_paths(root, rels, exclusions=None):
+    """Current state of specific relative paths (files or whole directories) under root"""
+    state = {}
+    exclusions = exclusions or ExclusionRules()
+    for rel in rels:
+        path = os.path.join(root, rel)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if exclusions.excludes_path(rel, is_dir=True):
+                continue
+            stack = [(path, rel + os.sep)]
+            while stack:
+                _, files, subdirs, _, _ = _list_dir(*stack.pop(), exclusions, None)
+                state.update(files)
+                stack.extend(subdirs)
+        elif stat.S_ISREG(st.st_mode) and not exclusions.excludes_path(rel):
+            state[rel] = {'mtime': st.st_mtime, 'size': st.st_size}
+    return state
+
+IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+IN_DELETE_SELF, IN_MOVE_SELF, IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x400, 0x800, 0x4000, 0x8000, 0x40000000
+
+class InotifyWatcher:
+    """Recursive inotify watch (Linux) putting changed relative paths on a queue; None means rescan all"""
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    def __init__(self, root, events, exclusions=None):
+        import ctypes
+        self.root = os.path.abspath(root)
+        self.events = events
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.exclusions = exclusions or ExclusionRules()
+        self.watches = {}  # wd -> rel prefix ("" for the root, else "dir" + os.sep)
+        self._add_tree(self.root, "")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _add_tree(self, path, rel_prefix):
+        stack = [(path, rel_prefix)]
+        while stack:
+            dir_path, prefix = stack.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.MASK)
+            if wd < 0:
+                continue
+            self.watches[wd] = prefix
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and \
+                                not self.exclusions.excludes_dir(prefix + entry.name, entry.name):
+                            stack.append((entry.path, prefix + entry.name + os.sep))
+            except OSError:
+                pass
+
+    def _drop_tree(self, rel_prefix):
+        for wd, prefix in list(self.watches.items()):
+            if prefix.startswith(rel_prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                self.watches.pop(wd, None)
+
+    def _run(self):
+        import struct
+        while True:
+            data = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+                name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+                offset += 16 + length
+                if mask & IN_Q_OVERFLOW:
+                    self.events.put(None)
+                    continue
+                prefix = self.watches.get(wd)
+                if prefix is None:
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if not name:
+                    # Event on a watched directory itself; the root going away needs a full pass
+                    self.events.put(prefix.rstrip(os.sep) or None)
+                    continue
+                rel = prefix + name
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        self._drop_tree(rel + os.sep)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        if self.exclusions.excludes_dir(rel, name):
+                            continue
+                        self._add_tree(os.path.join(self.root, rel), rel + os.sep)
+                self.events.put(rel)
+
+class PollingWatcher:
+    """Fallback watcher: rescans root every WATCH_POLL_SECONDS and reports the paths that changed"""
+
+    def __init__(self, root, events, exclusions=None):
+        self.root = root
+        self.events = events
+        self.exclusions = exclusions
+        self.snapshot = get_tree_state(root, exclusions)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(WATCH_POLL_SECONDS)
+            current = get_tree_state(self.root, self.exclusions)
+            for rel in current.keys() | self.snapshot.keys():
+                if current.get(rel) != self.snapshot.get(rel):
+                    self.events.put(rel)
+            self.snapshot = current
+
+def start_watcher(root, events, exclusions=None):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, events, exclusions)
+        except (OSError, AttributeError) as e:
+            print(f"inotify unavailable for {root} ({e}), polling instead")
+    return PollingWatcher(root, events, exclusions)
+
+def sync_paths(job, rels, manifest):
+    """Apply the sync() decision logic to the given relative paths only (watch mode).
+
+    manifest is the in-memory state, updated in place. Returns False if the job lock is busy.
+    """
+    lock_path = job.lock_file
+    if lock_path.exists():
+        return False
+    lock_path.touch()
+    metrics = RunMetrics(job, "watch")
+    metrics.lock_taken()
+    transfers = None
+    store = None
+    hash_cache = None
+
+    try:
+        dir_a, dir_b = job.source_path, job.dest_path
+        state_path = job.state_file
+        a_accessible = is_drive_accessible(dir_a)
+        b_accessible = is_drive_accessible(dir_b)
+        if not a_accessible and not b_accessible:
+            return True
+
+        curr_a = scan_paths(dir_a, rels, job.exclusions) if a_accessible else {}
+        curr_b = scan_paths(dir_b, rels, job.exclusions) if b_accessible else {}
+        prefixes = tuple(rel + os.sep for rel in rels)
+        last_state = {rel: meta for rel, meta in manifest.items() if rel in rels or rel.startswith(prefixes)}
+
+        store = open_state_store(state_path)
+        detect_mtime_tolerance(job, store, a_accessible, b_accessible)
+        if DETECT_RENAMES and a_accessible and b_accessible and last_state:
+            def digest(path):
+                nonlocal hash_cache
+                if hash_cache is None:
+                    hash_cache = HashCache(state_path.with_suffix(".hashes.db"))
+                return hash_cache.digest(path)
+            replay_renames(curr_a, curr_b, last_state, dir_a, dir_b, digest, tolerance=job.mtime_tolerance)
+            if job.bidirectional:
+                replay_renames(curr_b, curr_a, last_state, dir_b, dir_a, digest, tolerance=job.mtime_tolerance)
+
+        paths = set(curr_a) | set(curr_b) | set(last_state)
+        new_state = {}
+        transfers = TransferQueue(new_state, job, store)
+        plan = Plan(transfers)
+        reconcile(job, paths, curr_a, curr_b, last_state, a_accessible, b_accessible, plan)
+        metrics.planned(plan)
+        with metrics.phase("transfer"):
+            plan.execute()
+            transfers.join()
+        metrics.transferred(transfers)
+
+        removed = [rel for rel in last_state if rel not in new_state]
+        manifest.update(new_state)
+        for rel in removed:
+            manifest.pop(rel, None)
+        store.commit_paths(removed, manifest)
+        # Only the listings we wrote into are known to be stale; mtime checks catch the rest
+        store.save_dir_cache('a', DirCache(), transfers.written_dirs['a'])
+        store.save_dir_cache('b', DirCache(), transfers.written_dirs['b'])
+        if transfers.copies or transfers.deletions or transfers.errors:
+            print(f"[{datetime.now():%H:%M:%S}] {len(rels)} changed path(s): {transfers.copies} copied, "
+                  f"{transfers.deletions} safe-deleted, {transfers.errors} failed")
+    except Exception as e:
+        print(f"Watch sync error: {e}")
+        metrics.fail("error", e)
+    finally:
+        if transfers is not None:
+            transfers.join()
+        if store is not None:
+            store.close()
+        if hash_cache is not None:
+            hash_cache.close()
+        if lock_path.exists():
+            lock_path.unlink()
+        metrics.lock_released()
+        # Only batches that did (or failed to do) something are worth a line
+        if metrics.record['status'] != 'ok' or metrics.record.get('copies') or metrics.record.get('safe_deletes') \
+                or metrics.record.get('copy_errors') or metrics.record.get('delete_errors'):
+            metrics.write()
+    return True
+
+def load_manifest(job):
+    store = open_state_store(job.state_file)
+    try:
+        return dict(store.load())
+    finally:
+        store.close()
+
+def watch(job):
+    """Long-running mode: sync only the paths touched by filesystem events, plus periodic full passes"""
+    import queue
+    dir_a, dir_b = job.source_path, job.dest_path
+    sync(job)
+    manifest = load_manifest(job)
+    events = queue.Queue()
+    for root in (dir_a, dir_b):
+        if is_drive_accessible(root):
+            start_watcher(root, events, job.exclusions)
+    print(f"Watching {dir_a} and {dir_b} (Ctrl+C to stop)")
+
+    pending = set()
+    first_event = last_event = None
+    full_pass = False
+    next_reconcile = time.monotonic() + WATCH_RECONCILE_SECONDS
+    while True:
+        now = time.monotonic()
+        timeout = WATCH_DEBOUNCE_SECONDS if pending else max(0.1, next_reconcile - now)
+        try:
+            rel = events.get(timeout=timeout)
+            # Coalesce: duplicates collapse in the set, the quiet period restarts
+            if rel is None:
+                full_pass = True
+            else:
+                pending.add(rel)
+            last_event = time.monotonic()
+            first_event = first_event or last_event
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        if full_pass or now >= next_reconcile:
+            sync(job)
+            manifest = load_manifest(job)
+            pending.clear()
+            first_event = last_event = None
+            full_pass = False
+            next_reconcile = now + WATCH_RECONCILE_SECONDS
+        elif pending and (now - last_event >= WATCH_DEBOUNCE_SECONDS or now - first_event >= WATCH_MAX_DELAY_SECONDS):
+            batch, pending = pending, set()
+            first_event = last_event = None
+            if not sync_paths(job, batch, manifest):
+                # A scheduled run holds the lock; retry the batch once it is done
+                pending |= batch
+                first_event = last_event = time.monotonic()
+
+def device_key(path):
+    """Identify the physical drive a path lives on, so jobs sharing it can be kept apart"""
+    p = Path(path)
+    for candidate in (p, *p.parents):
+        try:
+            dev = os.stat(candidate).st_dev
+        except OSError:
+            continue
+        if hasattr(os, 'major'):
+            # Partitions of one disk share its spindle; sysfs names the whole disk (Linux)
+            sysfs = f"/sys/dev/block/{os.major(dev)}:{os.minor(dev)}"
+            if os.path.exists(sysfs + "/partition"):
+                return "disk:" + os.path.basename(os.path.dirname(os.path.realpath(sysfs)))
+        return f"dev:{dev}"
+    # Disconnected drive: fall back to its letter/mount so it still groups with its other jobs
+    return "drive:" + (p.anchor.upper() or str(p))
+
+def _dest_paths(job):
+    return job.dest_paths if isinstance(job, FanoutJob) else [job.dest_path]
+
+def run_jobs(jobs, workers=RUNNER_JOBS, dry_run=False):
+    """Sync several jobs concurrently on one shared copy pool.
+
+    A job starts only when every drive it touches (source and destination) has a free slot, so
+    jobs on different drives run in parallel and jobs on the same drive take turns.
+    """
+    slots = {}
+    for path, n in DEVICE_JOB_SLOTS_OVERRIDES.items():
+        slots[device_key(path)] = n
+    in_use = {}
+    pending = [(job, {device_key(path) for path in (job.source_path, *_dest_paths(job))}) for job in jobs]
+    pools = TransferPools(RUNNER_COPY_WORKERS, RUNNER_LARGE_COPY_WORKERS)
+
+    def run(job):
+        started = time.monotonic()
+        print(f"[{job.case_name}] sync started")
+        if isinstance(job, FanoutJob):
+            sync_fanout(job, pools, dry_run)
+        else:
+            sync(job, pools, dry_run)
+        print(f"[{job.case_name}] sync finished in {time.monotonic() - started:.1f}s")
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as runner:
+            running = {}
+            while pending or running:
+                # Start every waiting job whose drives all have room, in config order
+                for item in list(pending):
+                    if len(running) >= workers:
+                        break
+                    job, devices = item
+                    if all(in_use.get(d, 0) < slots.get(d, DEVICE_JOB_SLOTS) for d in devices):
+                        for d in devices:
+                            in_use[d] = in_use.get(d, 0) + 1
+                        pending.remove(item)
+                        running[runner.submit(run, job)] = devices
+                if not running:
+                    # Only reachable if a drive is configured with 0 slots
+                    print(f"Skipping {len(pending)} job(s) on drives with no slots")
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for d in running.pop(future):
+                        in_use[d] -= 1
+                    if future.exception() is not None:
+                        print(f"Job failed: {future.exception()}")
+    finally:
+        pools.shutdown()
+
+def run_job(config_path, watch_mode=False, dry_run=False):
+    """Entry point for scheduled runs: load the job config and sync (or watch, or dry-run) it"""
+    job = load_job(config_path)
+    if isinstance(job, FanoutJob):
+        if watch_mode:
+            print("Watch mode does not support jobs with several destinations; running one sync instead")
+        sync_fanout(job, dry_run=dry_run)
+    elif dry_run:
+        sync(job, dry_run=True)
+    elif watch_mode:
+        try:
+            watch(job)
+        except KeyboardInterrupt:
+            pass
+    else:
+        sync(job)
+
+def run_many(config_paths, dry_run=False):
+    """Entry point for the multi-job runner: sync every given job config through run_jobs()"""
+    jobs = []
+    for config_path in config_paths:
+        try:
+            jobs.append(load_job(config_path))
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Skipping job config {config_path}: {e}")
+    run_jobs(jobs, dry_run=dry_run)
+
+if __name__ == "__main__":
+    paths = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if len(paths) > 1:
+        run_many(paths, "--dry-run" in sys.argv)
+    elif paths:
+        run_job(paths[0], "--watch" in sys.argv, "--dry-run" in sys.argv)
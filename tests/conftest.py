@@ -0,0 +1,22 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The engine is a flat module beside VaultMirror.py, not an installed package
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import VaultMirrorEngine as engine
+
+
+@pytest.fixture(autouse=True)
+def quiet_engine(monkeypatch):
+    monkeypatch.setattr(engine, "METRICS_ENABLED", False)
+
+
+@pytest.fixture(params=["dict", "streaming"])
+def mode(request, monkeypatch):
+    """Run the test against the in-memory diff and the streaming diff"""
+    if request.param == "streaming":
+        monkeypatch.setattr(engine, "STREAMING_DIFF_THRESHOLD", 0)
+    return request.param
@@ -0,0 +1,50 @@
+"""Building blocks for tests that run real syncs in a temp directory"""
+import os
+import time
+
+import VaultMirrorEngine as engine
+
+AGED = time.time() - 3600  # Well past DIR_CACHE_RACY_SECONDS, so listings are recorded and reused
+
+
+def make_job(base, name="case", **config):
+    src, dst = base / "A", base / "B"
+    src.mkdir(parents=True, exist_ok=True)
+    dst.mkdir(parents=True, exist_ok=True)
+    return engine.Job({
+        'case_name': name,
+        'source_path': str(src),
+        'dest_path': str(dst),
+        'bidirectional': False,
+        'state_file': str(base / f"{name}.json"),
+        'lock_file': str(base / f"{name}.lock"),
+        'deleted_root': str(base / "deleted"),
+        **config,
+    })
+
+
+def write(path, data, mtime=AGED):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+    os.utime(path, (mtime, mtime))
+
+
+def age_dirs(root):
+    for dir_path, _, _ in os.walk(root):
+        os.utime(dir_path, (AGED, AGED))
+
+
+def tree(root):
+    return {p.relative_to(root).as_posix(): p.read_bytes() for p in root.rglob("*") if p.is_file()}
+
+
+def run(job, **kwargs):
+    record = {}
+    engine.sync(job, record=record, **kwargs)
+    assert record['status'] == 'ok', record['error']
+    return record
+
+
+def deleted_files(job):
+    return [p for p in job.deleted_root.rglob("*") if p.is_file()
+            and not p.name.endswith(".meta.json") and not p.name.startswith(engine.DELETED_INDEX_NAME)]
@@ -0,0 +1,124 @@
+"""Bandwidth caps, time-of-day profiles and adaptive backoff (user-024)"""
+import os
+from datetime import datetime
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import make_job, run, tree, write
+
+MB = 1024 * 1024
+
+
+class Clock:
+    """Stands in for the time module inside the engine: sleeping just moves the clock on"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    perf_counter = time = monotonic
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(engine, "time", clock)
+    return clock
+
+
+def at(hhmm):
+    hours, minutes = map(int, hhmm.split(":"))
+    return datetime(2026, 1, 5, hours, minutes)
+
+
+@pytest.mark.parametrize("now, expected", [
+    ("09:30", 20), ("17:59", 20),
+    # The overnight window runs past midnight
+    ("18:00", 0), ("23:00", 0), ("07:59", 0),
+    # The first matching window wins
+    ("12:15", 20),
+])
+def test_scheduled_rate(now, expected):
+    profiles = [("08:00", "18:00", 20), ("18:00", "08:00", 0), ("12:00", "13:00", 5)]
+    assert engine.scheduled_rate(50, profiles, at(now)) == expected * MB
+
+
+def test_scheduled_rate_without_profiles():
+    assert engine.scheduled_rate(0, ()) == 0
+    assert engine.scheduled_rate(2.5, ()) == int(2.5 * MB)
+    assert engine.scheduled_rate(50, [("08:00", "09:00", 20)], at("10:00")) == 50 * MB
+
+
+def test_bucket_paces_to_its_cap(clock):
+    bucket = engine.TokenBucket(4)
+    started = clock.now
+    slept = sum(bucket.take(64 * 1024) for _ in range(16 * 16))
+    # 16 MB at 4 MB/s, less the burst the bucket allows
+    assert 4 - engine.BANDWIDTH_BURST_SECONDS <= clock.now - started <= 4
+    assert slept == pytest.approx(clock.now - started)
+
+
+def test_idle_bucket_builds_only_a_limited_burst(clock):
+    bucket = engine.TokenBucket(4)
+    clock.sleep(3600)
+    assert bucket.take(int(4 * MB * engine.BANDWIDTH_BURST_SECONDS)) == 0
+    assert bucket.take(4 * MB) == pytest.approx(1.0)
+
+
+def test_uncapped_and_shared_buckets(clock):
+    assert not engine.TokenBucket().active
+    assert engine.TokenBucket().take(100 * MB) == 0
+    assert engine.TokenBucket(10, share=4).rate() == int(10 * MB) // 4
+
+
+def feed(bucket, clock, seconds, seconds_per_mb):
+    """Copy 1 MB reads through bucket for seconds of clock time, each read taking seconds_per_mb"""
+    end = clock.now + seconds
+    while clock.now < end:
+        clock.sleep(seconds_per_mb)
+        bucket.take(MB, seconds_per_mb)
+
+
+def test_adaptive_backs_off_while_reads_are_slow(clock):
+    bucket = engine.TokenBucket(adaptive=True)
+    feed(bucket, clock, 5, 0.01)
+    assert bucket.rate() == 0 and bucket.backoffs == 0
+
+    # Reads ten times slower than usual: someone else is using the disk
+    feed(bucket, clock, 1.5, 0.1)
+    assert bucket.backoffs == 1
+    first = bucket.rate()
+    assert 0 < first < 10 * MB
+    feed(bucket, clock, 20, 0.1)
+    floor = int(engine.BANDWIDTH_MIN_MB_PER_S * MB)
+    assert bucket.rate() == floor
+    backoffs = bucket.backoffs
+    feed(bucket, clock, 5, 0.1)
+    assert bucket.backoffs == backoffs  # Already at the floor: nothing more to back off
+
+    # Fast again: the rate creeps back up until it no longer limits anything
+    feed(bucket, clock, 60, 0.01)
+    assert bucket.rate() == 0
+
+
+def test_job_throttle(tmp_path, monkeypatch):
+    assert not engine.job_throttle(make_job(tmp_path))
+    capped = engine.job_throttle(make_job(tmp_path, bandwidth_mb_per_s=5))
+    assert capped and capped.buckets[0].rate() == 5 * MB
+    monkeypatch.setattr(engine, "BANDWIDTH_MB_PER_S", 3)
+    rates = [bucket.rate() for bucket in engine.job_throttle(make_job(tmp_path), share=3).buckets]
+    assert rates == [MB]
+
+
+def test_capped_sync_is_paced(tmp_path):
+    job = make_job(tmp_path, bandwidth_mb_per_s=8)
+    write(job.source_path / "image.dd", os.urandom(6 * MB))
+    record = run(job)
+    assert tree(job.dest_path) == tree(job.source_path)
+    assert record['throttled_seconds'] > 0.1
@@ -0,0 +1,49 @@
+"""sync()'s record hook and the benchmark built on it (user-014)"""
+import VaultMirrorBench as bench
+import VaultMirrorEngine as engine
+from helpers import make_job, run, write
+
+
+def test_record_hook_returns_phases(tmp_path):
+    job = make_job(tmp_path)
+    write(job.source_path / "a.txt", b"one")
+    record = run(job)
+    assert {'purge', 'state_load', 'transfer', 'state_save'} <= set(record['phases'])
+    assert record['scanned']['a']['files'] == 1
+    assert record['copies'] == 1
+
+
+def test_locked_job_fills_record(tmp_path):
+    job = make_job(tmp_path)
+    job.lock_file.touch()
+    record = {}
+    engine.sync(job, record=record)
+    assert record['status'] == 'locked'
+
+
+def test_timed_sync_counts_a_pass(tmp_path, capsys):
+    job = make_job(tmp_path)
+    for i in range(5):
+        write(job.source_path / f"f{i}.bin", b"x" * 100)
+    result = bench.timed_sync(job)
+    assert result['counts']['copies'] == 5
+    assert result['counts']['bytes_copied'] == 500
+    assert result['total'] == round(sum(result['phases'].values()), 4)
+    # The engine's own output stays out of the bench's
+    assert capsys.readouterr().out == ""
+
+    (job.source_path / "f0.bin").unlink()
+    result = bench.timed_sync(job, purge=True)
+    assert result['counts']['deletes'] == 1
+    assert result['counts']['purged'] == 1
+    assert list(job.deleted_root.rglob("*.bin")) == []
+
+
+def test_compare_flags_slower_phases():
+    def results(**phases):
+        return {'scale': 0.01, 'scenarios': {'tiny': {'noop': {'phases': phases}}}}
+    baseline = results(scan_a=1.0, diff=1.0, purge=0.001)
+    regressions = bench.compare(results(scan_a=1.5, diff=1.1, purge=0.04), baseline)
+    # diff is within the threshold and purge is below timer noise
+    assert regressions == ["tiny/noop/scan_a: 1.000s -> 1.500s (+50%)"]
+    assert bench.compare(results(scan_a=0.5), baseline) == []
@@ -0,0 +1,51 @@
+"""Deleted-files index and purging past the grace period (user-010)"""
+import json
+import os
+import time
+
+import VaultMirrorEngine as engine
+from helpers import deleted_files, make_job, run, write
+
+
+def test_purge_keeps_rows_of_failed_unlinks(tmp_path, monkeypatch):
+    job = make_job(tmp_path)
+    for name in ("keep.txt", "stuck.txt", "gone.txt"):
+        write(job.source_path / name, name.encode())
+    run(job)
+    (job.source_path / "stuck.txt").unlink()
+    (job.source_path / "gone.txt").unlink()
+    run(job)
+    stored = deleted_files(job)
+    assert len(stored) == 2
+    stuck = next(str(p) for p in stored if p.read_bytes() == b"stuck.txt")
+
+    unlink = os.unlink
+    def failing_unlink(path, *args, **kwargs):
+        if str(path) == stuck:
+            raise PermissionError(13, "Permission denied", path)
+        return unlink(path, *args, **kwargs)
+    monkeypatch.setattr(engine.os, "unlink", failing_unlink)
+    assert engine.purge_old_deletions(job.deleted_root, 0) == 1
+    assert [str(p) for p in deleted_files(job)] == [stuck]
+
+    monkeypatch.setattr(engine.os, "unlink", unlink)
+    assert engine.purge_old_deletions(job.deleted_root, 0) == 1
+    assert deleted_files(job) == []
+    assert engine.purge_old_deletions(job.deleted_root, 0) == 0
+
+
+def test_existing_sidecars_are_indexed(tmp_path):
+    deleted_root = tmp_path / "deleted"
+    old, recent = deleted_root / "one_way" / "20200101" / "old.txt", deleted_root / "one_way" / "20200102" / "recent.txt"
+    for stored, age_days in ((old, 40), (recent, 1)):
+        stored.parent.mkdir(parents=True)
+        stored.write_text("gone")
+        sidecar = f"{stored}.meta.json"
+        with open(sidecar, 'w') as f:
+            json.dump({'original_path': str(stored), 'sync_id': "case", 'direction': "one_way"}, f)
+        ts = time.time() - age_days * 86400
+        os.utime(sidecar, (ts, ts))
+
+    assert engine.purge_old_deletions(deleted_root, 30) == 1
+    assert not old.exists() and not old.parent.exists()
+    assert recent.exists()
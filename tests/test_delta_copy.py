@@ -0,0 +1,77 @@
+"""Block-level updates of large files (user-006)"""
+import os
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import AGED, make_job, run, tree, write
+
+BLOCK = 4096
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(engine, "DELTA_BLOCK_SIZE", BLOCK)
+
+
+def test_only_changed_blocks_are_written(tmp_path):
+    data = bytearray(os.urandom(BLOCK * 20 + 100))
+    dst = tmp_path / "dst.bin"
+    dst.write_bytes(data)
+    data[BLOCK * 7 + 5] ^= 0xFF
+    src = tmp_path / "src.bin"
+    src.write_bytes(data)
+
+    sigs, written, total = engine.delta_copy(src, dst)
+    assert (written, total) == (1, 21)
+    assert len(sigs) == 21 * 16
+    assert dst.read_bytes() == data
+
+
+def test_recorded_signature_stands_in_for_reading_dst(tmp_path):
+    data = bytearray(os.urandom(BLOCK * 8))
+    src, dst = tmp_path / "src.bin", tmp_path / "dst.bin"
+    src.write_bytes(data)
+    dst.write_bytes(data)
+    sigs, _, _ = engine.delta_copy(src, dst)
+    st = dst.stat()
+
+    data[BLOCK * 3] ^= 0xFF
+    src.write_bytes(data)
+    written = engine.delta_copy(src, dst, (st.st_mtime, st.st_size, BLOCK, sigs))[1]
+    assert written == 1
+    assert dst.read_bytes() == data
+
+
+def test_mostly_different_file_gives_up_comparing(tmp_path):
+    # The first 16 blocks all differ; past that point the rest is rewritten without being read back
+    data = os.urandom(BLOCK * 32)
+    src, dst = tmp_path / "src.bin", tmp_path / "dst.bin"
+    src.write_bytes(data)
+    dst.write_bytes(os.urandom(BLOCK * 16) + data[BLOCK * 16:])
+    written, total = engine.delta_copy(src, dst)[1:]
+    assert (written, total) == (32, 32)
+    assert dst.read_bytes() == data
+
+
+@pytest.mark.parametrize("size", [BLOCK * 5, BLOCK * 12 + 1])
+def test_size_change(tmp_path, size):
+    src, dst = tmp_path / "src.bin", tmp_path / "dst.bin"
+    src.write_bytes(os.urandom(size))
+    dst.write_bytes(src.read_bytes()[:BLOCK * 4] + os.urandom(BLOCK * 4))
+    engine.delta_copy(src, dst)
+    assert dst.read_bytes() == src.read_bytes()
+
+
+def test_sync_updates_large_file_by_block(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "DELTA_THRESHOLD", BLOCK * 4)
+    job = make_job(tmp_path)
+    data = bytearray(os.urandom(BLOCK * 10))
+    write(job.source_path / "image.dd", bytes(data))
+    run(job)
+    data[BLOCK * 2] ^= 0xFF
+    write(job.source_path / "image.dd", bytes(data), AGED + 60)
+    record = run(job)
+    assert record['delta_files'] == 1
+    assert record['delta_blocks_written'] == 1
+    assert tree(job.dest_path) == tree(job.source_path)
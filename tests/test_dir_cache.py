@@ -0,0 +1,45 @@
+"""Directory listings reused across runs (user-004)"""
+import VaultMirrorEngine as engine
+from helpers import AGED, age_dirs, make_job, run, tree, write
+
+
+def synced_job(tmp_path):
+    job = make_job(tmp_path)
+    write(job.source_path / "sub" / "notes.txt", b"first draft")
+    write(job.source_path / "sub" / "other.txt", b"unchanged")
+    age_dirs(job.source_path)
+    run(job)
+    # The first run wrote into every destination directory, so their listings were dropped
+    age_dirs(job.dest_path)
+    run(job)
+    return job
+
+
+def test_unchanged_directories_are_not_relisted(tmp_path, mode):
+    job = synced_job(tmp_path)
+    record = run(job)
+    assert record['scanned']['a']['dir_cache_hits'] == 2
+    assert record['scanned']['b']['dir_cache_hits'] == 2
+    assert record['scanned']['a']['files'] == 2
+
+
+def test_added_file_changes_the_directory(tmp_path, mode):
+    job = synced_job(tmp_path)
+    write(job.source_path / "sub" / "added.txt", b"new")
+    record = run(job)
+    assert record['copies'] == 1
+    assert tree(job.dest_path) == tree(job.source_path)
+
+
+def test_in_place_edit_waits_for_full_rescan(tmp_path, mode, monkeypatch):
+    job = synced_job(tmp_path)
+    # Same size, later mtime: the directory's own mtime and size do not move
+    write(job.source_path / "sub" / "notes.txt", b"final draft", AGED + 60)
+    age_dirs(job.source_path)
+    run(job)
+    assert (job.dest_path / "sub" / "notes.txt").read_bytes() == b"first draft"
+
+    monkeypatch.setattr(engine, "DIR_CACHE_FULL_RESCAN_EVERY", 1)
+    record = run(job)
+    assert record['scanned']['a']['dir_cache_hits'] == 0
+    assert tree(job.dest_path) == tree(job.source_path)
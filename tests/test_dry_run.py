@@ -0,0 +1,49 @@
+"""Plan-then-execute and the --dry-run report (user-013)"""
+import os
+
+import VaultMirrorEngine as engine
+from helpers import AGED, make_job, run, tree, write
+
+
+def changed_job(tmp_path):
+    job = make_job(tmp_path)
+    write(job.source_path / "kept.txt", b"k" * 10)
+    write(job.source_path / "edited.txt", b"e" * 20)
+    write(job.source_path / "removed.txt", b"r" * 50)
+    write(job.source_path / "moved.bin", os.urandom(70))
+    run(job)
+    write(job.source_path / "added.txt", b"a" * 100)
+    write(job.source_path / "edited.txt", b"E" * 200, AGED + 60)
+    (job.source_path / "removed.txt").unlink()
+    os.rename(job.source_path / "moved.bin", job.source_path / "moved-here.bin")
+    return job
+
+
+def test_dry_run_reports_the_plan_and_changes_nothing(tmp_path, mode, capsys):
+    job = changed_job(tmp_path)
+    before = tree(job.dest_path)
+    store = engine.open_state_store(job.state_file)
+    runs = store.get_meta('runs')
+    store.close()
+    capsys.readouterr()
+
+    record = run(job, dry_run=True)
+    # The renamed file counts as unchanged once the rename is replayed
+    assert record['planned'] == {'copies': 2, 'bytes': 300, 'safe_deletes': 1, 'renames': 1, 'unchanged': 2}
+    out = capsys.readouterr().out
+    assert "Copy A -> B:   2 file(s), 300 bytes" in out
+    assert "Safe-delete:   1 file(s), 50 bytes" in out
+    # The new file plus what the edited one grew by
+    assert "needs 280 bytes" in out
+    assert "Rename/move:   1 file(s)" in out
+    assert tree(job.dest_path) == before
+    assert not job.lock_file.exists()
+    store = engine.open_state_store(job.state_file)
+    assert store.get_meta('runs') == runs
+    store.close()
+
+    # The real run then carries out the same plan
+    record = run(job)
+    assert record['planned']['copies'] == 2 and record['copies'] == 2
+    assert record['safe_deletes'] == 1
+    assert tree(job.dest_path) == tree(job.source_path)
@@ -0,0 +1,26 @@
+"""The engine as a module scheduled runs import on their own (user-011)"""
+import subprocess
+import sys
+from pathlib import Path
+
+import VaultMirrorEngine as engine
+
+ROOT = Path(engine.__file__).resolve().parent
+
+
+def test_import_leaves_gui_and_platform_modules_alone():
+    heavy = ('tkinter', 'win32com', 'ctypes', 'multiprocessing', 'mmap', 'VaultMirror')
+    out = subprocess.run([sys.executable, "-c", "import sys, VaultMirrorEngine; "
+                          f"print(','.join(m for m in {heavy!r} if m in sys.modules))"],
+                         cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    assert out.strip() == ""
+
+
+def test_drive_accessibility(tmp_path, monkeypatch):
+    assert engine.is_drive_accessible(tmp_path)
+    assert not engine.is_drive_accessible(tmp_path / "unplugged")
+
+    def denied(self):
+        raise PermissionError(13, "Access is denied", str(self))
+    monkeypatch.setattr(Path, "iterdir", denied)
+    assert not engine.is_drive_accessible(tmp_path)
@@ -0,0 +1,89 @@
+"""gitignore-style exclusion rules and pruned directories (user-020)"""
+import os
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import age_dirs, make_job, run, tree, write
+
+
+def excluded(patterns, path, is_dir=False):
+    return engine.ExclusionRules(patterns).excludes_path(path.replace("/", os.sep), is_dir)
+
+
+@pytest.mark.parametrize("patterns, path, is_dir, expected", [
+    # Names without a slash match at any depth; matching ignores case
+    (["Thumbs.db"], "case/photos/thumbs.DB", False, True),
+    (["*.log"], "a/b/trace.log", False, True),
+    (["*.log"], "a/b/trace.log.txt", False, False),
+    (["~$*"], "docs/~$report.docx", False, True),
+    (["img_??.raw"], "img_01.raw", False, True),
+    (["img_??.raw"], "img_001.raw", False, False),
+    (["img_[0-4].raw"], "img_3.raw", False, True),
+    (["img_[!0-4].raw"], "img_3.raw", False, False),
+    # A slash anchors the rule to the root
+    (["build/out"], "build/out", True, True),
+    (["build/out"], "src/build/out", True, False),
+    (["/scratch"], "scratch", True, True),
+    (["/scratch"], "src/scratch", True, False),
+    # "*" stays within a name, "**" spans folders
+    (["exports/*.csv"], "exports/q1.csv", False, True),
+    (["exports/*.csv"], "exports/2024/q1.csv", False, False),
+    (["exports/**/*.csv"], "exports/2024/q1/jan.csv", False, True),
+    (["exports/**/*.csv"], "exports/q1.csv", False, True),
+    (["**/cache"], "a/b/cache", True, True),
+    (["logs/**"], "logs/2024/run.txt", False, True),
+    # A trailing slash matches folders only
+    (["cache/"], "cache", True, True),
+    (["cache/"], "cache", False, False),
+    (["cache/"], "app/cache/blob.bin", False, True),
+    # The last matching rule wins, so "!" re-includes
+    (["*.bak", "!keep.bak"], "x/keep.bak", False, False),
+    (["*.bak", "!keep.bak"], "x/drop.bak", False, True),
+    (["!keep.bak", "*.bak"], "x/keep.bak", False, True),
+    # ...but nothing below an excluded folder comes back
+    (["vendor/", "!vendor/keep.txt"], "vendor/keep.txt", False, True),
+    # Built-in rules and our own temp files
+    ([], "x/scratch.tmp", False, True),
+    ([], "x/image.dd" + engine.PARTIAL_SUFFIX, False, True),
+    ([], "x/report.docx", False, False),
+])
+def test_rule_matching(patterns, path, is_dir, expected):
+    assert excluded(patterns, path, is_dir) is expected
+
+
+def test_comments_and_blank_lines_are_ignored():
+    rules = engine.ExclusionRules(["# *.docx", "", "   "])
+    assert not rules.excludes_path("report.docx")
+
+
+def test_deleted_folder_is_excluded_under_either_root(tmp_path):
+    deleted = tmp_path / "B" / "_deleted"
+    rules = engine.ExclusionRules((), [deleted], (tmp_path / "A", tmp_path / "B"))
+    assert rules.excludes_dir("_deleted", "_deleted")
+    assert not rules.excludes_dir("other", "other")
+
+
+def test_excluded_folders_are_pruned_from_sync(tmp_path, mode):
+    job = make_job(tmp_path, exclude=["node_modules/", "*.bak", "!keep.bak"])
+    write(job.source_path / "src" / "main.py", b"code")
+    write(job.source_path / "src" / "old.bak", b"old")
+    write(job.source_path / "src" / "keep.bak", b"keep")
+    write(job.source_path / "node_modules" / "lib" / "index.js", b"dep")
+    record = run(job)
+    assert tree(job.dest_path) == {'src/main.py': b"code", 'src/keep.bak': b"keep"}
+    assert record['scanned']['a']['files'] == 2
+
+
+def test_changed_rules_force_a_full_rescan(tmp_path, mode):
+    job = make_job(tmp_path, exclude=["*.raw"])
+    write(job.source_path / "sub" / "img.raw", b"raw")
+    write(job.source_path / "sub" / "img.jpg", b"jpg")
+    age_dirs(job.source_path)
+    run(job)
+    assert tree(job.dest_path) == {'sub/img.jpg': b"jpg"}
+
+    # Nothing on disk changed, so only the new rules can bring img.raw in despite the cached listing
+    job = make_job(tmp_path, exclude=[])
+    run(job)
+    assert tree(job.dest_path) == tree(job.source_path)
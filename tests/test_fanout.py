@@ -0,0 +1,63 @@
+"""One source read once and mirrored to several destinations (user-021)"""
+import os
+
+import VaultMirrorEngine as engine
+from helpers import AGED, deleted_files, tree, write
+
+
+def test_fanout_mirrors_every_destination(tmp_path):
+    src = tmp_path / "A"
+    write(src / "case" / "image.dd", os.urandom(64 * 1024))
+    write(src / "notes.txt", b"hello")
+    fanout_job = engine.FanoutJob({
+        'case_name': "fan",
+        'source_path': str(src),
+        'destinations': [{
+            'dest_path': str(tmp_path / f"B{i}"),
+            'state_file': str(tmp_path / f"fan{i}.json"),
+            'lock_file': str(tmp_path / f"fan{i}.lock"),
+            'deleted_root': str(tmp_path / f"deleted{i}"),
+        } for i in (1, 2)],
+    })
+    for job in fanout_job.jobs:
+        job.dest_path.mkdir()
+    engine.sync_fanout(fanout_job)
+    for job in fanout_job.jobs:
+        assert tree(job.dest_path) == tree(src)
+
+    (src / "notes.txt").unlink()
+    write(src / "case" / "image.dd", os.urandom(64 * 1024), AGED + 60)
+    engine.sync_fanout(fanout_job)
+    for job in fanout_job.jobs:
+        assert tree(job.dest_path) == tree(src)
+        assert len(deleted_files(job)) == 1
+
+
+def test_locked_destination_is_left_behind(tmp_path):
+    src = tmp_path / "A"
+    write(src / "notes.txt", b"hello")
+    fanout_job = engine.FanoutJob({
+        'case_name': "fan",
+        'source_path': str(src),
+        'exclude': ["*.bak"],
+        'destinations': [{
+            'dest_path': str(tmp_path / f"B{i}"),
+            'state_file': str(tmp_path / f"fan{i}.json"),
+            'lock_file': str(tmp_path / f"fan{i}.lock"),
+            'deleted_root': str(tmp_path / f"deleted{i}"),
+        } for i in (1, 2)],
+    })
+    assert [job.case_name for job in fanout_job.jobs] == ["fan_1", "fan_2"]
+    for job in fanout_job.jobs:
+        job.dest_path.mkdir()
+    # Destination 2 is busy with another run: destination 1 goes ahead without it
+    fanout_job.jobs[1].lock_file.touch()
+    write(src / "old.bak", b"excluded")
+    engine.sync_fanout(fanout_job)
+    assert tree(fanout_job.jobs[0].dest_path) == {'notes.txt': b"hello"}
+    assert tree(fanout_job.jobs[1].dest_path) == {}
+
+    fanout_job.jobs[1].lock_file.unlink()
+    engine.sync_fanout(fanout_job)
+    for job in fanout_job.jobs:
+        assert tree(job.dest_path) == {'notes.txt': b"hello"}
@@ -0,0 +1,93 @@
+"""mtimes compared to the coarser side's timestamp resolution (user-023)"""
+import math
+import os
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import AGED, make_job, run, write
+
+FAT = 2_000_000_000
+
+
+def meta(mtime, size=10):
+    return engine.file_meta(mtime, size)
+
+
+@pytest.mark.parametrize("a, b, tolerance, expected", [
+    (meta(101.0), meta(100.0), 0.0, True),
+    (meta(100.0), meta(101.0), 0.0, False),
+    (meta(100.0), meta(100.0), 0.0, False),
+    # Within the tolerance the times are the same, and only the size can tell the versions apart
+    (meta(101.0), meta(100.0), 2.0, False),
+    (meta(100.0), meta(101.5), 2.0, False),
+    (meta(101.0), meta(100.0, 11), 2.0, True),
+    (meta(103.0), meta(100.0), 2.0, True),
+])
+def test_mtime_newer(a, b, tolerance, expected):
+    assert engine.mtime_newer(a, b, tolerance) is expected
+
+
+def test_mtime_moved():
+    assert not engine.mtime_moved(meta(100.0), meta(101.9), 2.0)
+    assert engine.mtime_moved(meta(100.0), meta(102.1), 2.0)
+    assert engine.mtime_moved(meta(100.0), meta(100.001))
+
+
+def test_probe_measures_this_filesystem(tmp_path):
+    ns = engine.probe_mtime_resolution(tmp_path)
+    assert ns in engine.MTIME_RESOLUTIONS_NS
+    assert list(tmp_path.iterdir()) == []
+    assert engine.probe_mtime_resolution(tmp_path / "missing") is None
+
+
+@pytest.mark.parametrize("bidirectional", [False, True])
+def test_only_written_sides_are_probed(tmp_path, monkeypatch, bidirectional):
+    probed = []
+    def probe(root):
+        probed.append(root)
+        return FAT if root == job.dest_path else 1
+    monkeypatch.setattr(engine, "probe_mtime_resolution", probe)
+    monkeypatch.setattr(engine, "filesystem_type", lambda path: None)
+    job = make_job(tmp_path, bidirectional=bidirectional)
+    store = engine.open_state_store(job.state_file)
+    try:
+        assert engine.detect_mtime_tolerance(job, store, True, True) == 2.0
+        expected = [job.source_path, job.dest_path] if bidirectional else [job.dest_path]
+        assert probed == expected
+        # Cached in the manifest: the next run does not probe again
+        engine.detect_mtime_tolerance(job, store, True, True)
+        assert probed == expected
+    finally:
+        store.close()
+
+
+def test_unknown_one_way_source_counts_as_coarse(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "probe_mtime_resolution", lambda root: 1)
+    job = make_job(tmp_path)
+    store = engine.open_state_store(job.state_file)
+    try:
+        monkeypatch.setattr(engine, "filesystem_type", lambda path: None)
+        assert engine.detect_mtime_tolerance(job, store, True, True) == 2.0
+        monkeypatch.setattr(engine, "filesystem_type", lambda path: "ntfs")
+        assert engine.detect_mtime_tolerance(job, store, True, True) == 100 / 1e9
+    finally:
+        store.close()
+
+
+def test_rounded_copies_are_not_copied_again(tmp_path, monkeypatch, mode):
+    monkeypatch.setattr(engine, "probe_mtime_resolution", lambda root: FAT if root == job.dest_path else 1)
+    monkeypatch.setattr(engine, "filesystem_type", lambda path: "ext4")
+    job = make_job(tmp_path, bidirectional=True)
+    write(job.source_path / "report.docx", b"content", AGED + 0.7)
+    run(job)
+    # What a FAT destination does to the copy's mtime
+    copy = job.dest_path / "report.docx"
+    rounded = math.floor(copy.stat().st_mtime / 2) * 2
+    os.utime(copy, (rounded, rounded))
+    record = run(job)
+    assert record['mtime_tolerance'] == 2.0
+    assert record['copies'] == 0
+
+    monkeypatch.setattr(engine, "MTIME_PROBE", False)
+    assert run(job)['copies'] == 1
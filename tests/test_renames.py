@@ -0,0 +1,48 @@
+"""Renames and moves replayed on the other side (user-007)"""
+import os
+from pathlib import Path
+
+import VaultMirrorEngine as engine
+from helpers import AGED, deleted_files, make_job, run, tree, write
+
+
+def test_rename_is_replayed(tmp_path, mode):
+    job = make_job(tmp_path)
+    write(job.source_path / "old" / "report.bin", os.urandom(4096))
+    run(job)
+    os.rename(job.source_path / "old" / "report.bin", job.source_path / "report-final.bin")
+    record = run(job)
+    assert record['planned']['renames'] == 1
+    assert record['copies'] == 0
+    assert tree(job.dest_path) == tree(job.source_path)
+    assert deleted_files(job) == []
+
+
+def test_lookalike_is_not_paired_as_rename(tmp_path, mode):
+    job = make_job(tmp_path)
+    write(job.source_path / "gone.bin", b"x" * 4096)
+    run(job)
+    # Same size and mtime as the vanished file, different content
+    (job.source_path / "gone.bin").unlink()
+    write(job.source_path / "new.bin", b"y" * 4096)
+    record = run(job)
+    assert record['planned']['renames'] == 0
+    assert tree(job.dest_path) == {'new.bin': b"y" * 4096}
+    assert [p.read_bytes() for p in deleted_files(job)] == [b"x" * 4096]
+
+
+def test_pair_renames_matches_by_digest(tmp_path):
+    src, dst = tmp_path / "A", tmp_path / "B"
+    for root, names in ((dst, ("one", "two")), (src, ("uno", "dos"))):
+        root.mkdir()
+        for name in names:
+            write(root / name, {"one": b"1" * 10, "uno": b"1" * 10, "two": b"2" * 10, "dos": b"2" * 10}[name])
+    meta = engine.file_meta(AGED, 10)
+    digest = lambda path: Path(path).read_bytes()
+    pairs = engine.pair_renames({'one': meta, 'two': meta}, {'uno': meta, 'dos': meta}, src, dst, digest)
+    assert sorted(pairs) == [('one', 'uno'), ('two', 'dos')]
+    # Sizes that differ, or mtimes further apart than the tolerance, are never candidates
+    moved = engine.file_meta(AGED + 5, 10)
+    assert engine.pair_renames({'one': meta}, {'uno': moved}, src, dst, digest) == []
+    assert engine.pair_renames({'one': meta}, {'uno': moved}, src, dst, digest, tolerance=5) == [('one', 'uno')]
+    assert engine.pair_renames({'one': meta}, {'uno': engine.file_meta(AGED, 11)}, src, dst, digest) == []
@@ -0,0 +1,101 @@
+"""Large copies through a journalled temp file that resume where they stopped (user-008)"""
+import hashlib
+import os
+import time
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import make_job, run, tree, write
+
+BLOCK = 4096
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(engine, "DELTA_BLOCK_SIZE", BLOCK)
+    monkeypatch.setattr(engine, "RESUME_SYNC_BLOCKS", 1)
+
+
+def interrupt_after(monkeypatch, blocks):
+    """Make the copy fail on its read after blocks reads"""
+    paced_read = engine.paced_read
+    calls = []
+    def failing_read(f, n, throttle=None):
+        calls.append((f.tell(), n))
+        if len(calls) > blocks:
+            raise OSError("drive unplugged")
+        return paced_read(f, n, throttle)
+    monkeypatch.setattr(engine, "paced_read", failing_read)
+    return calls
+
+
+def interrupted(tmp_path, monkeypatch, data, blocks):
+    src, dst = tmp_path / "src.dd", tmp_path / "dst.dd"
+    src.write_bytes(data)
+    with monkeypatch.context() as m:
+        interrupt_after(m, blocks)
+        with pytest.raises(OSError):
+            engine.resumable_copy(src, dst, tmp_path / "journal")
+    return src, dst
+
+
+def test_interrupted_copy_resumes(tmp_path, monkeypatch, capsys):
+    data = os.urandom(BLOCK * 10 + 123)
+    src, dst = interrupted(tmp_path, monkeypatch, data, 6)
+    partial = tmp_path / ("dst.dd" + engine.PARTIAL_SUFFIX)
+    assert not dst.exists()
+    assert partial.read_bytes()[:BLOCK * 6] == data[:BLOCK * 6]
+
+    reads = interrupt_after(monkeypatch, 100)
+    sigs = engine.resumable_copy(src, dst, tmp_path / "journal")
+    assert f"from {BLOCK * 6:,} of" in capsys.readouterr().out
+    assert min(offset for offset, _ in reads) == BLOCK * 6
+    assert dst.read_bytes() == data
+    assert not partial.exists()
+    assert list((tmp_path / "journal").iterdir()) == []
+    assert len(sigs) == 11 * 16
+
+
+def test_resumed_copy_hashes_the_whole_source(tmp_path, monkeypatch):
+    data = os.urandom(BLOCK * 10)
+    src, dst = interrupted(tmp_path, monkeypatch, data, 3)
+    digest = hashlib.sha256()
+    engine.resumable_copy(src, dst, tmp_path / "journal", (digest,))
+    assert digest.digest() == hashlib.sha256(data).digest()
+    assert dst.read_bytes() == data
+
+
+def test_changed_source_restarts_from_scratch(tmp_path, monkeypatch, capsys):
+    src, dst = interrupted(tmp_path, monkeypatch, os.urandom(BLOCK * 8), 4)
+    data = os.urandom(BLOCK * 8)
+    src.write_bytes(data)
+    engine.resumable_copy(src, dst, tmp_path / "journal")
+    assert "Resuming" not in capsys.readouterr().out
+    assert dst.read_bytes() == data
+
+
+def test_partial_files_are_invisible_and_expire(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "RESUMABLE_THRESHOLD", BLOCK)
+    job = make_job(tmp_path)
+    write(job.source_path / "image.dd", os.urandom(BLOCK * 4))
+    write(job.dest_path / ("stale.dd" + engine.PARTIAL_SUFFIX), b"half a copy")
+    run(job)
+    assert tree(job.dest_path) == {**tree(job.source_path), "stale.dd" + engine.PARTIAL_SUFFIX: b"half a copy"}
+    assert engine.get_tree_state(job.dest_path, job.exclusions).keys() == {"image.dd"}
+
+    # An abandoned journal takes its partial copy with it once it is old enough
+    with monkeypatch.context() as m:
+        interrupt_after(m, 1)
+        with pytest.raises(OSError):
+            engine.resumable_copy(job.source_path / "image.dd", job.dest_path / "other.dd", job.journal_dir)
+    partial = job.dest_path / ("other.dd" + engine.PARTIAL_SUFFIX)
+    assert partial.exists()
+    engine.purge_stale_journals(job.journal_dir)
+    assert partial.exists()
+    old = time.time() - (engine.RESUME_JOURNAL_DAYS + 1) * 86400
+    for p in job.journal_dir.iterdir():
+        os.utime(p, (old, old))
+    engine.purge_stale_journals(job.journal_dir)
+    assert not partial.exists()
+    assert list(job.journal_dir.iterdir()) == []
@@ -0,0 +1,69 @@
+"""One job's sync split across worker processes (user-019)"""
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import AGED, make_job, run, tree, write
+
+
+def build(root):
+    for top in ("alpha", "beta", "gamma", "delta"):
+        for i in range(5):
+            write(root / top / "sub" / f"f{i}.bin", f"{top}-{i}".encode() * 50)
+    write(root / "loose.txt", b"top-level file")
+
+
+def churn(root):
+    # The rename crosses from one top-level folder (and so one shard) to another
+    os.rename(root / "alpha" / "sub" / "f0.bin", root / "delta" / "f0-moved.bin")
+    (root / "beta" / "sub" / "f1.bin").unlink()
+    write(root / "gamma" / "sub" / "f2.bin", b"edited" * 50, AGED + 60)
+    write(root / "epsilon" / "new.bin", b"added")
+    shutil.rmtree(root / "delta" / "sub")
+
+
+def manifest(job):
+    store = engine.open_state_store(job.state_file)
+    try:
+        return list(store.iter_sorted())
+    finally:
+        store.close()
+
+
+def test_sharded_sync_matches_serial(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "STREAMING_DIFF_THRESHOLD", 0)
+    serial, sharded = make_job(tmp_path / "serial"), make_job(tmp_path / "sharded")
+    for job in (serial, sharded):
+        build(job.source_path)
+
+    records = {}
+    for job, shards in ((serial, 1), (sharded, 3)):
+        monkeypatch.setattr(engine, "SYNC_SHARDS", shards)
+        run(job)
+        churn(job.source_path)
+        records[shards] = run(job)
+        assert tree(job.dest_path) == tree(job.source_path)
+
+    assert records[3]['shards'] == 3
+    for key in ('copies', 'safe_deletes'):
+        assert records[3][key] == records[1][key]
+    assert records[3]['planned']['renames'] == records[1]['planned']['renames'] == 1
+    assert manifest(sharded) == manifest(serial)
+    assert not list(sharded.state_file.parent.glob("*.shard*.db"))
+
+
+@pytest.mark.parametrize("appdata", [None, "roaming"])
+def test_ui_module_imports_without_appdata(tmp_path, appdata):
+    # Shard workers are spawned, so they re-import the main module, and it must import anywhere
+    env = {k: v for k, v in os.environ.items() if k != 'APPDATA'}
+    env['HOME'] = str(tmp_path)
+    if appdata:
+        env['APPDATA'] = str(tmp_path / appdata)
+    out = subprocess.run([sys.executable, "-c", "import VaultMirror; print(VaultMirror.BASE_DIR)"],
+                         cwd=os.path.dirname(engine.__file__), env=env, capture_output=True, text=True, check=True)
+    assert out.stdout.strip() == str(Path(tmp_path, appdata or "", "VaultMirror"))
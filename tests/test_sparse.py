@@ -0,0 +1,62 @@
+"""Sparse images copied with their holes left as holes (user-022)"""
+import hashlib
+import os
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import make_job, run
+
+MB = 1024 * 1024
+
+
+def allocated(path):
+    return os.stat(path).st_blocks * 512
+
+
+def make_sparse(path, size=16 * MB, data_at=(MB, 9 * MB)):
+    """A file of size bytes holding 64 KiB of data at each offset in data_at, holes elsewhere"""
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for offset in data_at:
+            f.seek(offset)
+            f.write(os.urandom(64 * 1024))
+    if not hasattr(os.stat_result, 'st_blocks') or allocated(path) >= size // 2:
+        pytest.skip("the temp filesystem does not keep holes")
+    return path
+
+
+def test_copy_file_keeps_holes(tmp_path):
+    # Ends in a hole, so the copy must still be given its full length
+    src = make_sparse(tmp_path / "disk.img")
+    digest = hashlib.sha256()
+    used = engine.copy_file(src, tmp_path / "copy.img", src.stat().st_size, hashers=(digest,))
+    assert used == ('sparse', 'sparse')
+    assert (tmp_path / "copy.img").read_bytes() == src.read_bytes()
+    assert allocated(tmp_path / "copy.img") <= allocated(src) + MB
+    assert digest.digest() == hashlib.sha256(src.read_bytes()).digest()
+
+
+def test_small_and_dense_files_are_copied_whole(tmp_path, monkeypatch):
+    src = make_sparse(tmp_path / "disk.img")
+    monkeypatch.setattr(engine, "SPARSE_COPIES", False)
+    assert engine.copy_file(src, tmp_path / "copy.img", src.stat().st_size)[0] != 'sparse'
+    assert (tmp_path / "copy.img").read_bytes() == src.read_bytes()
+
+
+@pytest.mark.parametrize("resumable", [False, True])
+def test_sync_records_allocated_size(tmp_path, monkeypatch, resumable):
+    if resumable:
+        monkeypatch.setattr(engine, "RESUMABLE_THRESHOLD", MB)
+    job = make_job(tmp_path)
+    src = make_sparse(job.source_path / "disk.img")
+    run(job)
+    copy = job.dest_path / "disk.img"
+    assert copy.read_bytes() == src.read_bytes()
+    # Resumable copies skip holes a whole block at a time: each data island costs one block
+    assert allocated(copy) <= 2 * engine.DELTA_BLOCK_SIZE + MB
+    store = engine.open_state_store(job.state_file)
+    meta = store.load()['disk.img']
+    store.close()
+    assert meta['size'] == 16 * MB
+    assert meta['alloc'] < 16 * MB
@@ -0,0 +1,75 @@
+"""SQLite manifest, its JSON predecessor and the migration between them (user-003)"""
+import json
+
+import pytest
+
+import VaultMirrorEngine as engine
+from helpers import make_job, run, tree, write
+
+
+def test_sqlite_round_trip(tmp_path):
+    store = engine.SqliteStateStore(tmp_path / "state.db")
+    assert store.load() == {}
+    state = {'a.txt': engine.file_meta(100.0, 3), 'sub/b.bin': engine.file_meta(200.0, 5)}
+    for rel, meta in state.items():
+        store.stage(rel, meta)
+    store.finish(state)
+    store.close()
+
+    store = engine.SqliteStateStore(tmp_path / "state.db")
+    assert store.load() == state
+    store.stage('a.txt', engine.file_meta(150.0, 4))
+    store.finish({'a.txt': engine.file_meta(150.0, 4)})
+    store.close()
+
+    store = engine.SqliteStateStore(tmp_path / "state.db")
+    assert store.load() == {'a.txt': engine.file_meta(150.0, 4)}
+    assert store.run_number == 3
+    store.close()
+
+
+def test_json_manifest_is_migrated_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(engine, "STATE_BACKEND", "sqlite")
+    legacy = {'a.txt': {'mtime': 100.0, 'size': 3}}
+    state_path = tmp_path / "case.json"
+    state_path.write_text(json.dumps(legacy))
+
+    store = engine.open_state_store(state_path)
+    assert isinstance(store, engine.SqliteStateStore)
+    assert store.load() == legacy
+    store.close()
+    assert not state_path.exists()
+    assert (tmp_path / "case.json.migrated").exists()
+
+    # A JSON manifest that reappears (say, after a rollback) is not imported over the database
+    state_path.write_text(json.dumps({'stale.txt': {'mtime': 1.0, 'size': 1}}))
+    store = engine.open_state_store(state_path)
+    assert store.load() == legacy
+    store.close()
+
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_sync_with_each_backend(tmp_path, monkeypatch, backend):
+    monkeypatch.setattr(engine, "STATE_BACKEND", backend)
+    job = make_job(tmp_path)
+    write(job.source_path / "a.txt", b"one")
+    write(job.source_path / "sub" / "b.txt", b"two")
+    run(job)
+    assert tree(job.dest_path) == tree(job.source_path)
+    assert run(job)['copies'] == 0
+    (job.source_path / "a.txt").unlink()
+    run(job)
+    assert tree(job.dest_path) == {'sub/b.txt': b"two"}
+
+
+def test_upgrade_from_json_keeps_the_mirror(tmp_path, monkeypatch):
+    job = make_job(tmp_path)
+    write(job.source_path / "a.txt", b"one")
+    monkeypatch.setattr(engine, "STATE_BACKEND", "json")
+    run(job)
+    monkeypatch.setattr(engine, "STATE_BACKEND", "sqlite")
+    # The migrated manifest still knows a.txt was synced, so deleting it on A deletes it on B
+    (job.source_path / "a.txt").unlink()
+    record = run(job)
+    assert record['copies'] == 0
+    assert tree(job.dest_path) == {}